@@ -0,0 +1,190 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+"""
+Synthetic genome-scale data for the benchmarks.
+
+Annotations are written in the scibiomart format (Ensembl chromosome names, e.g. 1) and inputs use UCSC names
+(e.g. chr1) so the chromosome naming layer is exercised as well. Everything is generated and written in chunks so
+that very large inputs (100M rows) never need to be held in memory.
+
+Example:
+    python benchmarks/generate.py annotation --rows 60000 --o annot.csv
+    python benchmarks/generate.py narrowpeak --rows 1000000 --o peaks.bed --unsorted
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+
+
+# GRCh38 primary chromosome lengths
+CHR_LENGTHS = {'1': 248956422, '2': 242193529, '3': 198295559, '4': 190214555, '5': 181538259, '6': 170805979,
+               '7': 159345973, '8': 145138636, '9': 138394717, '10': 133797422, '11': 135086622, '12': 133275309,
+               '13': 114364328, '14': 107043718, '15': 101991189, '16': 90338345, '17': 83257441, '18': 80373285,
+               '19': 58617616, '20': 64444167, '21': 46709983, '22': 50818468, 'X': 156040895, 'Y': 57227415}
+CHUNK_ROWS = 1000000
+
+INPUT_TYPES = ['narrowpeak', 'broadpeak', 'dmr', 'cpg']
+
+
+def rows_per_chr(num_rows: int) -> dict:
+    """ Splits num_rows across the chromosomes proportionally to their length. """
+    lengths = np.array(list(CHR_LENGTHS.values()), dtype=np.float64)
+    counts = np.floor(num_rows * lengths / lengths.sum()).astype(np.int64)
+    counts[0] += num_rows - counts.sum()
+    return dict(zip(CHR_LENGTHS.keys(), counts))
+
+
+def generate_annotation(num_rows: int, output_file: str, transcripts_per_gene=1, sort=True, seed=0) -> str:
+    """
+    Writes a synthetic gene (or transcript) annotation. With transcripts_per_gene > 1 each gene has several rows with
+    alternative TSSs that share the gene id (i.e. a transcript table).
+
+    Parameters
+    ----------
+    num_rows:               int: number of rows (genes or transcripts)
+    output_file:            str: csv to write to
+    transcripts_per_gene:   int: rows that share each gene id
+    sort:                   Bool: whether to sort on chromosome and start
+    seed:                   int: random seed
+
+    Returns
+    -------
+    output_file
+    """
+    rng = np.random.default_rng(seed)
+    dfs = []
+    gene_offset = 0
+    for chr_name, count in rows_per_chr(num_rows).items():
+        num_genes = max(int(np.ceil(count / transcripts_per_gene)), 1)
+        gene_starts = rng.integers(10000, CHR_LENGTHS[chr_name] - 3000000, num_genes)
+        gene_lengths = np.minimum(rng.lognormal(9.5, 1.3, num_genes).astype(np.int64) + 200, 2500000)
+        strands = rng.choice([-1, 1], num_genes)
+        gene_idx = np.repeat(np.arange(num_genes), transcripts_per_gene)[:count]
+        # Alternative TSSs are placed within the gene body
+        tss_shift = np.where(np.arange(count) % transcripts_per_gene == 0, 0,
+                             rng.integers(0, gene_lengths[gene_idx] // 2 + 1))
+        starts = gene_starts[gene_idx] + np.where(strands[gene_idx] > 0, tss_shift, 0)
+        ends = gene_starts[gene_idx] + gene_lengths[gene_idx] - np.where(strands[gene_idx] < 0, tss_shift, 0)
+        gene_ids = gene_idx + gene_offset
+        dfs.append(pd.DataFrame({'ensembl_gene_id': [f'ENSSYN{g:011d}' for g in gene_ids],
+                                 'external_gene_name': [f'SYN{g}' for g in gene_ids],
+                                 'chromosome_name': chr_name, 'start_position': starts, 'end_position': ends,
+                                 'strand': strands[gene_idx]}))
+        gene_offset += num_genes
+    annot_df = pd.concat(dfs, ignore_index=True)
+    if sort:
+        annot_df = annot_df.sort_values(['chromosome_name', 'start_position'], kind='stable')
+    else:
+        annot_df = annot_df.sample(frac=1, random_state=seed)
+    annot_df.to_csv(output_file, index=False)
+    return output_file
+
+
+def _location_chunk(input_type: str, chr_names: np.ndarray, starts: np.ndarray, rng, first_idx: int) -> pd.DataFrame:
+    """ One chunk of locations of the given type. """
+    n = len(starts)
+    ucsc_chrs = np.char.add('chr', chr_names.astype(str))
+    if input_type == 'narrowpeak':
+        ends = starts + rng.integers(150, 3000, n)
+        return pd.DataFrame({0: ucsc_chrs, 1: starts, 2: ends, 3: [f'Peak_{i}' for i in range(first_idx, first_idx + n)],
+                             4: rng.integers(0, 1000, n), 5: '.', 6: np.round(rng.gamma(2, 2, n), 5),
+                             7: np.round(rng.gamma(2, 3, n), 5), 8: np.round(rng.gamma(2, 2, n), 5),
+                             9: rng.integers(0, 500, n)})
+    if input_type == 'broadpeak':
+        ends = starts + rng.integers(5000, 500000, n)
+        return pd.DataFrame({0: ucsc_chrs, 1: starts, 2: ends, 3: [f'Peak_{i}' for i in range(first_idx, first_idx + n)],
+                             4: rng.integers(0, 1000, n), 5: '.', 6: np.round(rng.gamma(2, 2, n), 5),
+                             7: np.round(rng.gamma(2, 3, n), 5), 8: np.round(rng.gamma(2, 2, n), 5)})
+    if input_type == 'dmr':
+        ends = starts + rng.integers(100, 20000, n)
+        pvals = rng.random(n)
+        return pd.DataFrame({'seqnames': ucsc_chrs, 'start': starts, 'end': ends, 'width': ends - starts + 1,
+                             'strand': '*', 'stat': np.round(rng.normal(0, 20, n), 3), 'pval': pvals,
+                             'qval': np.minimum(pvals * 2, 1)})
+    if input_type == 'cpg':
+        pvals = rng.random(n)
+        return pd.DataFrame({'chr': ucsc_chrs, 'start': starts, 'end': starts, 'strand': '*',
+                             'pvalue': pvals, 'qvalue': np.minimum(pvals * 2, 1),
+                             'meth.diff': np.round(rng.normal(0, 30, n), 3)})
+    raise ValueError(f'Unknown input type: {input_type}, should be one of {INPUT_TYPES}')
+
+
+def generate_locations(input_type: str, num_rows: int, output_file: str, sort=True, seed=0) -> str:
+    """
+    Writes synthetic locations (narrowpeak/broadpeak bed, or dmr/cpg csv) in chunks.
+
+    Parameters
+    ----------
+    input_type:     str: one of narrowpeak, broadpeak, dmr or cpg
+    num_rows:       int: number of rows
+    output_file:    str: file to write to
+    sort:           Bool: whether the file is sorted on chromosome and start
+    seed:           int: random seed
+
+    Returns
+    -------
+    output_file
+    """
+    rng = np.random.default_rng(seed)
+    is_bed = input_type in ['narrowpeak', 'broadpeak']
+    sep = '\t' if is_bed else ','
+    first = True
+    written = 0
+    with open(output_file, 'w') as f:
+        if sort:
+            # Chromosome by chromosome, each chromosome is generated in sorted chunks of its own range
+            for chr_name, count in rows_per_chr(num_rows).items():
+                num_chunks = max(int(np.ceil(count / CHUNK_ROWS)), 1)
+                bounds = np.linspace(0, CHR_LENGTHS[chr_name] - 600000, num_chunks + 1).astype(np.int64)
+                chunk_counts = np.diff(np.linspace(0, count, num_chunks + 1).astype(np.int64))
+                for i in range(num_chunks):
+                    starts = np.sort(rng.integers(bounds[i], bounds[i + 1], chunk_counts[i]))
+                    chunk = _location_chunk(input_type, np.full(len(starts), chr_name), starts, rng, written)
+                    chunk.to_csv(f, sep=sep, header=first and not is_bed, index=False)
+                    first, written = False, written + len(chunk)
+        else:
+            chr_names = np.array(list(CHR_LENGTHS.keys()))
+            lengths = np.array(list(CHR_LENGTHS.values()))
+            while written < num_rows:
+                n = min(CHUNK_ROWS, num_rows - written)
+                chr_idx = rng.choice(len(chr_names), n, p=lengths / lengths.sum())
+                starts = rng.integers(0, lengths[chr_idx] - 600000)
+                chunk = _location_chunk(input_type, chr_names[chr_idx], starts, rng, written)
+                chunk.to_csv(f, sep=sep, header=first and not is_bed, index=False)
+                first, written = False, written + n
+    return output_file
+
+
+def gen_parser():
+    parser = argparse.ArgumentParser(description='Generate synthetic data for the scie2g benchmarks')
+    parser.add_argument('kind', type=str, help=f'annotation or one of {INPUT_TYPES}')
+    parser.add_argument('--rows', type=int, default=10000, help='Number of rows to generate')
+    parser.add_argument('--o', type=str, required=True, help='Output file')
+    parser.add_argument('--transcripts', type=int, default=1, help='Annotation only: rows per gene id')
+    parser.add_argument('--unsorted', action='store_true', help='Write the rows in a random order')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    return parser
+
+
+if __name__ == "__main__":
+    args = gen_parser().parse_args()
+    if args.kind == 'annotation':
+        generate_annotation(args.rows, args.o, args.transcripts, not args.unsorted, args.seed)
+    else:
+        generate_locations(args.kind, args.rows, args.o, not args.unsorted, args.seed)
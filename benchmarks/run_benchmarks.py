@@ -0,0 +1,174 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+"""
+Benchmark harness: times each stage of a scie2g run on synthetic data and saves the timings as JSON so that runs can
+be compared with each other (e.g. before and after a performance change).
+
+Stages: annotation_load, assign_locations_to_genes, get_gene_info_as_df, save_loc_to_csv.
+
+Example:
+    python benchmarks/run_benchmarks.py --preset small --o before.json
+    python benchmarks/run_benchmarks.py --preset small --o after.json --compare before.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+# Run against the checkout this file is in rather than an installed scie2g
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate import INPUT_TYPES, generate_annotation, generate_locations
+
+import scie2g
+from scie2g import Bed, Csv
+
+STAGES = ['annotation_load', 'assign_locations_to_genes', 'get_gene_info_as_df', 'save_loc_to_csv']
+
+# (annotation rows, transcripts per gene, input rows, sorted) for each preset, every input type is run for each
+PRESETS = {
+    'small': [(10000, 1, 10000, True), (10000, 1, 10000, False)],
+    'medium': [(60000, 1, 1000000, True), (60000, 1, 1000000, False), (250000, 4, 1000000, True)],
+    'large': [(60000, 1, 10000000, True), (2000000, 8, 10000000, True), (60000, 1, 100000000, True),
+              (60000, 1, 100000000, False)],
+}
+
+
+def make_e2g(input_type: str, filename: str, overlap_method: str):
+    """ Bed or Csv object with the columns of the generated input type. """
+    if input_type == 'narrowpeak':
+        return Bed(filename, overlap_method=overlap_method, peak_value=6, header_extra='8,9')
+    if input_type == 'broadpeak':
+        return Bed(filename, overlap_method=overlap_method, peak_value=6, header_extra='7,8')
+    if input_type == 'dmr':
+        return Csv(filename, 'seqnames', 'start', 'end', 'stat', ['pval', 'qval'], overlap_method=overlap_method)
+    return Csv(filename, 'chr', 'start', 'end', 'meth.diff', ['pvalue', 'qvalue'], overlap_method=overlap_method)
+
+
+def get_data(work_dir: str, annotation_rows: int, transcripts: int, input_type: str, input_rows: int,
+             is_sorted: bool):
+    """ Generates (or reuses previously generated) annotation and input files. """
+    annotation = os.path.join(work_dir, f'annotation_{annotation_rows}_{transcripts}.csv')
+    if not os.path.isfile(annotation):
+        generate_annotation(annotation_rows, annotation, transcripts)
+    ext = 'bed' if input_type in ['narrowpeak', 'broadpeak'] else 'csv'
+    input_file = os.path.join(work_dir, f'{input_type}_{input_rows}_{"sorted" if is_sorted else "unsorted"}.{ext}')
+    if not os.path.isfile(input_file):
+        generate_locations(input_type, input_rows, input_file, is_sorted)
+    return annotation, input_file
+
+
+def run_case(annotation: str, input_file: str, input_type: str, overlap_method: str, output_file: str,
+             stages: list) -> dict:
+    """ Runs each stage once and returns the time (seconds) taken by each. """
+    timings = {}
+    e2g = make_e2g(input_type, input_file, overlap_method)
+    t0 = time.perf_counter()
+    e2g.set_annotation_from_file(annotation)
+    timings['annotation_load'] = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    e2g.assign_locations_to_genes()
+    timings['assign_locations_to_genes'] = time.perf_counter() - t0
+    if 'get_gene_info_as_df' in stages:
+        t0 = time.perf_counter()
+        e2g.get_gene_info_as_df()
+        timings['get_gene_info_as_df'] = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    e2g.save_loc_to_csv(output_file)
+    timings['save_loc_to_csv'] = time.perf_counter() - t0
+    return {'stages': timings, 'total': sum(timings.values()), 'matches': len(e2g.loc_df)}
+
+
+def get_meta() -> dict:
+    """ Information about the environment, so results are only compared like with like. """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        commit = None
+    return {'scie2g': scie2g.__version__, 'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'date': datetime.datetime.now().isoformat(timespec='seconds')}
+
+
+def case_key(result: dict) -> tuple:
+    return (result['annotation_rows'], result['transcripts'], result['input_type'], result['input_rows'],
+            result['sorted'], result['overlap_method'])
+
+
+def compare(results: list, previous_file: str) -> None:
+    """ Prints the ratio of each stage time to the same case in a previous run (< 1 is faster). """
+    with open(previous_file) as f:
+        previous = {case_key(r): r for r in json.load(f)['results']}
+    print(f'Comparison with {previous_file} (new / old, < 1 is faster)')
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is None:
+            continue
+        ratios = [f'{s}={result["stages"][s] / old["stages"][s]:.2f}' for s in result['stages']
+                  if old['stages'].get(s)]
+        print(case_key(result), f'total={result["total"] / old["total"]:.2f}', ' '.join(ratios))
+
+
+def gen_parser():
+    parser = argparse.ArgumentParser(description='scie2g benchmarks')
+    parser.add_argument('--preset', type=str, default='small', help=f'One of {list(PRESETS.keys())}')
+    parser.add_argument('--types', type=str, default=','.join(INPUT_TYPES), help='Comma separated input types')
+    parser.add_argument('--m', type=str, default='in_promoter', help='Overlap method')
+    parser.add_argument('--repeat', type=int, default=1, help='Repeats per case (the fastest time is kept)')
+    parser.add_argument('--workdir', type=str, default='bench_data', help='Where generated data is stored')
+    parser.add_argument('--skip', type=str, default='', help='Comma separated stages to skip e.g. '
+                                                             'get_gene_info_as_df')
+    parser.add_argument('--o', type=str, default='bench_results.json', help='JSON file for the results')
+    parser.add_argument('--compare', type=str, default=None, help='Previous JSON results to compare to')
+    return parser
+
+
+def main(args=None):
+    args = gen_parser().parse_args(args)
+    os.makedirs(args.workdir, exist_ok=True)
+    stages = [s for s in STAGES if s not in args.skip.split(',')]
+    results = []
+    for annotation_rows, transcripts, input_rows, is_sorted in PRESETS[args.preset]:
+        for input_type in args.types.split(','):
+            annotation, input_file = get_data(args.workdir, annotation_rows, transcripts, input_type, input_rows,
+                                              is_sorted)
+            output_file = os.path.join(args.workdir, 'output.csv')
+            runs = [run_case(annotation, input_file, input_type, args.m, output_file, stages)
+                    for _ in range(args.repeat)]
+            best = min(runs, key=lambda r: r['total'])
+            result = {'annotation_rows': annotation_rows, 'transcripts': transcripts, 'input_type': input_type,
+                      'input_rows': input_rows, 'sorted': is_sorted, 'overlap_method': args.m}
+            result.update(best)
+            results.append(result)
+            print(json.dumps(result), file=sys.stderr)
+    with open(args.o, 'w') as f:
+        json.dump({'meta': get_meta(), 'results': results}, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,7 @@ __license__ = 'GPL3'
 from scie2g.base import Epi2Gene, Epi2GeneException
 from scie2g.bed import Bed
 from scie2g.csv import Csv
+from scie2g.coverage import Coverage
 
 from scie2g import errors
 from scie2g.__main__ import gen_parser
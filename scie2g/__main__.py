@@ -16,59 +16,169 @@
 ###############################################################################
 
 import argparse
+import json
 import os
 import sys
 
+import pandas as pd
+
 from sciutil import SciUtil
 
 from scie2g import __version__
-from scie2g import Bed, Csv
+from scie2g import Bed, Coverage, Csv, Epi2Gene
+from scie2g.dataset import PartitionedDataset
+from scie2g.gtf import is_gtf
 
 
 def print_help():
-    lines = ['-h Print help information.']
+    lines = ['-h Print help information.',
+             'serve Run a server that assigns regions to genes (see scie2g serve -h).']
     print('\n'.join(lines))
 
 
 def run(args):
+    if os.path.isdir(args.l2g):
+        run_dataset(args)
+        return
     if args.t == 'd':
         if not args.value:
             u = SciUtil()
             u.warn_p(['WARNING: You did not pass a column name for the value! Please use --value for the column '
                       'you would like to use as your value in your output file.\n Returning ...'])
             return
-        c = Csv(args.l2g, chr_str=args.chr, start=args.start, end=args.end, value=args.value, header_extra=args.hdr,
-                overlap_method=args.m, buffer_after_tss=args.downflank,
-                buffer_before_tss=args.upflank, buffer_gene_overlap=args.overlap,
-                gene_start=args.gstart, gene_end=args.gend, gene_chr=args.gchr,
-                gene_direction=args.gdir, gene_name=args.gname
-                )
-        c.set_annotation_from_file(args.a)
-        c.assign_locations_to_genes()  # Now we can run the assign values
-        c.save_loc_to_csv(args.o)
-        if args.b:
-            c.convert_to_bed(c.loc_df, args.b, args.b)
+        header_extra = [h.strip() for h in args.hdr.split(',')] if args.hdr else None
+        e2g = Csv(args.l2g, chr_str=args.chr, start=args.start, end=args.end, value=args.value,
+                  header_extra=header_extra, overlap_method=args.m, buffer_after_tss=args.downflank,
+                  buffer_before_tss=args.upflank, buffer_gene_overlap=args.overlap,
+                  gene_start=args.gstart, gene_end=args.gend, gene_chr=args.gchr,
+                  gene_direction=args.gdir, gene_name=args.gname, sort_memory=args.sortmem * 1024 * 1024,
+                  max_memory=args.maxmem, cache_dir=args.cache, cache_size=args.cachesize,
+                  compact_annotation=get_compact_columns(args)
+                  )
     elif args.t == 'b':
-        bed = Bed(args.l2g, overlap_method=args.m, buffer_after_tss=args.downflank,
+        e2g = Bed(args.l2g, overlap_method=args.m, buffer_after_tss=args.downflank,
                   buffer_before_tss=args.upflank, buffer_gene_overlap=args.overlap,
                   gene_start=args.gstart, gene_end=args.gend, gene_chr=args.gchr,
                   gene_direction=args.gdir, gene_name=args.gname, chr_idx=args.chridx, start_idx=args.startidx,
-                  end_idx=args.endidx, peak_value=args.valueidx, header_extra=args.hdridx
+                  end_idx=args.endidx, peak_value=args.valueidx, header_extra=args.hdridx,
+                  sort_memory=args.sortmem * 1024 * 1024, max_memory=args.maxmem,
+                  cache_dir=args.cache, cache_size=args.cachesize, compact_annotation=get_compact_columns(args)
                   )
-        # Add the gene annot
-        bed.set_annotation_from_file(args.a)
+    elif args.t == 'c':
+        if args.grid or args.rollup or args.prev:
+            SciUtil().warn_p(['WARNING: --grid, --rollup and --prev can not be used with a coverage track (--t c), '
+                              'the output is the signal in each gene window.\n Returning ...'])
+            return
+        e2g = Coverage(args.l2g, overlap_method=args.m, buffer_after_tss=args.downflank,
+                       buffer_before_tss=args.upflank, buffer_gene_overlap=args.overlap,
+                       gene_start=args.gstart, gene_end=args.gend, gene_chr=args.gchr,
+                       gene_direction=args.gdir, gene_name=args.gname, compact_annotation=get_compact_columns(args))
+    else:
+        return
+    if args.profile:
+        e2g.stats.enable()
+    # Add the gene annot
+    if is_gtf(args.a):
+        e2g.set_annotation_from_gtf(args.a, feature_types=args.features.split(',') if args.features else None)
+    else:
+        e2g.set_annotation_from_file(args.a)
+    if args.grid:
+        run_grid(e2g, args)
+    elif args.rollup:
+        # Transcript level annotation, assign each location to each gene once
+        e2g.u.save_df(e2g.assign_locations_to_genes_grid([{}], rollup_column=args.rollup).drop(columns='setting_id'),
+                      args.o)
+    elif args.prev:
+        # Only recompute the genes that changed since the annotation the previous output was made with
+        e2g.u.save_df(e2g.reannotate(pd.read_csv(args.prev), pd.read_csv(args.preva), id_column=args.gid), args.o)
+    else:
         # Now we can run the assign values
-        bed.assign_locations_to_genes()
-        bed.save_loc_to_csv(args.o)
+        e2g.assign_locations_to_genes()
+        e2g.save_loc_to_csv(args.o)
+        if args.t == 'd' and args.b:
+            # After a memory budgeted run the output is only on disk
+            loc_df = e2g.loc_df if e2g.loc_df is not None else pd.read_csv(args.o)
+            e2g.convert_to_bed(loc_df, args.b, args.b)
+    if args.profile:
+        save_profile(e2g, args)
+
+
+def run_dataset(args):
+    """ Annotates every partition in the input directory, writing one output per partition in args.o. """
+    e2g = Epi2Gene(overlap_method=args.m, buffer_after_tss=args.downflank, buffer_before_tss=args.upflank,
+                   buffer_gene_overlap=args.overlap, gene_start=args.gstart, gene_end=args.gend, gene_chr=args.gchr,
+                   gene_direction=args.gdir, gene_name=args.gname,
+                   compact_annotation=get_compact_columns(args))
+    if args.profile:
+        e2g.stats.enable()
+    if is_gtf(args.a):
+        e2g.set_annotation_from_gtf(args.a, feature_types=args.features.split(',') if args.features else None)
+    else:
+        e2g.set_annotation_from_file(args.a)
+    if args.t == 'b':
+        dataset = PartitionedDataset(args.l2g, chr_col=args.chridx, start_col=args.startidx, end_col=args.endidx)
+    else:
+        dataset = PartitionedDataset(args.l2g, chr_col=args.chr, start_col=args.start, end_col=args.end)
+    dataset.annotate(e2g, args.o, workers=args.workers)
+    if args.profile:
+        save_profile(e2g, args)
+
+
+def get_compact_columns(args):
+    """ With --compact, the extra annotation columns to keep (the --rollup and --gid columns if used). """
+    if not args.compact:
+        return False
+    return [c for c in [args.rollup, args.gid if args.prev else None] if c]
+
+
+def save_profile(e2g, args):
+    """ Saves the stage timings and counters of the run (see stats.py) along with the settings used. """
+    info = {'version': __version__, 'input': args.l2g, 'annotation': args.a, 'output': args.o,
+            'file_type': args.t, 'grid': args.grid, 'overlap_method': args.m, 'buffer_before_tss': args.upflank,
+            'buffer_after_tss': args.downflank, 'buffer_gene_overlap': args.overlap,
+            'num_genes': e2g.num_genes, 'memory_bytes': e2g.memory_usage()}
+    e2g.stats.save(args.profile, info)
+    e2g.u.dp(['Profile saved to: ', args.profile, '\n', e2g.stats])
+
+
+# Short names from the command line that can be used in a grid file
+GRID_ALIASES = {'m': 'overlap_method', 'upflank': 'buffer_before_tss', 'downflank': 'buffer_after_tss',
+                'overlap': 'buffer_gene_overlap'}
+
+
+def read_grid(grid_file: str) -> list:
+    """ Reads a list of parameter sets from a JSON (list of objects) or CSV (one setting per row) file. """
+    if grid_file.endswith('.json'):
+        with open(grid_file) as f:
+            param_sets = json.load(f)
+    else:
+        param_sets = pd.read_csv(grid_file).to_dict('records')
+    return [{GRID_ALIASES.get(k, k): v for k, v in p.items()} for p in param_sets]
+
+
+def run_grid(e2g, args):
+    """ Runs every setting in the grid file in a single pass and saves the results. """
+    param_sets = read_grid(args.grid)
+    settings_df = pd.DataFrame(e2g.get_sweep_settings(param_sets))
+    settings_df.index.name = 'setting_id'
+    output_stem = args.o[:-4] if args.o.endswith('.csv') else args.o
+    settings_df.to_csv(f'{output_stem}_settings.csv')
+    if args.gridsplit:
+        results = e2g.assign_locations_to_genes_grid(param_sets, long_format=False, rollup_column=args.rollup)
+        for setting_id, df in results.items():
+            e2g.u.save_df(df, f'{output_stem}_setting{setting_id}.csv')
+    else:
+        e2g.u.save_df(e2g.assign_locations_to_genes_grid(param_sets, rollup_column=args.rollup), args.o)
 
 
 def gen_parser():
     parser = argparse.ArgumentParser(description='scie2g')
-    parser.add_argument('--a', type=str, help='Annotation with the gene locations')
+    parser.add_argument('--a', type=str, help='Annotation with the gene locations (csv, or a GTF/GFF3 file)')
     parser.add_argument('--o', type=str, default='l2g_outputfile.csv', help='Output file (csv)')
     parser.add_argument('--b', type=str, default='l2g_outputfile.bed', help='Output file (bed)')
-    parser.add_argument('--l2g', type=str, help='Input file to run scie2g on')
-    parser.add_argument('--t', type=str, default='b', help='The input file type: d=CSV, b=Bed')
+    parser.add_argument('--l2g', type=str, help='Input file to run scie2g on, or a directory of partitions')
+    parser.add_argument('--t', type=str, default='b', help='The input file type: d=CSV, b=Bed, c=coverage track '
+                                                           '(bedGraph, gives the signal in each gene window)')
     parser.add_argument('--upflank', type=int, default=2500, help='Maximum distance upstream from TSS'
                                                                   ' (default = 2500) for overlaps and in_promoter')
     parser.add_argument('--downflank', type=int, default=500, help='Maximum distance downstream from gene end '
@@ -100,6 +210,42 @@ def gen_parser():
     parser.add_argument('--gdir', type=int, default=5, help='Position in annotation file that your gene direction is.')
     parser.add_argument('--gname', type=int, default=0, help='Position in annotation file that gene name is.')
 
+    parser.add_argument('--sortmem', type=int, default=512, help='Memory (MB) used when sorting an unsorted input '
+                                                                 'file, larger files are sorted on disk.')
+    parser.add_argument('--maxmem', '--max-memory', type=str, default=None,
+                        help='Memory budget for the run e.g. 8G. Locations are processed in chunks sized from this '
+                             'and matches are spilled to disk, so large inputs run in a predictable footprint.')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Directory to cache results in. Reruns with the same input, annotation and settings '
+                             'load the matches from the cache instead of assigning again.')
+    parser.add_argument('--cachesize', '--cache-size', type=str, default='1G',
+                        help='Size of the --cache directory e.g. 1G, the least recently used results are removed '
+                             'once it is larger.')
+    parser.add_argument('--grid', type=str, default=None, help='JSON or CSV file with a list of parameter settings '
+                                                               '(m, upflank, downflank, overlap) to run in a single '
+                                                               'pass. Output has a setting_id column.')
+    parser.add_argument('--gridsplit', action='store_true', help='With --grid, save one output file per setting.')
+    parser.add_argument('--features', type=str, default=None,
+                        help='With a GTF/GFF3 annotation, comma separated feature types to use (default gene).')
+    parser.add_argument('--rollup', type=str, default=None,
+                        help='For annotations with a row per transcript (e.g. a GTF with --features transcript), the '
+                             'annotation column with the gene id. Locations are assigned to each gene once using '
+                             'the transcript with the closest TSS.')
+    parser.add_argument('--prev', type=str, default=None, help='Previous output (csv) to update to the annotation '
+                                                               'in --a, only genes that changed are recomputed.')
+    parser.add_argument('--preva', type=str, default=None, help='With --prev, the annotation the previous output '
+                                                                'was made with.')
+    parser.add_argument('--gid', type=str, default='ensembl_gene_id', help='With --prev, the annotation column used '
+                                                                          'to match genes between annotations.')
+    parser.add_argument('--workers', type=int, default=1, help='When the input is a directory of partitions (e.g. one '
+                                                               'file per chromosome), the number annotated at once. '
+                                                               'Outputs are saved in the directory --o.')
+    parser.add_argument('--compact', action='store_true', help='Only keep the annotation columns used for the run, '
+                                                               'with small dtypes, to reduce the memory used by '
+                                                               'large annotations.')
+    parser.add_argument('--profile', type=str, default=None, help='JSON file to save the time taken by each stage '
+                                                                  'and counters (locations, genes tested, matches).')
+
     return parser
 
 
@@ -114,6 +260,11 @@ def main(args=None):
     elif sys.argv[1] in {'-v', '--v', '-version', '--version'}:
         print(f'scie2g v{__version__}')
         sys.exit(0)
+    elif sys.argv[1] == 'serve':
+        # Only the server needs the http modules
+        from scie2g import server
+        print(f'scie2g v{__version__}')
+        sys.exit(server.main(sys.argv[2:]))
     else:
         print(f'scie2g v{__version__}')
         args = parser.parse_args(args)
@@ -121,12 +272,16 @@ def main(args=None):
         if not os.path.isfile(args.a):
             u.err_p([f'The annotation file could not be located, file passed: {args.a}'])
             sys.exit(1)
-        if not os.path.isfile(args.l2g):
-            u.err_p([f'The input file could not be located, file passed: {args.l2g}'])
+        if not os.path.isfile(args.l2g) and not os.path.isdir(args.l2g):
+            u.err_p([f'The input file (or dataset directory) could not be located, file passed: {args.l2g}'])
+            sys.exit(1)
+        if args.prev and not (os.path.isfile(args.prev) and args.preva and os.path.isfile(args.preva)):
+            u.err_p([f'--prev needs the previous output and its annotation (--preva), files passed: {args.prev}, '
+                     f'{args.preva}'])
             sys.exit(1)
-        if args.t != 'b' and args.t != 'd':
+        if args.t not in ['b', 'd', 'c']:
             u.err_p([f'The file type passed is not supported: {args.t}, '
-                     f'filetype must be "b" for bed or "d" for dmrseq.'])
+                     f'filetype must be "b" for bed, "d" for dmrseq or "c" for a coverage track (bedGraph).'])
             sys.exit(1)
         # Otherwise we have need successful so we can run the program
         u.dp(['Running scie2g on input file: ', args.l2g,
@@ -136,7 +291,9 @@ def main(args=None):
               '\nUpstream flank: ', args.upflank,
               '\nDownstream flank:', args.downflank,
               '\nGene overlap: ', args.overlap])
-        u.warn_p(['Assuming your annotation file and your input file are SORTED!'])
+        u.dp(['Unsorted annotation and input files are sorted automatically (sort memory: ', args.sortmem, 'MB)'])
+        if args.maxmem:
+            u.dp(['Running within a memory budget of: ', args.maxmem])
         # RUN!
         run(args)
     # Done - no errors.
@@ -0,0 +1,209 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+"""
+Annotation and gene indexes that are shared between runs and threads. An Annotator is made once from an Epi2Gene
+object with an annotation, it keeps a read only copy of the annotation, the overlap settings and the gene indexes.
+Each batch of locations is annotated in its own AnnotationRun, which holds the results of that run only, so many
+threads (e.g. requests to a server, or partitions of a dataset) can annotate different inputs at the same time.
+
+    annotator = Annotator(e2g)
+    run = annotator.run(loc_df, 'chr', 'start', 'end')
+    run.get_loc_df().to_csv('output.csv', index=False)
+"""
+
+import threading
+from collections import defaultdict
+from typing import Tuple
+import numpy as np
+import pandas as pd
+
+from scie2g.base import SWEEP_PARAMS, Epi2Gene, Epi2GeneException, build_gene_index, errors, fill_setting, \
+    join_gene_info, pairs_to_offsets, query_gene_index
+from scie2g.index import parse_strands
+from scie2g.memory import get_nbytes
+
+
+def read_only(values: np.ndarray) -> np.ndarray:
+    """ Copy of an array that can't be written to. """
+    values = np.array(values)
+    values.setflags(write=False)
+    return values
+
+
+class Annotator:
+
+    """
+    Read only annotation (gene table, chromosome codes and ranges, gene windows) with the overlap settings and the
+    gene interval index of each setting. Nothing changes after it is made other than the cache of indexes, which is
+    only written under a lock, so instances can be shared between threads.
+    """
+
+    def __init__(self, e2g: Epi2Gene):
+        if len(e2g.gene_annot_df) < 1:
+            msg = errors.get('GENE_ANNOT_ERR')
+            e2g.u.err_p([msg])
+            raise Epi2GeneException(msg)
+        self.gene_annot_df = e2g.gene_annot_df.copy()
+        self.column_order = list(e2g.column_order)
+        # Column with the gene names (default output column)
+        self.name_column = self.column_order[e2g.gene_name]
+        self.settings, self.u = {p: getattr(e2g, p) for p in SWEEP_PARAMS}, e2g.u
+        self.direction_aware, self.chromosomes = e2g.direction_aware, e2g.chromosomes
+        _, gene_starts, gene_ends, gene_directions = e2g.get_gene_arrays()
+        self.gene_starts, self.gene_ends = read_only(gene_starts), read_only(gene_ends)
+        self.gene_directions, self.gene_chr_codes = read_only(gene_directions), read_only(e2g.gene_chr_codes)
+        self.chr_gene_ranges = dict(e2g.chr_gene_ranges)
+        self.num_genes = len(self.gene_starts)
+        self.gene_indexes, self.lock = {}, threading.Lock()
+        # Build the index for the default settings now rather than in the first run
+        self.get_gene_index()
+
+    @classmethod
+    def from_file(cls, gene_annotation_file: str, **settings):
+        """
+        Annotator for an annotation file (scibiomart csv), settings are any Epi2Gene arguments e.g. overlap_method,
+        buffer_before_tss or direction_aware.
+        """
+        e2g = Epi2Gene(None, None, **settings)
+        e2g.set_annotation_from_file(gene_annotation_file)
+        return cls(e2g)
+
+    def get_setting(self, setting=None) -> dict:
+        """ Overlap settings of a run: setting with any missing keys (see SWEEP_PARAMS) from this annotator. """
+        return fill_setting(setting, self.settings, self.u, "get_setting")
+
+    def get_gene_index(self, setting=None):
+        """ Gene interval index for a setting (strand partitioned if direction_aware), built once. """
+        setting = self.get_setting(setting)
+        key = tuple(setting[p] for p in SWEEP_PARAMS)
+        index = self.gene_indexes.get(key)
+        if index is not None:
+            return index
+        with self.lock:
+            # Another thread may have built it while we waited
+            index = self.gene_indexes.get(key)
+            if index is None:
+                index = build_gene_index(self.gene_chr_codes, self.gene_starts, self.gene_ends, self.gene_directions,
+                                         setting, self.direction_aware)
+                self.gene_indexes[key] = index
+        return index
+
+    def query_pairs(self, chrs, starts, ends, strands=None, setting=None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Location/gene pairs (sorted by location then gene) for a batch of regions, see Epi2Gene.query for the
+        arguments. Strands are only used if direction_aware, regions without a strand get genes on either strand.
+        """
+        strands = parse_strands(strands) if self.direction_aware and strands is not None else None
+        return query_gene_index(self.get_gene_index(setting), self.chromosomes.codes(chrs),
+                                np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64), strands)
+
+    def query(self, chrs, starts, ends, strands=None, setting=None) -> Tuple[np.ndarray, np.ndarray]:
+        """ Same as query_pairs as CSR arrays: the genes of region i are gene_idx[offsets[i]: offsets[i + 1]]. """
+        loc_idx, gene_idx = self.query_pairs(chrs, starts, ends, strands, setting)
+        return pairs_to_offsets(loc_idx, len(starts)), gene_idx
+
+    def gene_values(self, column: str, gene_idx: np.ndarray) -> np.ndarray:
+        """ Values of an annotation column for genes. """
+        if column not in self.gene_annot_df.columns:
+            raise Epi2GeneException(f'gene_values: column not in the annotation: {column}')
+        return self.gene_annot_df[column].values[gene_idx]
+
+    def memory_usage(self) -> dict:
+        """ Approximate memory (bytes) held by the annotation, gene arrays and gene indexes, and the total. """
+        usage = {'gene_annot_df': get_nbytes(self.gene_annot_df),
+                 'gene_arrays': get_nbytes([self.gene_starts, self.gene_ends, self.gene_directions,
+                                            self.gene_chr_codes]),
+                 'gene_indexes': get_nbytes(list(self.gene_indexes.values()))}
+        usage['total'] = sum(usage.values())
+        return usage
+
+    def run(self, loc_df: pd.DataFrame, chr_col='chr', start_col='start', end_col='end', strand_col=None,
+            setting=None):
+        """
+        Annotates a table of locations.
+
+        Parameters
+        ----------
+        loc_df:         DataFrame: the locations (not changed)
+        chr_col:        column with the chromosome of each location
+        start_col:      column with the start of each location
+        end_col:        column with the end of each location
+        strand_col:     column with the strand of each location (only used if direction_aware)
+        setting:        dict: overlap settings to use instead of the ones on this annotator (keys in SWEEP_PARAMS)
+
+        Returns
+        -------
+        AnnotationRun
+        """
+        loc_idx, gene_idx = self.query_pairs(loc_df[chr_col].values, loc_df[start_col].values,
+                                             loc_df[end_col].values,
+                                             loc_df[strand_col].values if strand_col is not None else None, setting)
+        return AnnotationRun(self, loc_df, loc_idx, gene_idx, self.get_setting(setting))
+
+
+class AnnotationRun:
+
+    """
+    The results of annotating one table of locations: the (location, gene) index pairs, in location order. Outputs
+    are built from the pairs when asked for, nothing is shared with other runs.
+    """
+
+    def __init__(self, annotator: Annotator, loc_df: pd.DataFrame, loc_idx: np.ndarray, gene_idx: np.ndarray,
+                 setting: dict):
+        self.annotator, self.loc_df, self.setting = annotator, loc_df, setting
+        self.loc_idx, self.gene_idx = loc_idx, gene_idx
+
+    def get_loc_df(self, gene_info_columns=None, keep_unassigned=False) -> pd.DataFrame:
+        """
+        One row per location/gene pair with the gene_idx and the gene columns (same as
+        Epi2Gene.assign_gene_info_to_loc_df). Locations without a gene are added (with empty gene columns) if
+        keep_unassigned.
+        """
+        gene_info_columns = gene_info_columns or self.annotator.column_order
+        missing = [c for c in gene_info_columns if c not in self.annotator.gene_annot_df.columns]
+        if missing:
+            raise Epi2GeneException(f'get_loc_df: columns not in the annotation: {missing}')
+        new_df = join_gene_info(self.loc_df, self.loc_idx, self.gene_idx, self.annotator.gene_annot_df,
+                                gene_info_columns)
+        if keep_unassigned:
+            unassigned = np.setdiff1d(np.arange(len(self.loc_df)), self.loc_idx)
+            new_df = pd.concat([new_df, self.loc_df.iloc[unassigned].reset_index(drop=True)])
+            order = np.concatenate([self.loc_idx, unassigned])
+            new_df = new_df.iloc[np.argsort(order, kind='stable')].reset_index(drop=True)
+        return new_df
+
+    def get_location_to_genes(self) -> dict:
+        """ Gene indexes of each location that was assigned a gene. """
+        location_to_genes = defaultdict(list)
+        for loc, gene in zip(self.loc_idx.tolist(), self.gene_idx.tolist()):
+            location_to_genes[loc].append(gene)
+        return location_to_genes
+
+    def get_gene_to_locations(self) -> dict:
+        """ Location indexes of each gene that was assigned a location. """
+        gene_to_locations = defaultdict(list)
+        for loc, gene in zip(self.loc_idx.tolist(), self.gene_idx.tolist()):
+            gene_to_locations[gene].append(loc)
+        return gene_to_locations
+
+    def save(self, filename: str, gene_info_columns=None, keep_unassigned=False) -> None:
+        """ Saves get_loc_df to a csv. """
+        self.get_loc_df(gene_info_columns, keep_unassigned).to_csv(filename, index=False)
+
+    def __len__(self):
+        return len(self.loc_idx)
@@ -14,6 +14,13 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
 #                                                                             #
 ###############################################################################
+import gzip
+import io
+import os
+from collections import defaultdict
+import tempfile
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 from typing import Tuple
@@ -22,24 +29,111 @@ from tqdm import tqdm
 from sciutil import SciUtil, SciException
 from scibiomart import SciBiomartApi
 
+from scie2g.index import IntervalIndex, StrandedIndex, gene_windows, parse_strands
+from scie2g.chromosomes import CHROMOSOMES
+from scie2g.sorting import get_sort_order, is_sorted, sort_file
+from scie2g.stats import Stats, timed
+from scie2g.gtf import read_gtf
+from scie2g.cache import ResultCache, hash_df, hash_file
+from scie2g.memory import MIN_CHUNK_ROWS, PAIR_DTYPE, PairSpill, get_chunk_rows, get_nbytes, parse_memory
+from scie2g.pipeline import PIPELINE_DEPTH, BackgroundWriter, prefetch
+
 # Errors
 errors = {'GENE_ANNOT_ERR': 'Err: assign_locations_to_genes, You have not initialised a gene information object yet.'
                             '\nSee set_annotation_from_file if you already have an annotation file or '
                             'set_annotation_using_biomart to make a new one (uses biomart).\nDetails to '
                             ' make an annotation file can be found in the package scibiomart.'}
 
+# Parameters that can be varied in a sweep (see assign_locations_to_genes_grid)
+SWEEP_PARAMS = ['overlap_method', 'buffer_before_tss', 'buffer_after_tss', 'buffer_gene_overlap']
+
+# Bytes buffered when writing output files (see open_output)
+BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def open_output(filename: str):
+    """ Buffered binary file for writing, gzipped if the filename ends with .gz """
+    if filename.endswith('.gz'):
+        return io.BufferedWriter(gzip.open(filename, 'wb'), buffer_size=BLOCK_SIZE)
+    return open(filename, 'wb', buffering=BLOCK_SIZE)
+
+
+def read_bed_annotation(bed_file: str) -> pd.DataFrame:
+    """ Reads a bed file (no header, lines starting with # are skipped). """
+    return pd.read_csv(bed_file, sep='\t', header=None, comment='#', dtype={0: str})
+
 
 class Epi2GeneException(SciException):
     def __init__(self, message=''):
         Exception.__init__(self, message)
 
 
+def fill_setting(setting: dict, defaults: dict, u: SciUtil, caller: str) -> dict:
+    """
+    Overlap settings with every key in SWEEP_PARAMS: the values in setting, anything not set taken from defaults.
+    Unknown keys and overlap methods raise an Epi2GeneException (reported by u as coming from caller).
+    """
+    filled = {p: defaults[p] for p in SWEEP_PARAMS}
+    for p, value in (setting or {}).items():
+        if p not in SWEEP_PARAMS:
+            msg = u.msg.msg_arg_err(caller, "param_sets", p, SWEEP_PARAMS)
+            u.err_p([msg])
+            raise Epi2GeneException(msg)
+        filled[p] = value
+    if filled['overlap_method'] not in ['in_promoter', 'overlaps']:
+        msg = u.msg.msg_arg_err(caller, "overlap_method", filled['overlap_method'], ['in_promoter', 'overlaps'])
+        u.err_p([msg])
+        raise Epi2GeneException(msg)
+    return {p: v if p == 'overlap_method' else int(v) for p, v in filled.items()}
+
+
+def build_gene_index(gene_chr_codes: np.ndarray, gene_starts: np.ndarray, gene_ends: np.ndarray,
+                     gene_directions: np.ndarray, setting: dict, stranded=False):
+    """ Interval index of the gene windows for a setting (see gene_windows), one per strand if stranded. """
+    lo, hi = gene_windows(gene_starts, gene_ends, gene_directions, setting['overlap_method'],
+                          setting['buffer_before_tss'], setting['buffer_after_tss'], setting['buffer_gene_overlap'])
+    if stranded:
+        return StrandedIndex(gene_chr_codes, lo, hi, gene_directions)
+    return IntervalIndex(gene_chr_codes, lo, hi)
+
+
+def query_gene_index(index, loc_codes: np.ndarray, loc_starts: np.ndarray, loc_ends: np.ndarray, loc_strands=None,
+                     stats=None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Location/gene pairs (sorted by location then gene) from a gene index. A StrandedIndex gives stranded locations
+    genes on their own strand and unstranded ones (NaN, or no loc_strands) genes on either strand.
+    """
+    if not isinstance(index, StrandedIndex):
+        return index.query(loc_codes, loc_starts, loc_ends, stats)
+    loc_strands = loc_strands if loc_strands is not None else np.full(len(loc_starts), np.nan)
+    return index.query(loc_codes, loc_starts, loc_ends, loc_strands, stats)
+
+
+def pairs_to_offsets(loc_idx: np.ndarray, num_regions: int) -> np.ndarray:
+    """ CSR offsets of pairs sorted by location: the pairs of region i are offsets[i]: offsets[i + 1]. """
+    offsets = np.zeros(num_regions + 1, dtype=np.int64)
+    np.cumsum(np.bincount(loc_idx, minlength=num_regions), out=offsets[1:])
+    return offsets
+
+
+def join_gene_info(loc_df: pd.DataFrame, loc_idx: np.ndarray, gene_idx: np.ndarray, gene_annot_df: pd.DataFrame,
+                   gene_info_columns: list) -> pd.DataFrame:
+    """ One row of loc_df per location/gene pair with the gene_idx and the gene_info_columns of the annotation. """
+    new_df = loc_df.iloc[loc_idx].reset_index(drop=True)
+    new_df['gene_idx'] = gene_idx
+    for c in gene_info_columns:
+        new_df[c] = gene_annot_df[c].values[gene_idx]
+    return new_df
+
+
 class Epi2Gene:
 
-    def __init__(self, filename: str, header: list, overlap_method='in_promoter', buffer_after_tss=500,
+    def __init__(self, filename=None, header=None, overlap_method='in_promoter', buffer_after_tss=500,
                  buffer_before_tss=2500,
                  buffer_gene_overlap=500, gene_column_order=None, gene_id_type=None, output_dir='.', sciutil=None,
-                 hdr_gene_idx=4, direction_aware=False):
+                 hdr_gene_idx=4, direction_aware=False, gene_start=None, gene_end=None, gene_chr=None,
+                 gene_direction=None, gene_name=None, sort_memory=512 * 1024 * 1024, max_memory=None,
+                 cache_dir=None, cache_size='1G', compact_annotation=False):
 
         self.u = SciUtil() if sciutil is None else sciutil
         # Settings for choosing the overlap
@@ -50,7 +144,6 @@ class Epi2Gene:
         self.gene_direction, self.gene_name, self.gene_id_type = 4, 1, gene_id_type
         self.output_dir, self.filename = output_dir, filename
         self.location_to_gene_dict, self.gene_to_location_dict, self.df = None, None, None
-        self.cur_gene_idx, self.cur_loc_idx, self.cur_loc_start, self.cur_loc_end, self.cur_chr = 0, 0, 0, 0, None
         self.rows_with_genes, self.header, self.loc_df = [], header, None
         self.hdr_gene_idx, self.biomart, self.gene_info_df = hdr_gene_idx, None, None
         self.gene_annot_df, self.gene_annot_values = pd.DataFrame(), []
@@ -58,113 +151,308 @@ class Epi2Gene:
                                                                          'start_position', 'end_position', 'strand']
         self.num_genes = 0
         self.direction_aware = direction_aware
-
+        # Canonical integer code of each gene's chromosome, and the range of gene indexes on each chromosome
+        self.chromosomes, self.gene_chr_codes, self.chr_gene_ranges = CHROMOSOMES, np.zeros(0, dtype=np.int64), {}
+        # Optional positions of the columns in the annotation file (used by the CLI), if these are set we keep every
+        # column from the annotation file.
+        self.annot_column_idxs = [gene_chr, gene_name, gene_start, gene_end, gene_direction]
+        # Memory budget (bytes) when sorting an unsorted input, larger inputs are sorted on disk
+        self.sort_memory = sort_memory
+        # Optional memory budget (bytes or e.g. '8G') for the whole run. When set, locations are streamed through the
+        # interval index in chunks and the (location, gene) pairs are spilled to disk (see memory.py)
+        self.max_memory = parse_memory(max_memory)
+        if self.max_memory is not None:
+            self.sort_memory = min(self.sort_memory, self.max_memory // 2)
+        self.pair_spill, self.chunk_rows = None, None
+        # Gene interval index for each overlap setting used so far (see get_gene_index), reset with the annotation
+        self.gene_indexes = {}
+        # Interval index over the locations themselves and the locations it was built from (see locations_for_genes)
+        self.location_index, self.locations = None, None
+        # Names of the chr, start and end columns in the table returned by read_locations
+        self.loc_chr_col, self.loc_start_col, self.loc_end_col = None, None, None
+        # Stage timers and counters, disabled by default (see stats.py), use self.stats.enable() to record a run
+        self.stats = Stats()
+        # Optional cache of assignment results, reruns on the same input, annotation and settings load the pairs from
+        # here (see cache.py). Not used for memory budgeted runs.
+        self.cache = ResultCache(cache_dir, cache_size) if cache_dir else None
+        # Only keep the annotation columns we need, with small dtypes, and don't hold the object array of gene values
+        # between runs (see compact_annotation_df). A list also keeps these columns (e.g. a rollup column).
+        self.compact_annotation = compact_annotation
+
+    @timed('assign_locations_to_genes')
     def assign_locations_to_genes(self):
-        """ Wrapper for the main _assign values method, here we just perform some generic tests & setups """
+        """
+        Wrapper for the main _assign values method, here we just perform some generic tests & setups. Every location
+        is assigned to every gene whose window it overlaps (including genes nested in longer genes, which the
+        previous gene by gene walk could miss), with or without max_memory.
+        """
         if len(self.gene_annot_df) < 1:
             self.u.err_p([errors.get('GENE_ANNOT_ERR')])
             return
-        self.loc_idxs_np = np.full(len(self.gene_annot_df), -1)
-        # Run assignment
+        self.reset_run_state()
+        if self.max_memory is not None:
+            self._assign_values_chunked()
+            return
+        cache_key = self.get_cache_key() if self.cache is not None else None
+        if cache_key is not None:
+            pairs = self.cache.get(cache_key)
+            if pairs is not None:
+                self.stats.add('cache_hits', 1)
+                self.set_assignment_pairs(pairs['loc_idx'], pairs['gene_idx'])
+                if self.stats.enabled:
+                    self.update_assign_stats()
+                return
+            self.stats.add('cache_misses', 1)
+        self._assign_values_and_stats()
+        if cache_key is not None:
+            self.cache.put(cache_key, *self.get_assignment_pairs())
+
+    def reset_run_state(self) -> None:
+        """
+        Clears everything left by a previous run (assigned rows, cached outputs and spilled pairs) so the same object
+        can be used for another assignment (e.g. with other overlap settings).
+        """
+        self.rows_with_genes, self.loc_df, self.gene_info_df, self.df = [], None, None, None
+        self.location_to_gene_dict, self.gene_to_location_dict = defaultdict(list), defaultdict(list)
+        if self.pair_spill is not None:
+            self.pair_spill.cleanup()
+        self.pair_spill, self.chunk_rows = None, None
+
+    def _assign_values_and_stats(self):
         self._assign_values()
+        if self.stats.enabled:
+            self.update_assign_stats()
+
+    def update_assign_stats(self):
+        """ Counters that can be worked out after a run rather than in the loop. """
+        self.stats.add('matches', len(self.rows_with_genes))
+        fan_outs = [len(genes) for genes in self.location_to_gene_dict.values()]
+        self.stats.add('locations_assigned', len(fan_outs))
+        self.stats.set_max('max_genes_per_location', max(fan_outs, default=0))
+        self.stats.set_max('max_locations_per_gene', max([len(locs) for locs in self.gene_to_location_dict.values()],
+                                                         default=0))
+
+    def get_cache_settings(self) -> dict:
+        """ Every setting (other than the input and annotation) that changes the result of an assignment. """
+        settings = {p: getattr(self, p) for p in SWEEP_PARAMS}
+        # Results of the gene by gene walk (before the interval index) had fewer pairs and are not reused
+        settings.update({'engine': 'interval_index', 'type': type(self).__name__,
+                         'direction_aware': self.direction_aware,
+                         'header': self.header, 'hdr_gene_idx': self.hdr_gene_idx,
+                         'column_order': self.column_order,
+                         'gene_columns': [self.gene_chr, self.gene_start, self.gene_end, self.gene_direction],
+                         # Scaffolds etc. are sorted in the order this process first saw them, and the cached
+                         # location indexes are positions in that order
+                         'other_chromosomes': self.chromosomes.other_names()})
+        return settings
+
+    @timed('cache_key')
+    def get_cache_key(self) -> str:
+        """ Key of this run in the result cache (hashes of the input file and annotation plus the settings). """
+        return self.cache.key(hash_file(self.filename), hash_df(self.gene_annot_df), self.get_cache_settings())
+
+    def get_assignment_pairs(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ Location and gene index of each assignment, in the order they were made. """
+        loc_idx = np.array([r[0] for r in self.rows_with_genes], dtype=np.int64)
+        gene_idx = np.array([r[self.hdr_gene_idx] for r in self.rows_with_genes], dtype=np.int64)
+        return loc_idx, gene_idx
+
+    @timed('set_assignment_pairs')
+    def set_assignment_pairs(self, loc_idx: np.ndarray, gene_idx: np.ndarray, loc_df=None) -> None:
+        """
+        Rebuilds the state of a run (rows_with_genes and the location/gene dictionaries) from the pairs returned by
+        get_assignment_pairs, so every output is the same as if the assignment had been run. loc_df is read if it
+        isn't passed.
+        """
+        loc_df = loc_df if loc_df is not None else self.read_locations()
+        rows_df = loc_df.iloc[loc_idx].reset_index(drop=True)
+        rows_df['gene_idx'] = gene_idx
+        self.rows_with_genes = rows_df[self.header].values.tolist()
+        for loc, gene in zip(loc_idx.tolist(), gene_idx.tolist()):
+            self.location_to_gene_dict[loc].append(gene)
+            self.gene_to_location_dict[gene].append(loc)
+        # Keep the locations we just read for get_gene_info_as_df
+        self.df = loc_df
+        self.stats.add('locations_read', len(loc_df))
 
     def _assign_values(self):
-        self.u.warn_p(['Warn: _assign_values not performed. Please use the correct wrapper for your file type.'
-                       '\nDMRseq, Generic, or Bed.'])
-        return
+        """
+        Assigns each location to every gene whose window (see gene_windows) it overlaps using the gene interval index,
+        the same engine as memory budgeted runs, grids and query. If direction_aware the same windows are looked up
+        in the index of genes on the location's strand (see query_genes), so a stranded run only ever drops pairs of
+        the unstranded run. The locations come from read_locations (see the file type wrappers) and the outputs are
+        built from the pairs (see set_assignment_pairs).
+        """
+        loc_df = self.read_locations()
+        if loc_df is None:
+            return
+        loc_chrs, loc_starts, loc_ends = self.get_location_arrays(loc_df)
+        if len(loc_df) > 0:
+            self.check_chr(loc_chrs[0], str(self.gene_annot_df[self.column_order[self.gene_chr]].values[0]))
+        loc_codes = self.get_chr_codes(loc_chrs)
+        loc_strands = self.get_location_strands(loc_df) if self.direction_aware else None
+        if self.stats.enabled:
+            # Identical locations (e.g. merged replicates) are only searched for once (see IntervalIndex.query)
+            locations = pd.DataFrame({'chr': loc_codes, 'start': loc_starts, 'end': loc_ends})
+            if loc_strands is not None:
+                locations['strand'] = loc_strands
+            self.stats.add('duplicate_locations', int(locations.duplicated().sum()))
+        loc_idx, gene_idx = self.query_genes(loc_codes, loc_starts, loc_ends, loc_strands, stats=self.stats)
+        self.set_assignment_pairs(loc_idx, gene_idx, loc_df)
     """
     -----------------------------------------------------------------
     Generation of gene data.
     -----------------------------------------------------------------
     """
+    @timed('annotation')
     def set_annotation_from_file(self, gene_annotation_file, sep=','):
         # Assume the file is the correct format (i.e. from scibiomart)
         self.gene_annot_df = pd.read_csv(gene_annotation_file, sep=sep)
+        if None not in self.annot_column_idxs:
+            self.column_order = list(self.gene_annot_df.columns)
+            self.gene_chr, self.gene_name, self.gene_start, self.gene_end, self.gene_direction = self.annot_column_idxs
         convert_dict = {'start_position': int,
                         'end_position': int,
                         'chromosome_name': str}
         self.gene_annot_df = self.gene_annot_df.astype(convert_dict)
         # Ensure it is sorted
-        self.biomart = SciBiomartApi()
-        self.gene_annot_df = self.biomart.sort_df_on_starts(self.gene_annot_df)
+        self.gene_annot_df = self.sort_annotation_df(self.gene_annot_df)
         # Gene information is just all the values from our annot df
-        self.gene_annot_values = self.gene_annot_df[self.column_order].values
-        self.num_genes = len(self.gene_annot_values)
+        self.update_gene_annot_values()
 
-    def set_annotation_from_gtf(self, gene_annotation_file):
-        """ Set an annotation from a GTF file. """
-        # Assume the file is the correct format (i.e. from scibiomart)
-        self.gene_annot_df = pd.read_csv(gene_annotation_file, header=None, sep='\t', comment='#')
-        self.gene_annot_df.columns = ['chromosome_name', 'ref', 'label', 'start_position', 'end_position', 'score',
-                                      'direction', 'strand', 'description']
-        convert_dict = {'start_position': int,
-                        'end_position': int,
-                        'chromosome_name': str}
-        self.gene_annot_df = self.gene_annot_df.astype(convert_dict)
-        self.gene_annot_df['external_gene_name'] = [g.split(';')[0] for g in self.gene_annot_df['description'].values]
-        # NC_000913.3 RefSeq  gene    1001807 1002877 .   +   .   ID=gene-b0941;Dbxref=ASAP:ABE-0003191,ECOCYC:G6483,GeneID:947185;Name=elfG;gbkey=Gene;gene=elfG;gene_biotype=protein_coding;gene_synonym=ECK0932,ycbT;locus_tag=b0941
-        # We assume the GFF is already sorted
+    @timed('annotation')
+    def set_annotation_from_gtf(self, gene_annotation_file, feature_types=None, biotypes=None, file_format=None):
+        """
+        Set an annotation from a GTF or GFF3 file (optionally gzipped). The file is streamed and only the features
+        we want are kept (see gtf.py), the annotation is then sorted like every other annotation.
+
+        Parameters
+        ----------
+        gene_annotation_file:   str: path to the GTF/GFF3 file
+        feature_types:          list: features to use as genes (default gene records), e.g. ['transcript']
+        biotypes:               list: only keep these biotypes e.g. ['protein_coding'], None keeps all
+        file_format:            str: gtf or gff3, by default this comes from the file extension
+        """
+        self.gene_annot_df = read_gtf(gene_annotation_file, feature_types, biotypes, file_format)
+        self.gene_annot_df = self.sort_annotation_df(self.gene_annot_df).reset_index(drop=True)
         # Gene information is just all the values from our annot df
-        self.gene_annot_values = self.gene_annot_df[self.column_order].values
-        self.num_genes = len(self.gene_annot_values)
+        self.update_gene_annot_values()
 
-    def set_annotation_from_bed_files(self, bed_files: list, save_file=False, output_filename=None):
+    @timed('annotation')
+    def set_annotation_from_bed_files(self, bed_files: list, save_file=False, output_filename=None, merge=False,
+                                      merge_distance=0, threads=1):
         """
-        Creates an annotation file from multiple bed files. Basically consolidates them to a single bed file then sets
-        that as the annotation file.
+        Creates an annotation file from multiple bed files. The files are read (in parallel if threads > 1),
+        concatenated once and sorted in the canonical chromosome order, then set as the annotation.
 
         Bed files needs to be the full path to the bed file.
-        """
-        if save_file:
-            output_filename = output_filename if output_filename else 'merged_beds.bed'
-        # Otherwise convert each bed file to a pandas dataframe and then sort
-        bed_df = pd.DataFrame()
-        for bed_file in bed_files:
-            bed_tmp = pd.read_csv(bed_file, sep='\t', header=None, comment='#')
-            bed_df = bed_df.append(bed_tmp)
 
+        Parameters
+        ----------
+        bed_files:          list: paths to the bed files
+        save_file:          bool: save the merged annotation (as a bed file) to output_filename
+        output_filename:    str: file to save to (default merged_beds.bed)
+        merge:              bool: merge overlapping intervals on the same chromosome and strand (like bedtools merge -s)
+        merge_distance:     int: with merge, also merge intervals that are at most this far apart (0 merges adjacent
+                            intervals only)
+        threads:            int: number of files to read at once
+        """
+        if threads > 1 and len(bed_files) > 1:
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                bed_dfs = list(pool.map(read_bed_annotation, bed_files))
+        else:
+            bed_dfs = [read_bed_annotation(bed_file) for bed_file in bed_files]
+        bed_df = self.format_bed_annotation(pd.concat(bed_dfs, ignore_index=True))
+        if merge:
+            bed_df = self.merge_annotation_intervals(bed_df, merge_distance)
+        self.gene_annot_df = self.sort_annotation_df(bed_df, direction_col='direction').reset_index(drop=True)
         # Save it if the have selected this option
         if save_file:
-            bed_df.to_csv(output_filename)
-        self.gene_annot_df = bed_df
-        self.gene_annot_df.rename(columns={0: 'chr', 1: 'start_position', 2: 'end_position', 3: 'name',
-                                           5: 'direction', 4: 'strand'}, inplace=True)
-        if len(self.gene_annot_df.columns) < 5:  # might only have start, end
-            self.gene_annot_df['strand'] = '.'
-            self.gene_annot_df['direction'] = 1
-        # Check the direction as well
-        if not isinstance(self.gene_annot_df['direction'].values[0], int):
-            self.gene_annot_df['direction'] = [1 if x == '+' else -1 for x in self.gene_annot_df['direction'].values]
-        # Assume sorted for Bed Files
-        self.gene_annot_df['strand'] = self.gene_annot_df['direction']
+            output_filename = output_filename if output_filename else 'merged_beds.bed'
+            self.gene_annot_df[['chr', 'start_position', 'end_position', 'name', 'score']].assign(
+                strand=np.where(self.gene_annot_df['direction'].values > 0, '+', '-')).to_csv(
+                output_filename, sep='\t', header=False, index=False)
         # Gene information is just all the values from our annot df
-        self.gene_annot_values = self.gene_annot_df[self.column_order].values
-        self.num_genes = len(self.gene_annot_values)
+        self.update_gene_annot_values()
 
+    @timed('annotation')
     def set_annotation_from_bed_file(self, gene_annotation_file):
         """
         Assume the file is the correct format (i.e. from UCSC).
         https://genome.ucsc.edu/FAQ/FAQformat.html
         """
-        self.gene_annot_df = pd.read_csv(gene_annotation_file, sep='\t', header=None, comment='#')
-        self.gene_annot_df.rename(columns={0: 'chr', 1: 'start_position', 2: 'end_position', 3: 'name',
-                                           5: 'direction', 4: 'strand'}, inplace=True)
-        if len(self.gene_annot_df.columns) < 5:  # might only have start, end
-            self.gene_annot_df['strand'] = '.'
-            self.gene_annot_df['direction'] = 1
-        convert_dict = {'start_position': int,
-                        'end_position': int,
-                        'chromosome_name': str}
-        self.gene_annot_df = self.gene_annot_df.astype(convert_dict)
+        self.gene_annot_df = self.format_bed_annotation(read_bed_annotation(gene_annotation_file))
         # Ensure it is sorted
-        # Check the direcion as well
-        if not isinstance(self.gene_annot_df['direction'].values[0], int):
-            self.gene_annot_df['direction']= [1 if x == '+' else -1 for x in self.gene_annot_df['direction'].values]
+        self.gene_annot_df = self.sort_annotation_df(self.gene_annot_df, direction_col='direction')
         # Gene information is just all the values from our annot df
-        self.gene_annot_df['strand'] = self.gene_annot_df['direction']
-        self.gene_annot_values = self.gene_annot_df[self.column_order].values
-        self.num_genes = len(self.gene_annot_values)
+        self.update_gene_annot_values()
 
+    def format_bed_annotation(self, bed_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Names the columns of a bed annotation: chr, start_position, end_position, name, score and direction (1 for +
+        and -1 otherwise). The strand is set to the direction, chromosome_name and external_gene_name are copies of
+        chr and name so the default column order can be used.
+        """
+        bed_df = bed_df.rename(columns={0: 'chr', 1: 'start_position', 2: 'end_position', 3: 'name', 4: 'score',
+                                        5: 'direction'})
+        if 'name' not in bed_df.columns:
+            bed_df['name'] = [f'{c}:{s}-{e}' for c, s, e in zip(bed_df['chr'].values, bed_df['start_position'].values,
+                                                                 bed_df['end_position'].values)]
+        if 'score' not in bed_df.columns:
+            bed_df['score'] = 0
+        if 'direction' not in bed_df.columns:  # might only have start, end
+            bed_df['direction'] = 1
+        bed_df = bed_df.astype({'chr': str, 'start_position': np.int64, 'end_position': np.int64})
+        # Check the direction as well
+        if not pd.api.types.is_numeric_dtype(bed_df['direction']):
+            bed_df['direction'] = np.where(bed_df['direction'].astype(str).values == '+', 1, -1)
+        bed_df['strand'] = bed_df['direction']
+        bed_df['chromosome_name'], bed_df['external_gene_name'] = bed_df['chr'], bed_df['name']
+        return bed_df
+
+    @timed('merge_annotation')
+    def merge_annotation_intervals(self, bed_df: pd.DataFrame, distance=0) -> pd.DataFrame:
+        """
+        Merges intervals that overlap (or are within distance of each other) on the same chromosome and strand.
+        Runs are found without a python loop: after sorting on chromosome, strand and start, a new run starts
+        wherever the start is past the furthest end seen so far in the current chromosome/strand group.
+
+        Parameters
+        ----------
+        bed_df:     DataFrame: formatted bed annotation (see format_bed_annotation)
+        distance:   int: maximum gap between intervals that are merged
+
+        Returns
+        -------
+        DataFrame with one row per merged interval, names of the merged intervals are joined with a comma and the
+        score is the maximum score.
+        """
+        if len(bed_df) == 0:
+            return bed_df
+        chr_codes = self.chromosomes.codes(bed_df['chr'].values)
+        directions = bed_df['direction'].values.astype(np.int64)
+        starts, ends = bed_df['start_position'].values, bed_df['end_position'].values
+        order = np.lexsort((starts, directions, chr_codes))
+        chr_codes, directions, starts, ends = chr_codes[order], directions[order], starts[order], ends[order]
+        new_group = np.ones(len(order), dtype=bool)
+        new_group[1:] = (chr_codes[1:] != chr_codes[:-1]) | (directions[1:] != directions[:-1])
+        # Furthest end so far within each chromosome/strand group
+        run_max_ends = pd.Series(ends).groupby(np.cumsum(new_group)).cummax().values
+        new_run = new_group.copy()
+        new_run[1:] |= starts[1:] > run_max_ends[:-1] + distance
+        run_idx = np.cumsum(new_run) - 1
+        sorted_df = bed_df.iloc[order]
+        merged_df = pd.DataFrame({'chr': sorted_df['chr'].values[new_run], 'start_position': starts[new_run],
+                                  'end_position': np.maximum.reduceat(ends, np.nonzero(new_run)[0]),
+                                  'direction': directions[new_run]})
+        names = pd.DataFrame({'run': run_idx, 'name': sorted_df['name'].astype(str).values}).drop_duplicates()
+        merged_df['name'] = names.groupby('run')['name'].agg(','.join).values
+        merged_df['score'] = pd.Series(pd.to_numeric(sorted_df['score'].values, errors='coerce')).groupby(
+            run_idx).max().values
+        self.stats.add('intervals_merged', len(bed_df) - len(merged_df))
+        return self.format_bed_annotation(merged_df)
+
+    @timed('annotation')
     def set_annotation_using_biomart(self, mart: str, dataset: str, filter_dict=None):
         self.biomart = SciBiomartApi()
         self.biomart.set_mart(mart)
@@ -176,13 +464,114 @@ class Epi2Gene:
                         'chromosome_name': str}
         self.gene_annot_df = self.gene_annot_df.astype(convert_dict)
         # Sort the values
-        self.gene_annot_df = self.biomart.sort_df_on_starts(self.gene_annot_df)
+        self.gene_annot_df = self.sort_annotation_df(self.gene_annot_df)
         # Gene information is just all the values from our annot df
-        self.gene_annot_values = self.gene_annot_df[self.column_order].values
-        self.num_genes = len(self.gene_annot_values)
+        self.update_gene_annot_values()
+
+    @timed('sort_annotation')
+    def sort_annotation_df(self, annot_df: pd.DataFrame, chr_col='chromosome_name', start_col='start_position',
+                           end_col='end_position', direction_col='strand') -> pd.DataFrame:
+        """
+        Sorts the annotation on canonical chromosome order then TSS (TSS as in sort_df_on_starts in scibiomart). We
+        first check if it is already sorted (one vectorised pass) and only sort if needed.
+
+        Parameters
+        ----------
+        annot_df:       DataFrame: gene annotation
+        chr_col:        str: chromosome column
+        start_col:      str: start column
+        end_col:        str: end column
+        direction_col:  str: direction column (< 0 for reverse transcribed genes)
+
+        Returns
+        -------
+        DataFrame sorted on chromosome and TSS
+        """
+        directions = annot_df[direction_col].values.astype(np.float64)
+        tss = np.where(directions < 0, annot_df[end_col].values, annot_df[start_col].values)
+        # Sorting on the chromosome codes (see ChromosomeIndex) gives the canonical order: numbered chromosomes, then
+        # named ones (X, Y, W, Z, MT), then any others in the order they were first seen
+        chr_codes = self.chromosomes.codes(annot_df[chr_col].values)
+        if is_sorted(chr_codes, tss):
+            return annot_df
+        return annot_df.iloc[get_sort_order(chr_codes, tss)]
+
+    def update_gene_annot_values(self):
+        """
+        Sets the gene values used in the main loop from the annotation DataFrame, as well as the canonical chromosome
+        code of each gene and the range of gene indexes for each chromosome (so we can jump straight to a chromosome).
+        """
+        if self.compact_annotation is not False:
+            self.compact_annotation_df()
+        self.num_genes = len(self.gene_annot_df)
+        self.gene_chr_codes = self.chromosomes.codes(
+            self.gene_annot_df[self.column_order[self.gene_chr]].astype(str).values)
+        self.gene_annot_values = None if self.compact_annotation is not False else \
+            self.gene_annot_df[self.column_order].values
+        self.chr_gene_ranges, self.gene_indexes = {}, {}
+        if self.num_genes > 0:
+            # Genes are sorted on chromosome so each chromosome is a single block.
+            block_starts = np.concatenate([[0], np.nonzero(np.diff(self.gene_chr_codes))[0] + 1])
+            block_ends = np.concatenate([block_starts[1:], [self.num_genes]])
+            for start, end in zip(block_starts, block_ends):
+                self.chr_gene_ranges[int(self.gene_chr_codes[start])] = (int(start), int(end))
+            if len(self.chr_gene_ranges) != len(block_starts):
+                self.u.warn_p(['update_gene_annot_values: Warning! Your annotation is not sorted on chromosome, '
+                               'locations on chromosomes that are split into multiple blocks will be missed.'])
+
+    def compact_annotation_df(self) -> None:
+        """
+        Drops every annotation column other than the chromosome, name, start, end and direction (plus any columns
+        passed in compact_annotation) and stores them with small dtypes: chromosomes and repeated strings as
+        categoricals and positions/strands as the smallest integer type that holds them.
+        """
+        gene_columns = [self.column_order[i] for i in [self.gene_chr, self.gene_name, self.gene_start, self.gene_end,
+                                                       self.gene_direction]]
+        extra_columns = [] if self.compact_annotation is True else list(self.compact_annotation)
+        missing = [c for c in extra_columns if c not in self.gene_annot_df.columns]
+        if missing:
+            raise Epi2GeneException(f'compact_annotation_df: columns not in the annotation: {missing}')
+        keep = [c for c in self.column_order if c in gene_columns] + \
+               [c for c in extra_columns if c not in gene_columns]
+        df = self.gene_annot_df[keep].reset_index(drop=True)
+        for column in keep:
+            values = df[column]
+            if pd.api.types.is_integer_dtype(values):
+                df[column] = pd.to_numeric(values, downcast='integer')
+            elif not pd.api.types.is_numeric_dtype(values) and not isinstance(values.dtype, pd.CategoricalDtype) \
+                    and (column == gene_columns[0] or values.nunique() < len(values) // 2):
+                df[column] = values.astype('category')
+        self.gene_chr, self.gene_name, self.gene_start, self.gene_end, self.gene_direction = \
+            [keep.index(c) for c in gene_columns]
+        self.gene_annot_df, self.column_order = df, keep
+
+    def memory_usage(self) -> dict:
+        """
+        Approximate memory (bytes) held by each part of this object: the annotation, gene values and indexes, and
+        what is left from the last run. Use compact_annotation to shrink the annotation.
+
+        Returns
+        -------
+        dict: bytes for each component and the total
+        """
+        usage = {'gene_annot_df': get_nbytes(self.gene_annot_df),
+                 'gene_annot_values': get_nbytes(self.gene_annot_values),
+                 'gene_chr_codes': get_nbytes(self.gene_chr_codes),
+                 'gene_indexes': get_nbytes(list(self.gene_indexes.values())),
+                 'location_index': get_nbytes(self.location_index),
+                 'rows_with_genes': get_nbytes(self.rows_with_genes),
+                 'location_to_gene_dict': get_nbytes(self.location_to_gene_dict),
+                 'gene_to_location_dict': get_nbytes(self.gene_to_location_dict),
+                 'df': get_nbytes(self.df),
+                 'loc_df': get_nbytes(self.loc_df),
+                 'gene_info_df': get_nbytes(self.gene_info_df)}
+        usage['total'] = sum(usage.values())
+        return usage
 
     def save_annotation(self, output_dir=None):
         output_dir = output_dir or self.output_dir
+        # Only made when needed as it isn't used for assignments
+        self.biomart = self.biomart or SciBiomartApi()
         self.biomart.save_as_csv(self.gene_annot_df, output_dir)
 
     """
@@ -280,209 +669,498 @@ class Epi2Gene:
     Functions for running in the loop.
     -----------------------------------------------------------------
     """
-    def update_loc_value(self, loc_args: dict):
+    def check_chr(self, loc_chr, gene_chr):
+        """
+        Checks if the chr format is the same for each of the methods. i.e. either both don't have chr or both have chr.
+        Parameters
+        ----------
+        loc_chr
+        gene_chr
+
+        Returns
+        -------
+
+        """
+        if ('chr' in loc_chr and (isinstance(gene_chr, int) or 'chr' not in gene_chr)) or\
+                ('chr' in gene_chr and (isinstance(loc_chr, int) or 'chr' not in loc_chr)):
+            # Chromosomes are matched on their canonical names (see chromosomes.py) so this is just to let the user know
+            msg = f'Warning: Your input file used different chr conventions to your annotation: {loc_chr} vs ' \
+                  f'{gene_chr}\nThese are matched on canonical chromosome names (e.g. chr1 and 1, chrM and MT are ' \
+                  f'the same chromosome) \nfile: {self.filename}'
+            self.u.warn_p([msg])
+
+    """
+    -----------------------------------------------------------------
+    Vectorised assignment & parameter sweeps.
+    -----------------------------------------------------------------
+    """
+    def read_locations(self):
         """
-        Update the location's value with the new score & value (if this is better than the stored one).
+        Reads the whole location file into a DataFrame with one row per location (in the same order as the location
+        indexes used by _assign_values). Columns match self.header, the gene_idx column is left empty.
+        """
+        self.u.warn_p(['Warn: read_locations not performed. Please use the correct wrapper for your file type.'
+                       '\nDMRseq, Generic, or Bed.'])
+        return None
+
+    def get_location_arrays(self, loc_df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Typed chr, start and end arrays from a DataFrame returned by read_locations. """
+        return loc_df[self.loc_chr_col].astype(str).values, loc_df[self.loc_start_col].values.astype(np.int64), \
+            loc_df[self.loc_end_col].values.astype(np.int64)
+
+    def get_gene_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """ Typed chr, start, end and direction arrays for the genes in the annotation (in annotation order). """
+        df, columns = self.gene_annot_df, self.column_order
+        return df[columns[self.gene_chr]].astype(str).values, \
+            df[columns[self.gene_start]].values.astype(np.int64), df[columns[self.gene_end]].values.astype(np.int64), \
+            df[columns[self.gene_direction]].values.astype(np.float64)
+
+    def get_chr_codes(self, loc_chrs: np.ndarray) -> np.ndarray:
+        """ Canonical chromosome codes for the locations (comparable with gene_chr_codes). """
+        return self.chromosomes.codes(loc_chrs)
+
+    def get_location_strands(self, loc_df: pd.DataFrame) -> np.ndarray:
+        """ Strand of each location from its direction column: 1.0, -1.0 or NaN if unstranded (see parse_strands). """
+        if 'direction' not in loc_df.columns:
+            return np.full(len(loc_df), np.nan)
+        return parse_strands(loc_df['direction'].values)
+
+    def filter_direction(self, loc_df: pd.DataFrame, loc_idx: np.ndarray, gene_idx: np.ndarray,
+                         gene_directions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ If direction_aware only keep pairs on the same strand (unstranded locations are kept). """
+        if not self.direction_aware:
+            return loc_idx, gene_idx
+        loc_strands = self.get_location_strands(loc_df)[loc_idx]
+        keep = np.isnan(loc_strands) | (loc_strands == np.where(gene_directions[gene_idx] > 0, 1.0, -1.0))
+        return loc_idx[keep], gene_idx[keep]
+
+    def get_gene_index(self, setting=None, stranded=False):
+        """
+        Interval index of the gene windows for an overlap setting (the current settings if None), indexes are built
+        once per setting and kept until the annotation changes. If stranded, separate indexes for the + and - strand
+        genes (see StrandedIndex).
+        """
+        setting = setting or {p: getattr(self, p) for p in SWEEP_PARAMS}
+        key = tuple(setting[p] for p in SWEEP_PARAMS) + (stranded, )
+        index = self.gene_indexes.get(key)
+        if index is None:
+            _, gene_starts, gene_ends, gene_directions = self.get_gene_arrays()
+            index = build_gene_index(self.gene_chr_codes, gene_starts, gene_ends, gene_directions, setting, stranded)
+            self.gene_indexes[key] = index
+        return index
+
+    def query_genes(self, loc_codes: np.ndarray, loc_starts: np.ndarray, loc_ends: np.ndarray, loc_strands=None,
+                    setting=None, stats=None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Location/gene pairs (sorted by location then gene) using the gene index for setting. If direction_aware,
+        stranded locations only get genes on their own strand and unstranded ones (NaN) genes on either strand.
+        Candidates compared are counted in stats if it is passed.
+        """
+        return query_gene_index(self.get_gene_index(setting, stranded=self.direction_aware), loc_codes, loc_starts,
+                                loc_ends, loc_strands, stats)
 
-        Here we first assign the location value (to keep track of all locations assigned to genes).
-        Second, we look test if the new score is better than the previous score and if so we replace the
-        CpG island we have stored.
+    def query(self, chrs, starts, ends, strands=None, setting=None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the genes for a batch of regions without reading a file, using the current overlap_method and buffers
+        (or those in setting). This doesn't change any state other than caching the gene index.
 
         Parameters
         ----------
-        loc_args:      An ordered dictionary with the arguments stored that one wants added ot the row
+        chrs:           np.array: chromosome of each region (any naming convention, e.g. chr1, 1 or NC_000001.11)
+        starts:         np.array: start of each region
+        ends:           np.array: end of each region
+        strands:        np.array: strand of each region (1/-1 or +/-), only used if direction_aware. Regions without a
+                        strand (or no strands) get genes on either strand.
+        setting:        dict: overlap settings to use instead of the ones on this object (keys in SWEEP_PARAMS)
 
         Returns
         -------
-        stored_score, stored_value
-        """
-        self.assign_loc_value()
-        tmp_row = [self.cur_loc_idx, self.cur_chr, self.cur_loc_start, self.cur_loc_end, self.cur_gene_idx]
-        for arg in loc_args:
-            tmp_row.append(loc_args[arg])
-        self.rows_with_genes.append(tmp_row)
-
-    def check_for_gene_match(self, gene_chr: str, gene_start: int, gene_end: int, gene_direction: int,
-                             loc_start: int, loc_end: int, loc_args: dict) -> None:
-        """
-        This is the general search loop that we go through each time we are trying to assign a location to a gene.
-        """
-        self.cur_chr = gene_chr
-
-        # Check if we have locs around or accross the starting area
-        # First check if this loc is overlapping the gene, if it is, then
-        if not self.direction_aware or loc_args.get('direction') == gene_direction:
-            if self.overlaps(gene_start, gene_end, gene_direction, loc_start, loc_end):
-                # Add this to our rows
-                # Before we move onto the next loc, we want to see if there are any other genes that
-                # meet the same criteria
-                self.update_loc_value(loc_args)
-                # We've already assigned this gene, lets move up 1
-                prev_gene_idx = self.cur_gene_idx
-                self.cur_gene_idx += 1
-                self.find_genes_in_loc(loc_start, loc_end, loc_args)
-                self.cur_gene_idx = prev_gene_idx
-            else:
-                prev_gene_idx = self.cur_gene_idx
-                self.cur_gene_idx += 1
-                self.find_genes_in_loc(loc_start, loc_end, loc_args)
-                # Again we may need to re visit this gene
-                self.cur_gene_idx = prev_gene_idx
-        else:
-            prev_gene_idx = self.cur_gene_idx
-            self.cur_gene_idx += 1
-            self.find_genes_in_loc(loc_start, loc_end, loc_args)
-            # Again we may need to re visit this gene
-            self.cur_gene_idx = prev_gene_idx
+        offsets, gene_idx: CSR arrays, the genes of region i are gene_idx[offsets[i]: offsets[i + 1]]
+        """
+        if len(self.gene_annot_df) < 1:
+            msg = errors.get('GENE_ANNOT_ERR')
+            self.u.err_p([msg])
+            raise Epi2GeneException(msg)
+        setting = self.get_sweep_settings([setting])[0] if setting else None
+        loc_idx, gene_idx = self.query_genes(self.get_chr_codes(chrs), np.asarray(starts, dtype=np.int64),
+                                             np.asarray(ends, dtype=np.int64),
+                                             parse_strands(strands) if strands is not None else None, setting)
+        return pairs_to_offsets(loc_idx, len(starts)), gene_idx
+
+    @timed('location_index')
+    def get_location_index(self) -> IntervalIndex:
+        """
+        Interval index over the locations (read once, then kept), so that the locations for any genes and overlap
+        setting can be found with binary searches instead of another pass over the input.
+        """
+        if self.location_index is None:
+            self.locations = self.read_locations()
+            loc_chrs, loc_starts, loc_ends = self.get_location_arrays(self.locations)
+            self.location_index = IntervalIndex(self.get_chr_codes(loc_chrs), loc_starts, loc_ends)
+        return self.location_index
 
-    def assign_loc_value(self):
+    def locations_for_genes(self, gene_ids: list, setting=None, id_column=None) -> pd.DataFrame:
         """
-        Creates a dictionary using the location indicies as the keys and the gene index as the value
+        Finds all the locations assigned to some genes using the location index (see get_location_index), the input
+        is only read the first time this is called.
+
+        Parameters
+        ----------
+        gene_ids:       list: genes to find the locations of
+        setting:        dict: overlap settings to use instead of the ones on this object (keys in SWEEP_PARAMS)
+        id_column:      str: annotation column the gene_ids are from (default the gene name column)
+
         Returns
         -------
+        DataFrame in the same format as loc_df (sorted by location then gene)
+        """
+        if len(self.gene_annot_df) < 1:
+            msg = errors.get('GENE_ANNOT_ERR')
+            self.u.err_p([msg])
+            raise Epi2GeneException(msg)
+        setting = self.get_sweep_settings([setting or {}])[0]
+        id_column = id_column or self.column_order[self.gene_name]
+        genes = np.nonzero(self.gene_annot_df[id_column].isin(gene_ids).values)[0]
+        if len(genes) < len(set(gene_ids)):
+            self.u.warn_p(['locations_for_genes: some genes were not in the annotation column: ', id_column])
+        location_index = self.get_location_index()
+        _, gene_starts, gene_ends, gene_directions = self.get_gene_arrays()
+        lo, hi = gene_windows(gene_starts[genes], gene_ends[genes], gene_directions[genes], setting['overlap_method'],
+                              setting['buffer_before_tss'], setting['buffer_after_tss'],
+                              setting['buffer_gene_overlap'])
+        gene_pos, loc_idx = location_index.query(self.gene_chr_codes[genes], lo, hi)
+        gene_idx = genes[gene_pos]
+        loc_idx, gene_idx = self.filter_direction(self.locations, loc_idx, gene_idx, gene_directions)
+        order = np.argsort(loc_idx * max(self.num_genes, 1) + gene_idx)
+        return self.pairs_to_loc_df(self.locations, loc_idx[order], gene_idx[order], self.get_columns_in_gene_info())
 
+    """
+    -----------------------------------------------------------------
+    Re-annotation when the gene annotation changes.
+    -----------------------------------------------------------------
+    """
+    def get_annotation_coordinates(self, annot_df: pd.DataFrame, id_column: str) -> pd.DataFrame:
+        """ Gene id, canonical chromosome code, start, end and direction of each row of an annotation. """
+        chr_col, start_col, end_col, direction_col = [self.column_order[i] for i in
+                                                      [self.gene_chr, self.gene_start, self.gene_end,
+                                                       self.gene_direction]]
+        return pd.DataFrame({id_column: annot_df[id_column].values,
+                             'chr': self.get_chr_codes(annot_df[chr_col].values),
+                             'start': annot_df[start_col].values.astype(np.int64),
+                             'end': annot_df[end_col].values.astype(np.int64),
+                             'direction': annot_df[direction_col].values.astype(np.float64)}).drop_duplicates()
+
+    def diff_annotation(self, old_annot_df: pd.DataFrame, id_column='ensembl_gene_id') -> pd.DataFrame:
         """
-        # Add that gene to the location dictionary
-        self.location_to_gene_dict[self.cur_loc_idx].append(self.cur_gene_idx)
-        # Assign the location to the gene
-        self.gene_to_location_dict[self.cur_gene_idx].append(self.cur_loc_idx)
+        Compares an older annotation to the current one (gene_annot_df). Genes are matched on id_column and compared
+        on chromosome (canonical names), start, end and direction.
 
-    def get_current_gene_params(self, loc_chr: str,  loc_start_i: int, loc_end_i: int) -> Tuple[str, int, int, int]:
+        Parameters
+        ----------
+        old_annot_df:   DataFrame: previous annotation (same columns as the current one)
+        id_column:      str: column with the gene identifier
+
+        Returns
+        -------
+        DataFrame: id_column and status (added, removed, moved or unchanged) for every gene in either annotation
+        """
+        old = self.get_annotation_coordinates(old_annot_df, id_column)
+        new = self.get_annotation_coordinates(self.gene_annot_df, id_column)
+        merged = old.merge(new, how='outer', indicator=True)
+        changed = set(merged[merged['_merge'] != 'both'][id_column].values)
+        old_ids, new_ids = set(old[id_column].values), set(new[id_column].values)
+        ids = list(old_ids | new_ids)
+        status = ['moved' if i in changed else 'unchanged' for i in ids]
+        for j, i in enumerate(ids):
+            if i not in new_ids:
+                status[j] = 'removed'
+            elif i not in old_ids:
+                status[j] = 'added'
+        return pd.DataFrame({id_column: ids, 'status': status})
+
+    @timed('reannotate')
+    def reannotate(self, previous_df: pd.DataFrame, old_annot_df: pd.DataFrame, id_column='ensembl_gene_id',
+                   setting=None) -> pd.DataFrame:
         """
-        This is run in each of the main file loops. Here we check whether the current gene chr matches the current
-        location chr. If not, we need to iterate through the gene file until we match the location chr. Since we
-        assume that the location file is sorted this means the gene index always has to catch up.
+        Updates a previous result (in the loc_df format, made with old_annot_df and the same input and overlap
+        settings) to the current annotation. Rows for unchanged genes are kept (with gene_idx and the gene columns
+        updated), rows for removed or moved genes are dropped and the locations of added or moved genes are found
+        with the location index (see locations_for_genes), so only the windows that changed are recomputed.
 
         Parameters
         ----------
-        loc_chr
-        gene_chr
+        previous_df:    DataFrame: previous result, e.g. read from the csv saved by save_loc_to_csv
+        old_annot_df:   DataFrame: the annotation the previous result was made with
+        id_column:      str: column with the gene identifier (must be in the gene columns of the result)
+        setting:        dict: overlap settings of the previous result if they differ from this object's
 
         Returns
         -------
+        DataFrame: same result as running the assignment again with the current annotation
+        """
+        if len(self.gene_annot_df) < 1:
+            msg = errors.get('GENE_ANNOT_ERR')
+            self.u.err_p([msg])
+            raise Epi2GeneException(msg)
+        diff = self.diff_annotation(old_annot_df, id_column)
+        self.stats.add('genes_changed', int((diff['status'] != 'unchanged').sum()))
+        changed = diff[diff['status'] != 'unchanged'][id_column].values
+        updated = diff[diff['status'].isin(['added', 'moved'])][id_column].values
+        loc_idx_col = self.header[0]
+        gene_info_columns = self.get_columns_in_gene_info()
+        start_col, end_col = self.column_order[self.gene_start], self.column_order[self.gene_end]
+
+        # Unchanged genes keep their rows, matched to the new annotation on id, start and end (in case of duplicates)
+        kept_df = previous_df[~previous_df[id_column].isin(changed)].reset_index(drop=True)
+        new_genes = pd.DataFrame({id_column: self.gene_annot_df[id_column].values,
+                                  start_col: self.gene_annot_df[start_col].values.astype(np.int64),
+                                  end_col: self.gene_annot_df[end_col].values.astype(np.int64),
+                                  'new_gene_idx': np.arange(self.num_genes)}).drop_duplicates([id_column, start_col,
+                                                                                                end_col])
+        keys = pd.DataFrame({id_column: kept_df[id_column].values,
+                             start_col: kept_df[start_col].values.astype(np.int64),
+                             end_col: kept_df[end_col].values.astype(np.int64)})
+        gene_idx = keys.merge(new_genes, how='left', on=[id_column, start_col, end_col])['new_gene_idx'].values
+        missing = pd.isnull(gene_idx)
+        if missing.any():
+            self.u.warn_p(['reannotate: rows with genes that are not in either annotation were dropped: ',
+                           int(missing.sum())])
+            kept_df, gene_idx = kept_df[~missing].reset_index(drop=True), gene_idx[~missing]
+        kept_df['gene_idx'] = gene_idx.astype(np.int64)
+        for c in gene_info_columns:
+            kept_df[c] = self.gene_annot_df[c].values[kept_df['gene_idx'].values]
+
+        # Added and moved genes are looked up in the location index
+        updated_df = self.locations_for_genes(list(updated), setting, id_column) if len(updated) else \
+            kept_df.iloc[:0]
+        self.stats.add('rows_kept', len(kept_df))
+        self.stats.add('rows_recomputed', len(updated_df))
+        new_df = pd.concat([kept_df, updated_df[list(kept_df.columns)]], ignore_index=True)
+        order = np.argsort(new_df[loc_idx_col].values.astype(np.int64) * max(self.num_genes, 1) +
+                           new_df['gene_idx'].values.astype(np.int64), kind='stable')
+        return new_df.iloc[order].reset_index(drop=True)
+
+    def get_sweep_settings(self, param_sets: list) -> list:
+        """
+        Fills in any parameters that were not set in each parameter set with the values on this object.
+
+        Parameters
+        ----------
+        param_sets:     list: list of dictionaries, keys must be in SWEEP_PARAMS
 
+        Returns
+        -------
+        list of dictionaries with every key in SWEEP_PARAMS set
         """
-        gene_chr = self.gene_annot_values[self.cur_gene_idx][self.gene_chr]
-        if not loc_chr == gene_chr:
-            # We need to iterate through until we get to the next chromosone
-            for i in range(0, len(self.gene_annot_values)):
-                gene_chr = self.get_gene_chr(i)
-                if gene_chr == loc_chr:
-                    self.cur_chr = loc_chr
-                    self.cur_gene_idx = i
-                    break
-        # We also need to see if this is before the current location if so, we have passed the TSS and need to move
-        # onto the next gene
-        for i in range(self.cur_gene_idx, self.num_genes):
-            gene_end = self.gene_annot_values[i][self.gene_end]
-            gene_direction = self.gene_annot_values[i][self.gene_direction]
-            gene_start = self.gene_annot_values[i][self.gene_start]
-
-            if self.overlaps(gene_start, gene_end, gene_direction, loc_start_i, loc_end_i):
-                # Update the gene index
-                self.cur_gene_idx = i
-                break
-                # Check if we have passed our loc (i.e. both the loc start and end are before our gene
-                # We need to do this in a way where we are aware of the reverse transcribed genes
-            if self.overlap_method == 'in_promoter':
-                if (gene_direction > 0 and (loc_end_i < (gene_start - self.buffer_before_tss))) or (gene_direction < 0 and
-                                                                                                  (loc_end_i < (gene_end -
-                                                                                                   self.buffer_gene_overlap))):
-                    self.cur_gene_idx = i
-                    # We want to see if there are any locs for this gene
-                    break
-            elif self.overlap_method == 'overlaps':
-                if gene_direction > 0 and (loc_end_i < (gene_start - self.buffer_before_tss)):
-                    # Here our gene has overshot the mark, so we go back and see if there are any new locations in
-                    # this gene
-                    self.cur_gene_idx = i
-                    break
-                elif gene_direction < 0 and (loc_end_i < (gene_start - self.buffer_after_tss)):
-                    # Here our gene has overshot the mark, so we go back and see if there are any new locations in
-                    # this gene
-                    self.cur_gene_idx = i
-                    # We want to see if there are any locs for this gene
-                    break
-        # Set current chr
-        gene_chr = self.gene_annot_values[self.cur_gene_idx][self.gene_chr]
-        gene_end = self.gene_annot_values[self.cur_gene_idx][self.gene_end]
-        gene_direction = self.gene_annot_values[self.cur_gene_idx][self.gene_direction]
-        gene_start = self.gene_annot_values[self.cur_gene_idx][self.gene_start]
-        return gene_chr, gene_start, gene_end, gene_direction
+        defaults = {p: getattr(self, p) for p in SWEEP_PARAMS}
+        return [fill_setting(param_set, defaults, self.u, "assign_locations_to_genes_grid") for param_set in param_sets]
 
-    def check_chr(self, loc_chr, gene_chr):
+    @timed('assign_locations_to_genes_grid')
+    def assign_locations_to_genes_grid(self, param_sets: list, long_format=True, rollup_column=None):
         """
-        Checks if the chr format is the same for each of the methods. i.e. either both don't have chr or both have chr.
+        Runs the assignment for a grid of overlap settings in a single pass. The input is read once, candidate
+        location/gene pairs are found once using the widest window of each gene across all the settings, and
+        each setting then only filters the candidates against its own gene windows (see gene_windows). The filter is
+        the overlap test the gene index uses, so every setting gives the same pairs as assign_locations_to_genes.
+
         Parameters
         ----------
-        loc_chr
-        gene_chr
+        param_sets:     list: list of dictionaries with any of overlap_method, buffer_before_tss, buffer_after_tss
+                        and buffer_gene_overlap (anything not set uses the value on this object).
+        long_format:    Bool: if true returns a single DataFrame with a setting_id column, otherwise a dictionary of
+                        setting_id to DataFrame.
+        rollup_column:  str: for annotations with many rows per gene (e.g. one per transcript), the annotation column
+                        with the gene id. Each location is then assigned each gene once (see rollup_pairs).
 
         Returns
         -------
-
+        DataFrame (or dictionary of DataFrames) in the same format as loc_df
         """
-        if ('chr' in loc_chr and (isinstance(gene_chr, int) or 'chr' not in gene_chr)) or\
-                ('chr' in gene_chr and (isinstance(loc_chr, int) or 'chr' not in loc_chr)):
-            # Since we're assuming that they have used the scibiomart package (which doesn't have chrs by default)
-            # we need to add those
-            msg = f'Warning: Your input file used different chr conventions to ensembl: {loc_chr} vs {gene_chr} ' \
-                  f'\nIf these do not match there will be no overlaps found. Please check your files to ensure your ' \
-                  f'chromosome names match in ' \
-                  f'\nfile: {self.filename}'
-            self.u.warn_p([msg])
+        if len(self.gene_annot_df) < 1:
+            msg = errors.get('GENE_ANNOT_ERR')
+            self.u.err_p([msg])
+            raise Epi2GeneException(msg)
+        settings = self.get_sweep_settings(param_sets)
+        loc_df = self.read_locations()
+        loc_chrs, loc_starts, loc_ends = self.get_location_arrays(loc_df)
+        gene_chrs, gene_starts, gene_ends, gene_directions = self.get_gene_arrays()
+        loc_codes = self.get_chr_codes(loc_chrs)
+
+        windows = [gene_windows(gene_starts, gene_ends, gene_directions, s['overlap_method'],
+                                s['buffer_before_tss'], s['buffer_after_tss'], s['buffer_gene_overlap'])
+                   for s in settings]
+        widest_lo = np.min([lo for lo, hi in windows], axis=0)
+        widest_hi = np.max([hi for lo, hi in windows], axis=0)
+        if self.direction_aware:
+            loc_idx, gene_idx = StrandedIndex(self.gene_chr_codes, widest_lo, widest_hi, gene_directions).query(
+                loc_codes, loc_starts, loc_ends, self.get_location_strands(loc_df), self.stats)
+        else:
+            loc_idx, gene_idx = IntervalIndex(self.gene_chr_codes, widest_lo, widest_hi).query(
+                loc_codes, loc_starts, loc_ends, self.stats)
+
+        gene_info_columns = self.get_columns_in_gene_info()
+        results = {}
+        cand_starts, cand_ends = loc_starts[loc_idx], loc_ends[loc_idx]
+        for setting_id, (lo, hi) in enumerate(windows):
+            # Same test as IntervalIndex.query, so the kept pairs are the ones this setting's own index would give
+            keep = (cand_starts <= hi[gene_idx]) & (cand_ends >= lo[gene_idx])
+            if rollup_column is None:
+                results[setting_id] = self.pairs_to_loc_df(loc_df, loc_idx[keep], gene_idx[keep], gene_info_columns)
+                continue
+            setting_loc_idx, setting_gene_idx, tss_distance, num_transcripts = \
+                self.rollup_pairs(loc_starts, loc_ends, loc_idx[keep], gene_idx[keep], rollup_column)
+            results[setting_id] = self.pairs_to_loc_df(loc_df, setting_loc_idx, setting_gene_idx, gene_info_columns)
+            results[setting_id]['tss_distance'] = tss_distance
+            results[setting_id]['num_transcripts'] = num_transcripts
+        if not long_format:
+            return results
+        for setting_id, df in results.items():
+            df.insert(0, 'setting_id', setting_id)
+        return pd.concat(list(results.values()), ignore_index=True)
+
+    def rollup_pairs(self, loc_starts: np.ndarray, loc_ends: np.ndarray, loc_idx: np.ndarray, gene_idx: np.ndarray,
+                     id_column: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Rolls location/transcript pairs up to one pair per location and gene, keeping the transcript whose TSS is
+        closest to the location (the first in the annotation if there is a tie).
+
+        Parameters
+        ----------
+        loc_starts:     np.array: start of every location
+        loc_ends:       np.array: end of every location
+        loc_idx:        np.array: location index of each pair
+        gene_idx:       np.array: annotation (transcript) index of each pair
+        id_column:      str: annotation column with the gene id the transcripts are rolled up to
 
-    def find_genes_in_loc(self, loc_start_i: int, loc_end_i: int, loc_args: dict) -> None:
+        Returns
+        -------
+        loc_idx, gene_idx (the best transcript), tss_distance (0 if the TSS is in the location) and num_transcripts
+        (number of the gene's transcripts matching the location), sorted by location then transcript
+        """
+        gene_chrs, gene_starts, gene_ends, gene_directions = self.get_gene_arrays()
+        tss = np.where(gene_directions < 0, gene_ends, gene_starts)[gene_idx]
+        tss_distance = np.maximum(np.maximum(loc_starts[loc_idx] - tss, tss - loc_ends[loc_idx]), 0)
+        gene_codes = pd.factorize(self.gene_annot_df[id_column].values)[0][gene_idx]
+        order = np.lexsort((gene_idx, tss_distance, gene_codes, loc_idx))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (loc_idx[order][1:] != loc_idx[order][:-1]) | (gene_codes[order][1:] != gene_codes[order][:-1])
+        num_transcripts = np.diff(np.append(np.nonzero(first)[0], len(order)))
+        best = order[first]
+        resort = np.lexsort((gene_idx[best], loc_idx[best]))
+        best, num_transcripts = best[resort], num_transcripts[resort]
+        self.stats.add('transcripts_rolled_up', len(loc_idx) - len(best))
+        return loc_idx[best], gene_idx[best], tss_distance[best], num_transcripts
+
+    def pairs_to_loc_df(self, loc_df: pd.DataFrame, loc_idx: np.ndarray, gene_idx: np.ndarray,
+                        gene_info_columns: list, keep_unassigned=False) -> pd.DataFrame:
         """
-        Searchers the region for any genes. This is done so that if we have a broad location e.g.
-        H3K27me3 that might have a peak across many genes we want to indicate that these genes are associated
-        with the region.
+        Builds the same output as assign_gene_info_to_loc_df from arrays of location and gene indexes.
 
         Parameters
         ----------
-        loc_start_i:        int: start index of the location
-        loc_end_i:          int: end index of the location
-        loc_args:           dict: arguments for the location
+        loc_df:             DataFrame: locations as returned from read_locations
+        loc_idx:            np.array: location index of each pair
+        gene_idx:           np.array: gene index of each pair
+        gene_info_columns:  list: the columns from the gene annotation that we want
+        keep_unassigned:    Keep locations that weren't assigned to a gene
+
+        Returns
+        -------
+        pd.DataFrame
+        """
+        new_df = join_gene_info(loc_df, loc_idx, gene_idx, self.gene_annot_df, gene_info_columns)
+        if not keep_unassigned:
+            new_df = new_df.dropna()
+        return new_df
+
+    """
+    -----------------------------------------------------------------
+    Memory budgeted assignment (max_memory).
+    -----------------------------------------------------------------
+    """
+    def iter_location_chunks(self, chunk_rows: int):
+        """
+        Reads the (sorted) locations in chunks of at most chunk_rows, each chunk is in the same format as
+        read_locations with location indexes continuing from the previous chunk.
+        """
+        self.u.warn_p(['Warn: iter_location_chunks not performed. Please use the correct wrapper for your file type.'
+                       '\nDMRseq, Generic, or Bed.'])
+        return iter([])
+
+    def sort_input_file(self, chr_idx: int, start_idx: int, sep='\t', header=False, suffix='.bed') -> str:
+        """
+        Sorts the input file into a temporary file (on disk if it is larger than sort_memory) which is removed when
+        this object is deleted.
+
+        Returns
+        -------
+        str: path to the sorted file
+        """
+        self.u.warn_p(['sort_input_file: Your input file was not sorted, sorting it now: ', self.filename])
+        fd, sorted_filename = tempfile.mkstemp(prefix='scie2g_sorted_', suffix=suffix)
+        os.close(fd)
+        weakref.finalize(self, os.remove, sorted_filename)
+        sort_file(self.filename, sorted_filename, chr_idx, start_idx, sep=sep, header=header,
+                  max_memory=self.sort_memory, chromosomes=self.chromosomes)
+        return sorted_filename
+
+    def get_chunk_sizes(self) -> Tuple[int, int]:
+        """
+        Chooses the number of locations per chunk and the number of pairs buffered before spilling from max_memory.
+        Half the budget goes to the location chunks (sized from a sample of the file) and a quarter to the pairs.
 
         Returns
         -------
-        None
-        """
-        for i in range(self.cur_gene_idx, self.num_genes):
-            gene_start = self.get_gene_start(i)
-            gene_chr = self.get_gene_chr(i)
-            gene_end = self.get_gene_end(i)
-            gene_direction = self.get_gene_direction(i)
-            # We have moved onto the next chromosone, so return.
-            if gene_chr != self.cur_chr:
-                self.cur_gene_idx = i
-                break
-            if not self.direction_aware or loc_args.get('direction') == gene_direction:
-                if self.overlaps(gene_start, gene_end, gene_direction, loc_start_i, loc_end_i):
-                    # Update the gene index
-                    self.cur_gene_idx = i
-                    self.update_loc_value(loc_args)
-                    # Check if we have passed our loc (i.e. both the loc start and end are before our gene
-                    # We need to do this in a way where we are aware of the reverse transcribed genes
-            if self.overlap_method == 'in_promoter':
-                if (gene_direction > 0 and (loc_end_i < (gene_start - self.buffer_before_tss))) or (gene_direction < 0 and
-                                                                                                  (loc_end_i < (gene_end -
-                                                                                                   self.buffer_before_tss))):
-                    self.cur_gene_idx = i
-                    # We want to see if there are any locs for this gene
-                    break
-            elif self.overlap_method == 'overlaps':
-                if gene_direction > 0 and (loc_end_i < (gene_start - self.buffer_before_tss)):
-                    # Here our gene has overshot the mark, so we go back and see if there are any new locations in
-                    # this gene
-                    self.cur_gene_idx = i
-                    break
-                elif gene_direction < 0 and (loc_end_i < (gene_start - self.buffer_after_tss)):
-                    # Here our gene has overshot the mark, so we go back and see if there are any new locations in
-                    # this gene
-                    self.cur_gene_idx = i
-                    # We want to see if there are any locs for this gene
-                    break
+        chunk_rows, max_pairs
+        """
+        sample = next(iter(self.iter_location_chunks(MIN_CHUNK_ROWS)), None)
+        bytes_per_row = sample.memory_usage(deep=True).sum() / max(len(sample), 1) if sample is not None else 1
+        # Up to PIPELINE_DEPTH chunks are read ahead (see pipeline.py) on top of the copies made of the current one.
+        # Pairs are concatenated when spilled so there are two copies at that point
+        return get_chunk_rows(self.max_memory // 2, bytes_per_row, copies=4 + PIPELINE_DEPTH), \
+            self.max_memory // (8 * PAIR_DTYPE.itemsize)
+
+    def _assign_values_chunked(self):
+        """
+        Streams the locations through the gene interval index in chunks and spills the matching (location, gene)
+        pairs to disk once the pair buffer is full, so the memory used depends on max_memory rather than the size of
+        the input. Outputs are made by merging the pairs with the locations again (see save_loc_to_csv_chunked).
+        """
+        self.chunk_rows, max_pairs = self.get_chunk_sizes()
+        if self.pair_spill is not None:
+            self.pair_spill.cleanup()
+        self.pair_spill = PairSpill(max_pairs)
+        num_locations = 0
+        # The next chunks are parsed in a reader thread while this one is searched
+        for loc_df in tqdm(prefetch(self.iter_location_chunks(self.chunk_rows))):
+            loc_chrs, loc_starts, loc_ends = self.get_location_arrays(loc_df)
+            loc_idx, gene_idx = self.query_genes(self.get_chr_codes(loc_chrs), loc_starts, loc_ends,
+                                                 self.get_location_strands(loc_df), stats=self.stats)
+            self.pair_spill.add(loc_idx + num_locations, gene_idx)
+            num_locations += len(loc_df)
+        self.pair_spill.flush()
+        self.stats.add('locations_read', num_locations)
+        self.stats.add('matches', len(self.pair_spill))
+        self.stats.add('spill_files', len(self.pair_spill.files))
+        self.stats.set_max('chunk_rows', self.chunk_rows)
+
+    def save_loc_to_csv_chunked(self, filename: str, keep_unassigned=False) -> None:
+        """
+        Saves the same output as save_loc_to_csv after a memory budgeted run, by merging the spilled pairs (in
+        location order) with the locations read again in chunks. Only one chunk of each is in memory at a time.
+        """
+        gene_info_columns = self.get_columns_in_gene_info()
+        self.pair_spill.rewind()
+        offset = 0
+        # Chunks are read ahead in one thread and written in another, this thread only merges them with the pairs
+        with open(filename, 'w') as f, BackgroundWriter(lambda chunk: chunk[0].to_csv(f, index=False,
+                                                                                      header=chunk[1])) as writer:
+            for loc_df in prefetch(self.iter_location_chunks(self.chunk_rows)):
+                pairs = self.pair_spill.take_before(offset + len(loc_df))
+                chunk_df = self.pairs_to_loc_df(loc_df, pairs['loc_idx'] - offset, pairs['gene_idx'],
+                                                gene_info_columns, keep_unassigned)
+                writer.put((chunk_df, offset == 0))
+                offset += len(loc_df)
 
     """
     -----------------------------------------------------------------
@@ -503,6 +1181,7 @@ class Epi2Gene:
 
         return list(self.column_order)
 
+    @timed('get_gene_info_as_df')
     def get_gene_info_as_df(self, columns=None, keep_unassigned=True) -> pd.DataFrame:
         """
         Convert the gene information info a dataframe that can be interrogated.
@@ -515,6 +1194,11 @@ class Epi2Gene:
         -------
         DataFrame
         """
+        if self.pair_spill is not None:
+            msg = 'get_gene_info_as_df: not available after a run with max_memory set (the pairs are on disk), ' \
+                  'use save_loc_to_csv instead.'
+            self.u.err_p([msg])
+            raise Epi2GeneException(msg)
         columns = columns if columns is not None else self.get_columns_in_gene_info()
         gene_info_df = pd.DataFrame()
         print("Running assign_loc_info_to_gene_list")
@@ -522,11 +1206,13 @@ class Epi2Gene:
             gene_info_df[c] = self.gene_annot_df[c].values
 
         new_rows = []
-        new_columns = columns + list(self.df.columns)
+        # The wrappers don't keep every row in memory while running, so re-read the locations if we need to
+        loc_df = self.df if self.df is not None and len(self.df) > 0 else self.read_locations()
+        new_columns = columns + list(loc_df.columns)
         # Assign gene values to the locations that had genes assigned.
         print("Running assign_gene_info_to_loc_df")
-        df_location_values = self.df.values
-        num_location_values = len(self.df.values[0])
+        df_location_values = loc_df.values
+        num_location_values = len(loc_df.columns)
         df_gene_values = gene_info_df.values
         for i in tqdm(range(self.num_genes)):
             values = self.gene_to_location_dict.get(i)
@@ -564,6 +1250,7 @@ class Epi2Gene:
         self.gene_info_df = new_df
         return gene_info_df
 
+    @timed('save')
     def save_gene_info_to_csv(self, filename: str, dropnull=False) -> None:
         """
         Save the gene information to the csv file.
@@ -584,6 +1271,7 @@ class Epi2Gene:
             df = self.gene_info_df
         self.u.save_df(df, filename)
 
+    @timed('save')
     def save_loc_to_csv(self, filename: str, keep_unassigned=False) -> None:
         """
         Save the information of the location data
@@ -595,10 +1283,15 @@ class Epi2Gene:
         -------
 
         """
+        if self.loc_df is None and self.pair_spill is not None:
+            # Memory budgeted run, stream the output rather than building loc_df
+            self.save_loc_to_csv_chunked(filename, keep_unassigned)
+            return
         self.loc_df = self.loc_df if self.loc_df is not None else \
             self.assign_gene_info_to_loc_df(self.get_columns_in_gene_info(), keep_unassigned=keep_unassigned)
         self.u.save_df(self.loc_df, filename)
 
+    @timed('assign_gene_info_to_loc_df')
     def assign_gene_info_to_loc_df(self, gene_info_columns: list, col_prefix='gene_',
                                    keep_unassigned=False) -> pd.DataFrame:
         """
@@ -619,11 +1312,9 @@ class Epi2Gene:
 
         new_df = pd.DataFrame(self.rows_with_genes, columns=self.header)
         # Copy over the elements from the gene info df based on the index
+        _, gene_idx = self.get_assignment_pairs()
         for g in range(0, len(gene_info_columns)):
-            values = []
-            for r in self.rows_with_genes:
-                values.append(self.gene_annot_values[r[self.hdr_gene_idx]][g])
-            new_df[gene_info_columns[g]] = values
+            new_df[gene_info_columns[g]] = self.gene_annot_df[self.column_order[g]].values[gene_idx]
 
         # Check if we want to drop the unassigned rows
         if not keep_unassigned:
@@ -637,20 +1328,29 @@ class Epi2Gene:
     Simple getters.
     -----------------------------------------------------------------
     """
+    def get_gene_value(self, idx, column: int):
+        """
+        Value of gene idx in the annotation column at position column of column_order, from gene_annot_values or,
+        for compact annotations (which don't keep gene_annot_values), straight from the annotation DataFrame.
+        """
+        if self.gene_annot_values is not None:
+            return self.gene_annot_values[idx][column]
+        return self.gene_annot_df[self.column_order[column]].values[idx]
+
     def get_gene_start(self, idx):
-        return self.gene_annot_values[idx][self.gene_start]
+        return self.get_gene_value(idx, self.gene_start)
 
     def get_gene_end(self, idx):
-        return self.gene_annot_values[idx][self.gene_end]
+        return self.get_gene_value(idx, self.gene_end)
 
     def get_gene_chr(self, idx):
-        return self.gene_annot_values[idx][self.gene_chr]
+        return self.get_gene_value(idx, self.gene_chr)
 
     def get_gene_direction(self, idx):
-        return self.gene_annot_values[idx][self.gene_direction]
+        return self.get_gene_value(idx, self.gene_direction)
 
     def get_gene_name(self, idx):
-        return self.gene_annot_values[idx][self.gene_name]
+        return self.get_gene_value(idx, self.gene_name)
 
     def get_gene_value_by_key(self, idx, key):
-        return self.gene_annot_values[idx].get(key)
+        return self.gene_annot_df[key].values[idx] if key in self.gene_annot_df.columns else None
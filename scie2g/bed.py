@@ -16,11 +16,15 @@
 ###############################################################################
 
 from collections import defaultdict
+from itertools import compress, islice
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
 import os
 
 from scie2g import Epi2Gene, Epi2GeneException
+from scie2g.base import BLOCK_SIZE, open_output
+from scie2g.sorting import get_sort_order, is_sorted
+from scie2g.stats import timed
 
 
 class Bed(Epi2Gene):
@@ -28,15 +32,21 @@ class Bed(Epi2Gene):
     def __init__(self, filename: str, header=None, overlap_method='overlaps', output_bed_file=None,
                  buffer_after_tss=500, buffer_before_tss=2500, buffer_gene_overlap=500,
                  gene_column_order=None,
-                 chr_idx=0, start_idx=1, end_idx=2, peak_value=6, header_extra="8,9", sep='\t'):
+                 chr_idx=0, start_idx=1, end_idx=2, peak_value=6, header_extra="8,9", sep='\t',
+                 gene_start=None, gene_end=None, gene_chr=None, gene_direction=None, gene_name=None,
+                 sort_memory=512 * 1024 * 1024, max_memory=None, cache_dir=None, cache_size='1G',
+                 compact_annotation=False):
         super().__init__(filename, header, overlap_method=overlap_method,
                          buffer_after_tss=buffer_after_tss,
                          buffer_before_tss=buffer_before_tss,
                          buffer_gene_overlap=buffer_gene_overlap,
-                         gene_column_order=gene_column_order)
+                         gene_column_order=gene_column_order,
+                         gene_start=gene_start, gene_end=gene_end, gene_chr=gene_chr,
+                         gene_direction=gene_direction, gene_name=gene_name, sort_memory=sort_memory,
+                         max_memory=max_memory, cache_dir=cache_dir, cache_size=cache_size,
+                         compact_annotation=compact_annotation)
         self.filename = filename
-        self.location_to_gene_dict, self.loc_idxs_np, self.gene_to_location_dict = defaultdict(list), None,\
-                                                                                   defaultdict(list)
+        self.location_to_gene_dict, self.gene_to_location_dict = defaultdict(list), defaultdict(list)
         self.rows = []
         self.rows_with_genes = []
         self.hdr_gene_idx = 1
@@ -44,12 +54,17 @@ class Bed(Epi2Gene):
                                                                                     'chr', 'start', 'end',
                                                                                    'peak_value'] + header_extra.split(',')
         self.header.append('width')  # This is automatically added for every peak
-        self.output_bed_file = None if not output_bed_file else open(output_bed_file, 'a+')
-        self.cur_line = None  # Keep track of the current line in the file
+        # Filtered bed file (the peaks assigned to a gene), written once the assignment is done, gzipped if the
+        # filename ends with .gz
+        self.output_bed_file = output_bed_file
         self.chr_idx, self.start_idx, self.end_idx, self.peak_value = chr_idx, start_idx, end_idx, peak_value
         self.hdr_idx = [chr_idx, start_idx, end_idx, peak_value] + [int(h.strip().replace('"', '')) for h
                                                                     in header_extra.split(',')]
         self.sep = sep
+        self.sorted_filename = None  # Sorted copy of the bed file (the file itself if it was already sorted)
+        self.input_order = None  # Input line of each sorted peak, None if the bed file was already sorted
+        # The chr, start and end are the first values we read for each peak
+        self.loc_chr_col, self.loc_start_col, self.loc_end_col = self.header[2:5]
         # Check parameters
         if not self.check_args():
             raise Epi2GeneException('Parsing arguments failed. Please read detailed error message printed to STDOUT.')
@@ -104,60 +119,120 @@ class Bed(Epi2Gene):
             return False
         return True
 
-    def _assign_values(self):
-        CHROM, START, END, SIGNAL = self.chr_idx, self.start_idx, self.end_idx, self.peak_value
-        # Here we have overridden the default method and we're interested in keeping the value
-        # that has the largest median value in a single condition
-        self.cur_loc_idx, self.cur_gene_idx, count = 0, 0, 0
-        first = True
-        num_genes = len(self.gene_annot_values)
-        bed_idx = -1
-        with open(self.filename, 'r+') as bedfile:
-            for line in tqdm(bedfile):
-                bed_idx += 1
-                self.cur_line = line
-                line = line.split('\t')
-                loc_chr = line[CHROM]
-                if first:
-                    self.check_chr(loc_chr, self.gene_annot_values[0][self.gene_chr])
-                    first = False
-                self.cur_loc_idx = bed_idx
-                if self.cur_gene_idx >= num_genes:
-                    self.u.warn_p(['read_bed: \t Current gene index greater than our length of chrom starts. '
-                                   'Returning. \n Filename: \t', self.filename])
-                    break
-
-                # Get the information for this location
-                loc_start, loc_end, loc_signal = int(line[START]),  int(line[END]), line[SIGNAL]
-                gene_chr, gene_start, gene_end, gene_direction = self.get_current_gene_params(loc_chr, loc_start,
-                                                                                              loc_end)
-                loc_width = loc_end - loc_start
-                self.cur_loc_start, self.cur_loc_end = loc_start, loc_end
-                # Create the argument object that will be used.
-                loc_args = {'peak_idx': self.cur_loc_idx, 'gene_idx': self.cur_gene_idx}
-                for h in self.hdr_idx:
-                    loc_args[self.header[len(loc_args)]] = line[int(h)].strip()   # Create the arguments based on the header
-                loc_args['width'] = loc_width  # Add in the peak width
-                if loc_chr == gene_chr:
-                    # Run loop and check if we have a gene match for this location.
-                    self.check_for_gene_match(gene_chr, gene_start, gene_end, gene_direction, loc_start,
-                                              loc_end, loc_args)
-
-        # Create dataframe based on rows and columns
-        self.df = pd.DataFrame(self.rows, columns=self.header)
-        # Close the file
-        if self.output_bed_file:
-            self.output_bed_file.close()
-
-    def update_loc_value(self, loc_args: dict):
-        # First we assign that this gene mapped to this location
-        self.assign_loc_value()
-        tmp_row = []
-        loc_args['gene_idx'] = self.cur_gene_idx  # Update the gene in-case we have changed this
-        for h in self.header:
-            tmp_row.append(loc_args[h])
-        self.rows_with_genes.append(tmp_row)
-        # If we have an output file to write (which is just the filtered bed file) then write that
-        if self.output_bed_file:
-            self.output_bed_file.write(self.cur_line)
+    def get_cache_settings(self) -> dict:
+        settings = super().get_cache_settings()
+        settings.update({'hdr_idx': self.hdr_idx})
+        return settings
+
+    def assign_locations_to_genes(self):
+        super().assign_locations_to_genes()
+        if self.output_bed_file and len(self.gene_annot_df) > 0:
+            self.save_filtered_bed(self.output_bed_file)
+
+    @timed('save')
+    def save_filtered_bed(self, filename: str) -> None:
+        """
+        Writes the peaks that were assigned to at least one gene to a bed file, each peak once. Lines are copied as
+        they are, in large blocks, gzipped if filename ends with .gz. After a memory budgeted run the spilled pairs are
+        read back one chunk of peaks at a time.
+
+        Peaks are written in the order of the input file. For an unsorted input the matched (sorted) peaks are mapped
+        back to their input lines with input_order and the original file is copied instead of the sorted one.
+
+        Parameters
+        ----------
+        filename:   str: path to the filtered bed file
+        """
+        if self.input_order is not None:
+            input_matched = np.zeros(len(self.input_order), dtype=bool)
+            input_matched[self.input_order] = self.get_matched_peaks()
+            with open(self.filename, 'rb', buffering=BLOCK_SIZE) as bed_file, open_output(filename) as output:
+                # Blank lines were dropped by the sort, so they aren't counted as peaks here either
+                output.writelines(compress((line for line in bed_file if line.strip()), input_matched))
+            self.stats.add('filtered_peaks_written', int(input_matched.sum()))
+            return
+        num_written = 0
+        with open(self.get_sorted_filename(), 'rb', buffering=BLOCK_SIZE) as bed_file, \
+                open_output(filename) as output:
+            if self.pair_spill is None:
+                loc_idx = self.get_assignment_pairs()[0]
+                matched = np.zeros(int(loc_idx.max()) + 1 if len(loc_idx) else 0, dtype=bool)
+                matched[loc_idx] = True
+                output.writelines(compress(bed_file, matched))
+                num_written = int(matched.sum())
+            else:
+                self.pair_spill.rewind()
+                offset = 0
+                while True:
+                    lines = list(islice(bed_file, self.chunk_rows))
+                    if not lines:
+                        break
+                    matched = np.zeros(len(lines), dtype=bool)
+                    matched[self.pair_spill.take_before(offset + len(lines))['loc_idx'] - offset] = True
+                    output.writelines(compress(lines, matched))
+                    num_written += int(matched.sum())
+                    offset += len(lines)
+        self.stats.add('filtered_peaks_written', num_written)
+
+    def get_matched_peaks(self) -> np.ndarray:
+        """ Whether each peak of the sorted bed file was assigned to at least one gene (spilled pairs are streamed). """
+        matched = np.zeros(len(self.input_order), dtype=bool)
+        if self.pair_spill is None:
+            matched[self.get_assignment_pairs()[0]] = True
+        else:
+            self.pair_spill.rewind()
+            for limit in range(self.chunk_rows, len(matched) + self.chunk_rows, self.chunk_rows):
+                matched[self.pair_spill.take_before(limit)['loc_idx']] = True
+        return matched
+
+    @timed('sort_input')
+    def get_sorted_filename(self) -> str:
+        """
+        Checks (one vectorised pass over the chr and start columns) that the bed file is sorted in the canonical
+        chromosome order (the same as the annotation). If it isn't, the file is sorted into a temporary file (on disk
+        if it is larger than sort_memory) which is removed when this object is deleted. The sort is stable, so the
+        input line of each sorted peak is kept in input_order (used to write the filtered bed in input order).
+
+        Returns
+        -------
+        str: path to the sorted file (the original filename if it was already sorted)
+        """
+        if self.sorted_filename is not None:
+            return self.sorted_filename
+        bed_df = pd.read_csv(self.filename, sep='\t', header=None, usecols=[self.chr_idx, self.start_idx],
+                             dtype={self.chr_idx: str})
+        chr_codes = self.get_chr_codes(bed_df[self.chr_idx].str.strip().values)
+        if is_sorted(chr_codes, bed_df[self.start_idx].values):
+            self.sorted_filename = self.filename
+        else:
+            self.input_order = get_sort_order(chr_codes, bed_df[self.start_idx].values)
+            self.sorted_filename = self.sort_input_file(self.chr_idx, self.start_idx)
+        return self.sorted_filename
+
+    @timed('read_locations')
+    def read_locations(self) -> pd.DataFrame:
+        """ Reads the bed file into a DataFrame of locations (one row per location, see Epi2Gene._assign_values). """
+        bed_df = pd.read_csv(self.get_sorted_filename(), sep='\t', header=None, dtype=str, keep_default_na=False)
+        return self.format_locations(bed_df)
+
+    def iter_location_chunks(self, chunk_rows: int):
+        """ Reads the sorted bed file in chunks (same format as read_locations, peak_idx continues across chunks). """
+        offset = 0
+        # Readers are only context managers from pandas 1.2 (Python 3.7), so close it ourselves
+        reader = pd.read_csv(self.get_sorted_filename(), sep='\t', header=None, dtype=str, keep_default_na=False,
+                             chunksize=chunk_rows)
+        try:
+            for bed_df in reader:
+                yield self.format_locations(bed_df, offset)
+                offset += len(bed_df)
+        finally:
+            reader.close()
+
+    def format_locations(self, bed_df: pd.DataFrame, offset=0) -> pd.DataFrame:
+        """ Picks out the header columns of the bed file, offset is the peak_idx of the first row. """
+        loc_df = pd.DataFrame({'peak_idx': np.arange(offset, offset + len(bed_df)), 'gene_idx': -1})
+        for i, h in enumerate(self.hdr_idx):
+            loc_df[self.header[i + 2]] = bed_df[int(h)].str.strip().values
+        loc_df['width'] = loc_df[self.loc_end_col].astype(np.int64) - loc_df[self.loc_start_col].astype(np.int64)
+        return loc_df
 
@@ -0,0 +1,149 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+"""
+Opt-in cache of assignment results. A result is the (location, gene) index pairs of a run, keyed on a hash of the
+input file, the gene annotation and every setting that changes the assignment. On a hit the pairs are loaded and the
+outputs are rebuilt from them rather than running the assignment again.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+from scie2g.memory import PAIR_DTYPE, parse_memory
+
+# Bump when the way results are computed or stored changes, so old entries are never used
+CACHE_VERSION = 1
+
+
+def hash_file(filename: str, block_size=1024 * 1024) -> str:
+    """ sha256 of a file's contents, read in blocks. """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_df(df: pd.DataFrame) -> str:
+    """ sha256 of a DataFrame's column names and values (the index is ignored). """
+    digest = hashlib.sha256(json.dumps([str(c) for c in df.columns]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+class ResultCache:
+
+    """
+    Directory of .npy files, one per result, holding the pairs as PAIR_DTYPE. Reading an entry updates its
+    modification time and the least recently used entries are removed once the directory is larger than max_size.
+    """
+
+    def __init__(self, cache_dir: str, max_size='1G'):
+        self.cache_dir, self.max_size = cache_dir, parse_memory(max_size)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, input_hash: str, annotation_hash: str, settings: dict) -> str:
+        """
+        Key of a result.
+
+        Parameters
+        ----------
+        input_hash:         str: hash of the input file (see hash_file)
+        annotation_hash:    str: hash of the gene annotation (see hash_df)
+        settings:           dict: every other setting that changes the assignment, values must be JSON serialisable
+
+        Returns
+        -------
+        str: hex digest
+        """
+        content = json.dumps({'version': CACHE_VERSION, 'input': input_hash, 'annotation': annotation_hash,
+                              'settings': settings}, sort_keys=True, default=str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.npy')
+
+    def get(self, key: str):
+        """ Pairs stored for key (None if there are none), marks the entry as recently used. """
+        path = self.get_path(key)
+        try:
+            pairs = np.load(path)
+        except (OSError, ValueError):
+            # Missing, or a partial/corrupt file left by another process
+            return None
+        if pairs.dtype != PAIR_DTYPE:
+            return None
+        os.utime(path)
+        return pairs
+
+    def put(self, key: str, loc_idx: np.ndarray, gene_idx: np.ndarray) -> None:
+        """ Stores the pairs for key (written to a temporary file then moved so readers never see part of it). """
+        pairs = np.empty(len(loc_idx), dtype=PAIR_DTYPE)
+        pairs['loc_idx'], pairs['gene_idx'] = loc_idx, gene_idx
+        fd, tmp_path = tempfile.mkstemp(prefix='.scie2g_', suffix='.npy', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, pairs)
+            os.replace(tmp_path, self.get_path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def get_entries(self) -> list:
+        """ (modification time, size, path) of each entry, least recently used first. """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy') and not name.startswith('.'):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    def size(self) -> int:
+        return sum(e[1] for e in self.get_entries())
+
+    def evict(self) -> None:
+        """ Removes the least recently used entries until the cache is within max_size. """
+        if self.max_size is None:
+            return
+        entries = self.get_entries()
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self) -> None:
+        for mtime, size, path in self.get_entries():
+            os.remove(path)
+
+    def __len__(self):
+        return len(self.get_entries())
@@ -0,0 +1,135 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+"""
+Canonical chromosome names and integer codes shared by the annotation and the input files.
+
+UCSC (chr1, chrM), Ensembl (1, MT) and RefSeq (NC_000001.11) names are all mapped to the same canonical name and
+then to a small integer code. Codes are ordered numerically for numbered chromosomes, then the sex chromosomes,
+then the mitochondrion, then anything else (scaffolds, patches) in the order they were first seen (see other_names).
+"""
+
+import re
+import threading
+import numpy as np
+import pandas as pd
+
+
+# RefSeq accessions of the primary assembly chromosomes for human (GRCh37/38) and mouse (GRCm38/39)
+REFSEQ_ALIASES = {f'NC_0000{i:02d}': str(i) for i in range(1, 23)}
+REFSEQ_ALIASES.update({'NC_000023': 'X', 'NC_000024': 'Y', 'NC_012920': 'MT', 'NC_001807': 'MT'})
+REFSEQ_ALIASES.update({f'NC_0000{i + 66:02d}': str(i) for i in range(1, 20)})
+REFSEQ_ALIASES.update({'NC_000086': 'X', 'NC_000087': 'Y', 'NC_005089': 'MT'})
+
+# Order of the named chromosomes (after the numbered chromosomes)
+NAMED_CHRS = ['X', 'Y', 'W', 'Z', 'MT']
+NAMED_CHR_CODE = 1000
+OTHER_CHR_CODE = 2000
+
+# UCSC style names for scaffolds e.g. chrUn_KI270302v1 or chr1_KI270706v1_random are KI270302.1 in Ensembl
+UCSC_SCAFFOLD = re.compile(r'^(?:\w+_)?([A-Z]{2}\d+)v(\d+)(?:_random|_alt|_fix)?$')
+
+
+def canonical_chr_name(name) -> str:
+    """
+    Maps UCSC, Ensembl and RefSeq chromosome names to one canonical (Ensembl style) name.
+
+    Parameters
+    ----------
+    name:       str: the chromosome name e.g. chr1, 1, NC_000001.11, chrM, MT
+
+    Returns
+    -------
+    str: canonical name e.g. 1, X, MT
+    """
+    name = str(name).replace('"', '').strip()
+    accession = name.split('.')[0]
+    if accession in REFSEQ_ALIASES:
+        return REFSEQ_ALIASES[accession]
+    if name[:3].lower() == 'chr':
+        name = name[3:]
+    if name.upper() in ['M', 'MT']:
+        return 'MT'
+    if name.upper() in NAMED_CHRS:
+        return name.upper()
+    if name.isdigit():
+        return str(int(name))
+    scaffold = UCSC_SCAFFOLD.match(name)
+    if scaffold:
+        return f'{scaffold.group(1)}.{scaffold.group(2)}'
+    return name
+
+
+class ChromosomeIndex:
+
+    """
+    Interns chromosome names to integer codes. The same raw name always gets the same code so the annotation and the
+    inputs can be compared as small ints, and sorting on the codes gives the canonical chromosome order.
+    """
+
+    def __init__(self):
+        self.raw_codes = {}     # Raw name -> code (cache so we only canonicalise each name once)
+        self.other_codes = {}   # Canonical name -> code for chromosomes that aren't numbered or named
+        self.names = {}         # Code -> canonical name
+        self.lock = threading.Lock()
+
+    def code(self, name) -> int:
+        """ Integer code of a chromosome name. """
+        code = self.raw_codes.get(name)
+        if code is None:
+            code = self._intern(name)
+        return code
+
+    def codes(self, names) -> np.ndarray:
+        """ Vectorised version of code, each distinct name is only looked up once. """
+        inverse, uniques = pd.factorize(np.asarray(names))
+        codes = np.array([self.code(u) for u in uniques] + [-1], dtype=np.int64)
+        # factorize gives -1 for missing values, these map onto the trailing -1 (no chromosome)
+        return codes[inverse]
+
+    def name(self, code: int) -> str:
+        """ Canonical name for a code. """
+        return self.names.get(code)
+
+    def other_names(self) -> list:
+        """
+        Canonical names of the chromosomes that aren't numbered or named, in code order. This order depends on what
+        the process has seen so far, anything that stores positions in sorted order (e.g. cached results) must include
+        it.
+        """
+        with self.lock:
+            return list(self.other_codes)
+
+    def _intern(self, name) -> int:
+        canonical = canonical_chr_name(name)
+        with self.lock:
+            if canonical.isdigit() and int(canonical) < NAMED_CHR_CODE:
+                code = int(canonical)
+            elif canonical in NAMED_CHRS:
+                code = NAMED_CHR_CODE + NAMED_CHRS.index(canonical)
+            else:
+                code = self.other_codes.get(canonical)
+                if code is None:
+                    code = OTHER_CHR_CODE + len(self.other_codes)
+                    self.other_codes[canonical] = code
+            self.names[code] = canonical
+            self.raw_codes[name] = code
+        return code
+
+
+# Shared by every annotation and input so the codes are always comparable
+CHROMOSOMES = ChromosomeIndex()
@@ -0,0 +1,251 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+"""
+Coverage tracks (bedGraph e.g. from ATAC or ChIP-seq) as input. Rather than assigning locations to genes, the signal
+in each gene's window (the same windows as in_promotor and overlaps_gene, see gene_windows) is summarised.
+
+The track is read one chromosome at a time, each chromosome is turned into cumulative sums of the signal and of the
+covered bases (so the signal in any window is two lookups) and a sparse table of maxima (so the max in any window
+is two lookups), every gene on that chromosome is then done at once with searchsorted.
+
+    cov = Coverage('atac.bedGraph', overlap_method='in_promoter')
+    cov.set_annotation_from_file('hsapiens_gene_ensembl-GRCh38.p13.csv')
+    signal_df = cov.assign_signal_to_genes()
+"""
+
+import gzip
+import os
+from typing import Tuple
+import numpy as np
+import pandas as pd
+
+from scie2g.base import Epi2Gene, Epi2GeneException
+from scie2g.index import gene_windows
+from scie2g.stats import timed
+
+# Lines of the bedGraph read at once
+COVERAGE_CHUNK_ROWS = 1000000
+# Columns added to the annotation in the output
+SIGNAL_COLUMNS = ['window_start', 'window_end', 'mean_signal', 'max_signal', 'total_signal', 'covered_bases']
+
+
+def open_input(filename: str):
+    """ Opens a text file for reading, gzipped files (ending in .gz) are decompressed. """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt')
+    return open(filename, 'r')
+
+
+def count_header_lines(filename: str) -> int:
+    """ Number of track, browser and comment lines at the start of a bedGraph (optionally gzipped). """
+    count = 0
+    with open_input(filename) as f:
+        for line in f:
+            if not line.startswith(('track', 'browser', '#')):
+                break
+            count += 1
+    return count
+
+
+def iter_chromosomes(filename: str, chunk_rows=COVERAGE_CHUNK_ROWS):
+    """
+    Reads a bedGraph chunk_rows lines at a time and yields the intervals of one chromosome at a time, so only one
+    chromosome is held in memory. The lines of each chromosome must be together (as in any sorted bedGraph).
+
+    Yields
+    ------
+    chromosome, starts, ends, values: chromosome name and np.arrays of its intervals (in file order)
+    """
+    cur_chr, pieces, seen = None, [], set()
+
+    def chromosome():
+        df = pd.concat(pieces, ignore_index=True)
+        return cur_chr, df[1].values.astype(np.int64), df[2].values.astype(np.int64), df[3].values.astype(np.float64)
+    # Readers are only context managers from pandas 1.2 (Python 3.7), so close it ourselves
+    reader = pd.read_csv(filename, sep='\t', header=None, usecols=[0, 1, 2, 3], dtype={0: str},
+                         skiprows=count_header_lines(filename), chunksize=chunk_rows)
+    try:
+        for df in reader:
+            chrs = np.asarray(df[0].values, dtype=object)
+            # Start of each run of lines on the same chromosome in this chunk
+            breaks = np.concatenate([[0], np.nonzero(chrs[1:] != chrs[:-1])[0] + 1, [len(chrs)]])
+            for start, end in zip(breaks[:-1], breaks[1:]):
+                if chrs[start] != cur_chr:
+                    if cur_chr is not None:
+                        yield chromosome()
+                    if chrs[start] in seen:
+                        raise Epi2GeneException(f'iter_chromosomes: the lines for {chrs[start]} are not together in '
+                                                f'{filename}, please sort it first (e.g. sort -k1,1 -k2,2n)')
+                    cur_chr, pieces = chrs[start], []
+                    seen.add(cur_chr)
+                pieces.append(df.iloc[start: end])
+    finally:
+        reader.close()
+    if cur_chr is not None:
+        yield chromosome()
+
+
+def build_max_table(values: np.ndarray) -> list:
+    """ Sparse table of maxima: level k holds the max of values[i: i + 2 ** k] for each i. """
+    table = [values]
+    width = 1
+    while 2 * width <= len(values):
+        prev = table[-1]
+        table.append(np.maximum(prev[:-width], prev[width:]))
+        width *= 2
+    return table
+
+
+def query_max_table(table: list, first: np.ndarray, last: np.ndarray) -> np.ndarray:
+    """ Max of values[first: last] for each range using a sparse table (-inf for empty ranges). """
+    maxes = np.full(len(first), -np.inf)
+    lengths = last - first
+    non_empty = np.nonzero(lengths > 0)[0]
+    levels = np.floor(np.log2(lengths[non_empty])).astype(np.int64)
+    for level in np.unique(levels):
+        ids = non_empty[levels == level]
+        # Two (overlapping) blocks of 2 ** level cover the range
+        maxes[ids] = np.maximum(table[level][first[ids]], table[level][last[ids] - (1 << int(level))])
+    return maxes
+
+
+class CoverageTrack:
+
+    """
+    The intervals of one chromosome of a coverage track, with cumulative sums of the signal and covered bases and a
+    sparse table of maxima. Bases that aren't in any interval have a signal of 0.
+    """
+
+    def __init__(self, starts: np.ndarray, ends: np.ndarray, values: np.ndarray):
+        if np.any(np.diff(starts) < 0):
+            order = np.argsort(starts, kind='stable')
+            starts, ends, values = starts[order], ends[order], values[order]
+        if np.any(ends[:-1] > starts[1:]):
+            raise Epi2GeneException('CoverageTrack: the coverage track has overlapping intervals, bedGraph intervals '
+                                    'are expected not to overlap.')
+        self.starts, self.ends, self.values = starts, ends, values
+        self.lengths = ends - starts
+        # Signal and covered bases before the start of each interval
+        self.cum_signal = np.concatenate([[0.0], np.cumsum(values * self.lengths)])
+        self.cum_covered = np.concatenate([[0], np.cumsum(self.lengths)])
+        self.max_table = build_max_table(values)
+
+    def cumulative(self, positions: np.ndarray, cum: np.ndarray, weights) -> np.ndarray:
+        """ Sum of weights over the bases before each position (cum is the cumulative sum at each interval start). """
+        # Last interval starting at or before each position
+        idx = np.searchsorted(self.starts, positions, side='right') - 1
+        clipped = np.maximum(idx, 0)
+        partial = np.clip(positions - self.starts[clipped], 0, self.lengths[clipped]) * weights[clipped]
+        return np.where(idx >= 0, cum[clipped] + partial, 0)
+
+    def window_signal(self, lo: np.ndarray, hi: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Signal in windows of bases lo (inclusive) to hi (exclusive).
+
+        Returns
+        -------
+        total_signal, covered_bases, max_signal: np.arrays, the max includes the 0 signal of uncovered bases
+        """
+        total = self.cumulative(hi, self.cum_signal, self.values) - self.cumulative(lo, self.cum_signal, self.values)
+        ones = np.ones(len(self.starts), dtype=np.int64)
+        covered = self.cumulative(hi, self.cum_covered, ones) - self.cumulative(lo, self.cum_covered, ones)
+        # Intervals that end after lo and start before hi
+        first = np.searchsorted(self.ends, lo, side='right')
+        last = np.searchsorted(self.starts, hi, side='left')
+        maxes = query_max_table(self.max_table, first, last)
+        maxes = np.where(covered < hi - lo, np.maximum(maxes, 0), maxes)
+        return total, covered, maxes
+
+
+class Coverage(Epi2Gene):
+
+    """
+    Coverage track input (bedGraph: chr, start, end, value, optionally gzipped). Each gene gets the mean, max and
+    total signal in its window (see gene_windows) and the number of bases in the window with a value.
+    """
+
+    def __init__(self, filename: str, overlap_method='in_promoter', buffer_after_tss=500, buffer_before_tss=2500,
+                 buffer_gene_overlap=500, gene_column_order=None, gene_start=None, gene_end=None, gene_chr=None,
+                 gene_direction=None, gene_name=None, chunk_rows=COVERAGE_CHUNK_ROWS, compact_annotation=False):
+        super().__init__(filename, None, overlap_method=overlap_method,
+                         buffer_after_tss=buffer_after_tss,
+                         buffer_before_tss=buffer_before_tss,
+                         buffer_gene_overlap=buffer_gene_overlap,
+                         gene_column_order=gene_column_order,
+                         gene_start=gene_start, gene_end=gene_end, gene_chr=gene_chr,
+                         gene_direction=gene_direction, gene_name=gene_name, compact_annotation=compact_annotation)
+        self.chunk_rows = chunk_rows
+        self.gene_signal_df = None
+        if not os.path.isfile(self.filename):
+            self.u.err_p(['Coverage: your filename does not exist!', self.filename])
+            raise Epi2GeneException('Parsing arguments failed. Please read detailed error message printed to STDOUT.')
+
+    def get_gene_window_bases(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        First base and the base after the last of each gene's window (clipped at the chromosome start). These are the
+        bases a location would be assigned to the gene for: the one base location [b, b + 1) overlaps the window
+        [lo, hi] (see gene_windows) if b <= hi and b + 1 >= lo, i.e. the bases lo - 1 to hi.
+        """
+        _, starts, ends, directions = self.get_gene_arrays()
+        lo, hi = gene_windows(starts, ends, directions, self.overlap_method, self.buffer_before_tss,
+                              self.buffer_after_tss, self.buffer_gene_overlap)
+        return np.maximum(lo - 1, 0), np.maximum(hi + 1, 0)
+
+    @timed('coverage')
+    def assign_signal_to_genes(self) -> pd.DataFrame:
+        """
+        Summarises the signal of the coverage track in each gene's window, the track is streamed one chromosome at a
+        time.
+
+        Returns
+        -------
+        DataFrame: the annotation columns (column_order) and window_start, window_end (bed style), mean_signal,
+        max_signal, total_signal and covered_bases. Genes on chromosomes without coverage have a signal of 0.
+        """
+        if len(self.gene_annot_df) < 1:
+            self.u.err_p(['assign_signal_to_genes: no annotation, please set one before running.'])
+            return None
+        lo, hi = self.get_gene_window_bases()
+        total, covered, maxes = np.zeros(self.num_genes), np.zeros(self.num_genes, dtype=np.int64), \
+            np.zeros(self.num_genes)
+        for chromosome, starts, ends, values in iter_chromosomes(self.filename, self.chunk_rows):
+            self.stats.add('coverage_intervals_read', len(starts))
+            self.stats.add('chromosomes_read')
+            gene_range = self.chr_gene_ranges.get(self.chromosomes.code(chromosome))
+            if gene_range is None:
+                continue
+            genes = slice(*gene_range)
+            total[genes], covered[genes], maxes[genes] = CoverageTrack(starts, ends, values).window_signal(
+                lo[genes], hi[genes])
+        signal_df = self.gene_annot_df[self.column_order].reset_index(drop=True)
+        for column, values in zip(SIGNAL_COLUMNS, [lo, hi, total / np.maximum(hi - lo, 1), maxes, total, covered]):
+            signal_df[column] = values
+        self.gene_signal_df = signal_df
+        return signal_df
+
+    def assign_locations_to_genes(self):
+        """ For coverage tracks the signal is assigned to genes instead (see assign_signal_to_genes). """
+        self.assign_signal_to_genes()
+
+    @timed('save')
+    def save_loc_to_csv(self, filename: str, keep_unassigned=False) -> None:
+        """ Saves the signal of each gene, keep_unassigned also keeps genes without any coverage in their window. """
+        signal_df = self.gene_signal_df if self.gene_signal_df is not None else self.assign_signal_to_genes()
+        if not keep_unassigned:
+            signal_df = signal_df[signal_df['covered_bases'].values > 0]
+        self.u.save_df(signal_df, filename)
@@ -23,9 +23,14 @@ from collections import defaultdict
 import os
 import pandas as pd
 import numpy as np
-from tqdm import tqdm
 
 from scie2g import Epi2Gene, Epi2GeneException
+from scie2g.base import open_output
+from scie2g.sorting import get_sort_order, is_sorted
+from scie2g.stats import timed
+
+# Lines formatted at once by convert_to_bed
+BED_CHUNK_ROWS = 500000
 
 
 class Csv(Epi2Gene):
@@ -37,7 +42,13 @@ class Csv(Epi2Gene):
                  buffer_before_tss=2500,
                  buffer_gene_overlap=500,
                  gene_column_order=None,
-                 sep=','
+                 sep=',',
+                 gene_start=None, gene_end=None, gene_chr=None, gene_direction=None, gene_name=None,
+                 sort_memory=512 * 1024 * 1024,
+                 max_memory=None,
+                 cache_dir=None,
+                 cache_size='1G',
+                 compact_annotation=False
                  ):
         self.chr_str, self.start_str, self.end_str, self.value_str = chr_str, start, end, value
         header = ['idx', self.chr_str, self.start_str, self.end_str, 'gene_idx', value]
@@ -48,17 +59,21 @@ class Csv(Epi2Gene):
                          buffer_after_tss=buffer_after_tss,
                          buffer_before_tss=buffer_before_tss,
                          buffer_gene_overlap=buffer_gene_overlap,
-                         direction_aware=direction_aware, gene_column_order=gene_column_order
+                         direction_aware=direction_aware, gene_column_order=gene_column_order,
+                         gene_start=gene_start, gene_end=gene_end, gene_chr=gene_chr,
+                         gene_direction=gene_direction, gene_name=gene_name, sort_memory=sort_memory,
+                         max_memory=max_memory, cache_dir=cache_dir, cache_size=cache_size,
+                         compact_annotation=compact_annotation
                          )
         self.filename = filename
         # Set to only look for an in promoter region
-        self.location_to_gene_dict, self.loc_idxs_np, self.gene_to_location_dict = defaultdict(list), \
-                                                                                   None, \
-                                                                                   defaultdict(list)
+        self.location_to_gene_dict, self.gene_to_location_dict = defaultdict(list), defaultdict(list)
         self.rows = []
         self.rows_with_genes = []
         self.header = header
         self.sep = sep
+        self.sorted_filename = None  # Sorted copy of the csv (only made for memory budgeted runs)
+        self.loc_chr_col, self.loc_start_col, self.loc_end_col = self.chr_str, self.start_str, self.end_str
         # Check parameters
         try:
             if not self.check_args():
@@ -113,102 +128,131 @@ class Csv(Epi2Gene):
             return False
         return True
 
-    def convert_to_bed(self, df: pd.DataFrame, filename: str, track_name: str, pvalue_str=None, name_str=None):
-        chrs, starts, ends, values = df[self.chr_str].values, df[self.start_str].values, df[self.end_str].values, \
-                                                 df[self.value_str].values
+    @timed('save')
+    def convert_to_bed(self, df: pd.DataFrame, filename: str, track_name: str, pvalue_str=None, name_str=None,
+                       chunk_rows=BED_CHUNK_ROWS):
+        """
+        Writes the locations as a tab separated bed file (BED9 with a track line) that can be viewed in IGV, gzipped
+        if filename ends with .gz. The columns are chr, start, end, name, score, strand (from a direction column if
+        there is one, see get_location_strands, otherwise .), thickStart, thickEnd and itemRgb. The lines are built
+        column-wise, chunk_rows at a time.
+
+        Parameters
+        ----------
+        df:             DataFrame: the locations (e.g. loc_df)
+        filename:       str: path to the bed file
+        track_name:     str: name (and description) of the track
+        pvalue_str:     str: column with p values, if set the score is -log10(p) otherwise the value column is used
+                        (missing scores are written as .)
+        name_str:       str: column to use as the name, otherwise the value column is used
+        chunk_rows:     int: number of lines formatted at once
+        """
         if pvalue_str:
-            vals = df[pvalue_str].values
-            min_value = 0
-            if len(np.nonzero(vals)) > 1:
-                min_value = np.min(vals[np.nonzero(vals)])
-            vals = -1 * np.log10(vals + min_value)
+            vals = df[pvalue_str].values.astype(float)
+            # Offset by the smallest non zero p value so that p values of 0 don't give an infinite score (missing p
+            # values are neither, they stay missing)
+            nonzero = vals[vals > 0]
+            min_value = np.min(nonzero) if len(nonzero) > 0 and np.any(vals == 0) else 0
+            scores = pd.Series(-1 * np.log10(vals + min_value), index=df.index)
         else:
-            vals = values
-        if name_str:    # Override using the name
-            values = df[name_str].values
-        i = 0
-        with open(filename, 'w+') as f:
-            f.write(f'track name="{track_name}" description="{track_name}" visibility=2 itemRgb="On"\n')
-            for row in df.values:
-                # Assign the row values to variables
-                c = '0,0,255'
-                # chr start end name score
-                f.write(f'{chrs[i]}    {starts[i]}    {ends[i]}    {values[i]}    {vals[i]}    {starts[i]}    '
-                        f'{ends[i]}    {c}\n')
-                i += 1
-
-    def format_df(self, df):
-        """ Format the csv & sort for efficiency """
-        # Also ensure the start and ends are integers
-        convert_dict = {self.start_str: int,
-                        self.end_str: int,
-                        self.chr_str: str}
-        df = df.astype(convert_dict)
-
-        # Lastly, we want to at chr to all the seqnames so that they are in ncbi format
-        if 'chr' not in str(df[self.chr_str].values[0]):
-            df['chr'] = df[self.chr_str].astype(str)
+            scores = df[self.value_str]
+        # Missing scores are written as .
+        scores = scores.astype(str).where(scores.notna(), '.')
+        names = df[name_str] if name_str else df[self.value_str]
+        strands = self.get_location_strands(df)
+        strands = pd.Series(np.select([strands > 0, strands < 0], ['+', '-'], '.'), index=df.index)
+        columns = [df[self.chr_str], df[self.start_str], df[self.end_str], names, scores, strands,
+                   df[self.start_str], df[self.end_str]]
+        with open_output(filename) as f:
+            f.write(f'track name="{track_name}" description="{track_name}" visibility=2 itemRgb="On"\n'.encode())
+            for i in range(0, len(df), chunk_rows):
+                chunk = [c.iloc[i: i + chunk_rows].astype(str) for c in columns]
+                lines = chunk[0].str.cat(chunk[1:], sep='\t') + '\t0,0,255\n'
+                f.write(''.join(lines.values).encode())
+
+    def get_usecols(self) -> list:
+        """ The columns of the csv that are used: chr, start, end, value and header_extra. """
+        return list(dict.fromkeys([self.chr_str, self.start_str, self.end_str, self.value_str] +
+                                  list(self.header_extra)))
+
+    def read_csv(self, filename=None, **kwargs) -> pd.DataFrame:
+        """
+        Reads only the columns we use (see get_usecols) from the csv, chromosomes are read as strings. Any kwargs
+        (e.g. chunksize) are passed to pd.read_csv.
+        """
+        return pd.read_csv(filename or self.filename, sep=self.sep, usecols=self.get_usecols(),
+                           dtype={self.chr_str: str}, **kwargs)
+
+    @timed('format_input')
+    def format_df(self, df: pd.DataFrame) -> dict:
+        """
+        Typed columns of the csv in the canonical chromosome order (same as the annotation). Only the sort order is
+        worked out, each column is then taken in that order as an array rather than copying the whole frame.
+
+        Returns
+        -------
+        dict: chr, chr_code, start, end and value arrays, and extra: dict of the header_extra arrays
+        """
+        chrs = df[self.chr_str].astype(str).values
+        starts = df[self.start_str].values.astype(np.int64)
+        chr_codes = self.get_chr_codes(chrs)
+        # Only sort if we need to
+        order = None if is_sorted(chr_codes, starts) else get_sort_order(chr_codes, starts)
+
+        def take(values):
+            return values if order is None else values[order]
+        return {'chr': take(chrs), 'chr_code': take(chr_codes), 'start': take(starts),
+                'end': take(df[self.end_str].values.astype(np.int64)), 'value': take(df[self.value_str].values),
+                'extra': {h: take(df[h].values) for h in self.header_extra}}
+
+    def get_cache_settings(self) -> dict:
+        settings = super().get_cache_settings()
+        settings.update({'sep': self.sep, 'header_extra': self.header_extra})
+        return settings
+
+    @timed('read_locations')
+    def read_locations(self) -> pd.DataFrame:
+        """ Reads the csv into a DataFrame of locations (one row per location in sorted order). """
+        return self.format_locations(self.format_df(self.read_csv()))
+
+    def get_sorted_filename(self) -> str:
+        """
+        The csv sorted in the canonical chromosome order, needed to read it in chunks. If the file isn't sorted it is
+        sorted into a temporary file (on disk if it is larger than sort_memory).
+        """
+        if self.sorted_filename is not None:
+            return self.sorted_filename
+        df = pd.read_csv(self.filename, sep=self.sep, usecols=[self.chr_str, self.start_str],
+                         dtype={self.chr_str: str})
+        if is_sorted(self.get_chr_codes(df[self.chr_str].values), df[self.start_str].values):
+            self.sorted_filename = self.filename
         else:
-            df['chr'] = df[self.chr_str].values
-
-        df = df.sort_values(['chr', self.start_str], ascending=[True, True])
-        return df
-
-    def _assign_values(self):
-        # Since the output file is in a simple csv format we can just read in using pandas
-        df = pd.read_csv(self.filename, sep=self.sep)
-
-        df = self.format_df(df)
-
-        self.check_chr(df['chr'][0], self.gene_annot_values[0][self.gene_chr])
-
-        # Now we are ready to iterate through and annotate our DMRs to genes
-        num_genes = len(self.gene_annot_values)
-
-        chrs, starts, ends, values = df['chr'].values, df[self.start_str].values, df[self.end_str].values, \
-                                                 df[self.value_str].values
-        header_idxs = {}
-        i = 0
-        for c in df.columns:
-            if c in self.header_extra:
-                header_idxs[c] = i
-            i += 1
-
-        rows = df.values
-        for loc_idx in tqdm(range(len(df))):
-            # Assign the row values to variables
-            loc_chr, loc_start, loc_end, loc_value = chrs[loc_idx], starts[loc_idx], ends[loc_idx] + 1, values[loc_idx]
-            loc_start, loc_end = int(loc_start), int(loc_end)
-            self.cur_loc_idx = loc_idx
-
-            if self.cur_gene_idx >= num_genes:
-                self.u.warn_p(['_assign_values: \t Current gene index greater than our length of chrom starts. '
-                               'Returning. \n Filename: \t', self.filename])
-                break
-            # Add in the other header information the user has requested
-            loc_args = {'idx': loc_idx, self.chr_str: loc_chr, self.start_str: loc_start,
-                        self.end_str: loc_end, 'gene_idx': None, self.value_str: loc_value}
-            for h in self.header_extra:
-                loc_args[h] = rows[loc_idx][header_idxs[h]]
-
-            gene_chr, gene_start, gene_end, gene_direction = self.get_current_gene_params(loc_chr, loc_start, loc_end)
-
-            # Update row values
-            self.cur_loc_start, self.cur_loc_end = loc_start, loc_end
-
-            if loc_chr == gene_chr:
-                self.check_for_gene_match(gene_chr, gene_start, gene_end, gene_direction, loc_start,
-                                          loc_end, loc_args)
-            self.cur_loc_idx = loc_idx
-
-        # Create dataframe based on rows and columns
-        self.df = pd.DataFrame(self.rows, columns=self.header)
-
-    def update_loc_value(self, loc_args: dict):
-        # First we assign that this gene mapped to this location
-        self.assign_loc_value()
-        tmp_row = []
-        loc_args['gene_idx'] = self.cur_gene_idx  # Update the gene in-case we have changed this
-        for h in self.header:
-            tmp_row.append(loc_args[h])
-        self.rows_with_genes.append(tmp_row)
+            columns = list(pd.read_csv(self.filename, sep=self.sep, nrows=0).columns)
+            self.sorted_filename = self.sort_input_file(columns.index(self.chr_str), columns.index(self.start_str),
+                                                        sep=self.sep, header=True, suffix='.csv')
+        return self.sorted_filename
+
+    def iter_location_chunks(self, chunk_rows: int):
+        """ Reads the sorted csv in chunks (same format as read_locations, idx continues across chunks). """
+        offset = 0
+        # Readers are only context managers from pandas 1.2 (Python 3.7), so close it ourselves
+        reader = self.read_csv(self.get_sorted_filename(), chunksize=chunk_rows)
+        try:
+            for df in reader:
+                yield self.format_locations(self.format_df(df), offset)
+                offset += len(df)
+        finally:
+            reader.close()
+
+    def format_locations(self, columns: dict, offset=0) -> pd.DataFrame:
+        """ Builds the header columns from the columns returned by format_df, offset is the idx of the first row. """
+        loc_df = pd.DataFrame({'idx': np.arange(offset, offset + len(columns['chr']))})
+        loc_df[self.chr_str] = columns['chr']
+        loc_df[self.start_str] = columns['start']
+        loc_df[self.end_str] = columns['end'] + 1  # Csv ends are inclusive
+        loc_df['gene_idx'] = -1
+        loc_df[self.value_str] = columns['value']
+        for h in self.header_extra:
+            loc_df[h] = columns['extra'][h]
+        return loc_df
+
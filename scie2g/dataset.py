@@ -0,0 +1,231 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+"""
+Datasets split into many files, e.g. one file per chromosome or per sample and chromosome. Partitions are found by
+walking a directory, each is paired with the slice of the annotation on its chromosome and annotated on its own
+(streamed in chunks), so no step needs the whole dataset in memory. Outputs keep the layout of the input directory.
+
+Chromosomes are taken from the file or directory names: chr1.bed, sample1_chr1.bed, sample1/chrX.csv.gz or hive
+style directories (chrom=1/part-0.parquet). Partitions without a chromosome in their name are annotated against the
+whole annotation.
+"""
+
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+from scie2g.base import Epi2Gene, Epi2GeneException
+from scie2g.annotator import Annotator, AnnotationRun
+from scie2g.chromosomes import canonical_chr_name
+from scie2g.pipeline import prefetch
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+# File types that are read as partitions, and the separator of the text formats
+PARTITION_SEPS = {'.bed': '\t', '.bedgraph': '\t', '.tsv': '\t', '.txt': '\t', '.csv': ',', '.parquet': None}
+# Keys of hive style partition directories that hold the chromosome (e.g. chrom=chr1)
+CHR_KEYS = ['chr', 'chrom', 'chromosome', 'seqnames', 'seqname']
+CHR_NAME = re.compile(r'^chr[0-9A-Za-z]+$', re.IGNORECASE)
+# Locations read at once from each partition
+PARTITION_CHUNK_ROWS = 1000000
+
+
+def get_partition_type(filename: str) -> str:
+    """ File type of a partition (the extension, without .gz), None if it isn't a type we read. """
+    name = filename.lower()
+    name = name[:-3] if name.endswith('.gz') else name
+    ext = os.path.splitext(name)[1]
+    return ext if ext in PARTITION_SEPS else None
+
+
+def get_partition_chr(relpath: str):
+    """
+    Chromosome of a partition from its path (relative to the dataset), e.g. chr1.bed, sample1_chr1.bed or
+    chrom=1/part-0.parquet. The part closest to the file wins.
+
+    Returns
+    -------
+    str: canonical chromosome name (see chromosomes.py) or None
+    """
+    parts = relpath.replace(os.sep, '/').split('/')
+    for part in reversed(parts):
+        key, sep, value = part.partition('=')
+        if sep and key.lower() in CHR_KEYS:
+            return canonical_chr_name(value)
+        for token in re.split(r'[_.\-]', part):
+            if CHR_NAME.match(token):
+                return canonical_chr_name(token)
+    return None
+
+
+class Partition:
+
+    """ One file of a dataset: its path, the path relative to the dataset and its chromosome (or None). """
+
+    def __init__(self, path: str, relpath: str, chromosome=None):
+        self.path, self.relpath, self.chromosome = path, relpath, chromosome
+        self.file_type = get_partition_type(path)
+
+    def get_output_path(self, output_dir: str) -> str:
+        """ Output file for this partition, the same relative path in output_dir with a .csv extension. """
+        relpath = self.relpath[:-3] if self.relpath.lower().endswith('.gz') else self.relpath
+        return os.path.join(output_dir, os.path.splitext(relpath)[0] + '.csv')
+
+    def __repr__(self):
+        return f'Partition({self.relpath}, chromosome={self.chromosome})'
+
+
+def find_partitions(path: str) -> list:
+    """
+    Walks a dataset directory and finds the files to annotate (bed, bedGraph, tsv, csv, optionally gzipped, and
+    parquet), in a stable (sorted) order. Hidden files and directories are skipped.
+
+    Parameters
+    ----------
+    path:       str: dataset directory
+
+    Returns
+    -------
+    list of Partition
+    """
+    if not os.path.isdir(path):
+        raise Epi2GeneException(f'find_partitions: {path} is not a directory.')
+    partitions = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(('.', '_')))
+        for filename in sorted(files):
+            if filename.startswith(('.', '_')) or get_partition_type(filename) is None:
+                continue
+            file_path = os.path.join(root, filename)
+            relpath = os.path.relpath(file_path, path)
+            partitions.append(Partition(file_path, relpath, get_partition_chr(relpath)))
+    return partitions
+
+
+class PartitionedDataset:
+
+    """
+    A directory of partitions that is annotated as one input. Columns are given by name, or by position for files
+    without a header (bed and bedGraph files have no header, the default columns are 0, 1 and 2, other files use
+    chr, start and end). If strand_col is set and the Epi2Gene object is direction_aware, locations only get genes
+    on their own strand.
+    """
+
+    def __init__(self, path: str, chr_col=None, start_col=None, end_col=None, strand_col=None,
+                 chunk_rows=PARTITION_CHUNK_ROWS):
+        self.path, self.partitions = path, find_partitions(path)
+        self.chr_col, self.start_col, self.end_col, self.strand_col = chr_col, start_col, end_col, strand_col
+        self.chunk_rows = chunk_rows
+
+    def get_columns(self, partition: Partition) -> list:
+        """ chr, start and end column of a partition (names, or positions for files without a header). """
+        positional = partition.file_type in ['.bed', '.bedgraph']
+        defaults = [0, 1, 2] if positional else ['chr', 'start', 'end']
+        return [c if c is not None else d for c, d in zip([self.chr_col, self.start_col, self.end_col], defaults)]
+
+    def iter_chunks(self, partition: Partition):
+        """ Reads a partition in chunks of at most chunk_rows locations. """
+        if partition.file_type == '.parquet':
+            if pq is None:
+                raise Epi2GeneException(f'iter_chunks: pyarrow is needed to read parquet partitions '
+                                        f'({partition.relpath}), pip install pyarrow')
+            for batch in pq.ParquetFile(partition.path).iter_batches(batch_size=self.chunk_rows):
+                yield batch.to_pandas()
+            return
+        header = None if partition.file_type in ['.bed', '.bedgraph'] else 'infer'
+        # Readers are only context managers from pandas 1.2 (Python 3.7), so close it ourselves
+        reader = pd.read_csv(partition.path, sep=PARTITION_SEPS[partition.file_type], header=header, comment='#',
+                             chunksize=self.chunk_rows)
+        try:
+            for chunk in reader:
+                yield chunk
+        finally:
+            reader.close()
+
+    def get_annotation_slice(self, annotator: Annotator, partition: Partition):
+        """
+        Range of genes (in the sorted annotation) on the chromosome of a partition, (0, num_genes) if the partition
+        has no chromosome and (0, 0) if no genes are on its chromosome.
+        """
+        if partition.chromosome is None:
+            return 0, annotator.num_genes
+        code = int(annotator.chromosomes.codes([partition.chromosome])[0])
+        return annotator.chr_gene_ranges.get(code, (0, 0))
+
+    def annotate_partition(self, annotator: Annotator, partition: Partition, output_dir: str, keep_unassigned=False,
+                           setting=None) -> str:
+        """
+        Annotates one partition, streaming it in chunks, and writes the locations with their genes (same columns as
+        save_loc_to_csv) to its output file.
+
+        Returns
+        -------
+        str: path to the output file
+        """
+        output_path = partition.get_output_path(output_dir)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        first_gene, last_gene = self.get_annotation_slice(annotator, partition)
+        chr_col, start_col, end_col = self.get_columns(partition)
+        header = True
+        with open(output_path, 'w') as f:
+            for loc_df in prefetch(self.iter_chunks(partition)):
+                if last_gene > first_gene:
+                    run = annotator.run(loc_df, chr_col, start_col, end_col, self.strand_col, setting)
+                else:
+                    # No genes on this chromosome
+                    run = AnnotationRun(annotator, loc_df, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                                        annotator.get_setting(setting))
+                chunk_df = run.get_loc_df(keep_unassigned=keep_unassigned)
+                chunk_df.to_csv(f, index=False, header=header)
+                header = False
+        return output_path
+
+    def annotate(self, e2g: Epi2Gene, output_dir: str, workers=1, keep_unassigned=False, setting=None) -> list:
+        """
+        Annotates every partition with the annotation in e2g, at most workers partitions at a time, writing one
+        output per partition in output_dir (same layout as the dataset).
+
+        Parameters
+        ----------
+        e2g:                Epi2Gene: object with the annotation and overlap settings
+        output_dir:         str: directory for the outputs
+        workers:            int: maximum number of partitions annotated at once
+        keep_unassigned:    Keep locations that weren't assigned to a gene
+        setting:            dict: overlap settings to use instead of the ones on e2g (keys in SWEEP_PARAMS)
+
+        Returns
+        -------
+        list: output file of each partition (in the order of self.partitions)
+        """
+        # Read only copy of the annotation and index shared by the workers, the gene index is built once up front
+        annotator = Annotator(e2g)
+        annotator.get_gene_index(setting)
+        if workers <= 1:
+            outputs = [self.annotate_partition(annotator, p, output_dir, keep_unassigned, setting)
+                       for p in self.partitions]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                outputs = list(pool.map(lambda p: self.annotate_partition(annotator, p, output_dir, keep_unassigned,
+                                                                          setting), self.partitions))
+        e2g.stats.add('partitions_annotated', len(outputs))
+        return outputs
@@ -0,0 +1,195 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+"""
+Streaming GTF/GFF3 reader. The file is read in chunks and only the requested feature types (e.g. gene) are kept
+before their attributes are parsed, so a GENCODE GTF never has its exons, CDS and UTRs in memory.
+"""
+
+import bz2
+import csv
+import gzip
+import io
+import lzma
+import zipfile
+from urllib.parse import unquote
+import numpy as np
+import pandas as pd
+
+GFF_COLUMNS = ['seqname', 'source', 'feature', 'start', 'end', 'score', 'strand', 'frame', 'attributes']
+# Features kept by default, Ensembl GFF3 files also have ncRNA_gene and pseudogene records for genes
+DEFAULT_FEATURES = {'gtf': ['gene'], 'gff3': ['gene', 'ncRNA_gene', 'pseudogene']}
+# Attribute names for each output column, the first one found is used (for GFF3 these are for gene records)
+ATTRIBUTES = {'gtf': {'ensembl_gene_id': ['gene_id'],
+                      'external_gene_name': ['gene_name', 'gene'],
+                      'gene_biotype': ['gene_type', 'gene_biotype'],
+                      'ensembl_transcript_id': ['transcript_id'],
+                      'external_transcript_name': ['transcript_name'],
+                      'transcript_biotype': ['transcript_type', 'transcript_biotype']},
+              'gff3': {'ensembl_gene_id': ['gene_id', 'ID'],
+                       'external_gene_name': ['Name', 'gene_name', 'gene'],
+                       'gene_biotype': ['biotype', 'gene_biotype', 'gene_type']}}
+# In GFF3 transcripts point to their gene with Parent, and Name/ID/biotype are the transcript's
+GFF3_TRANSCRIPT_ATTRIBUTES = {'ensembl_gene_id': ['gene_id', 'Parent'],
+                              'external_gene_name': ['gene_name', 'gene'],
+                              'gene_biotype': ['gene_biotype', 'gene_type'],
+                              'ensembl_transcript_id': ['transcript_id', 'ID'],
+                              'external_transcript_name': ['Name', 'transcript_name'],
+                              'transcript_biotype': ['biotype', 'transcript_biotype', 'transcript_type']}
+GENE_FEATURES = ['gene', 'ncRNA_gene', 'pseudogene']
+GENE_COLUMNS = ['ensembl_gene_id', 'external_gene_name', 'gene_biotype']
+# Ensembl and RefSeq GFF3 IDs have the feature type as a prefix e.g. gene:ENSG00000223972 or gene-b0941
+ID_PREFIX = r'^(?:gene|transcript|rna)[:-]'
+
+
+def open_text(filename: str):
+    """ Opens a text file for reading, decompressing it by its extension (the same ones pandas infers). """
+    name = filename.lower()
+    if name.endswith('.gz'):
+        return gzip.open(filename, 'rt')
+    if name.endswith('.bz2'):
+        return bz2.open(filename, 'rt')
+    if name.endswith('.xz'):
+        return lzma.open(filename, 'rt')
+    if name.endswith('.zip'):
+        archive = zipfile.ZipFile(filename)
+        return io.TextIOWrapper(archive.open(archive.namelist()[0]))
+    return open(filename, 'r')
+
+
+def count_header_lines(filename: str) -> int:
+    """ Number of comment and directive lines (starting with #) at the start of a GTF/GFF3 file. """
+    count = 0
+    with open_text(filename) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            count += 1
+    return count
+
+
+def get_extension(filename: str) -> str:
+    """ Extension of a file ignoring any compression extension e.g. .gtf for genes.gtf.gz """
+    name = filename.lower()
+    for ext in ['.gz', '.zip', '.bz2', '.xz']:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name[name.rfind('.'):] if '.' in name else ''
+
+
+def is_gtf(filename: str) -> bool:
+    """ True for .gtf, .gff and .gff3 files (optionally compressed). """
+    return get_extension(filename) in ['.gtf', '.gff', '.gff3']
+
+
+def get_format(filename: str) -> str:
+    """ gff3 for .gff/.gff3 files (optionally compressed), gtf otherwise. """
+    return 'gff3' if get_extension(filename) in ['.gff', '.gff3'] else 'gtf'
+
+
+def extract_attribute(attributes: pd.Series, key: str, file_format: str) -> pd.Series:
+    """
+    Vectorised lookup of one attribute in the attribute column: key "value"; for GTF and key=value; for GFF3.
+    Rows without the attribute are NaN.
+    """
+    if file_format == 'gtf':
+        pattern = rf'(?:^|;)\s*{key}\s+"?([^";]*)"?'
+    else:
+        pattern = rf'(?:^|;)\s*{key}=([^;]*)'
+    values = attributes.str.extract(pattern, expand=False)
+    if file_format == 'gff3':
+        # GFF3 escapes reserved characters e.g. %3B for ;
+        escaped = values.str.contains('%', regex=False, na=False)
+        if escaped.any():
+            values[escaped] = values[escaped].map(unquote)
+    return values
+
+
+def get_attribute_keys(file_format: str, genes_only: bool) -> dict:
+    """ Attribute names for each output column (the first one found is used), transcripts have extra columns. """
+    keys = GFF3_TRANSCRIPT_ATTRIBUTES if file_format == 'gff3' and not genes_only else ATTRIBUTES[file_format]
+    return {c: keys[c] for c in GENE_COLUMNS} if genes_only else keys
+
+
+def parse_attributes(attributes: pd.Series, file_format: str, keys: dict) -> pd.DataFrame:
+    """ Output columns (keys of keys) from the attribute column, using the first attribute found for each. """
+    parsed = pd.DataFrame(index=attributes.index)
+    for column in keys:
+        values = pd.Series(np.nan, index=attributes.index, dtype=object)
+        for key in keys[column]:
+            missing = values.isna()
+            if not missing.any():
+                break
+            values[missing] = extract_attribute(attributes[missing], key, file_format)
+        if column in ['ensembl_gene_id', 'ensembl_transcript_id'] and file_format == 'gff3':
+            values = values.str.replace(ID_PREFIX, '', regex=True)
+        parsed[column] = values
+    return parsed
+
+
+def read_gtf(filename: str, feature_types=None, biotypes=None, file_format=None,
+             chunk_rows=500000) -> pd.DataFrame:
+    """
+    Reads the genes (or transcripts) of a GTF or GFF3 file, optionally gzipped, as an annotation.
+
+    Parameters
+    ----------
+    filename:       str: path to the GTF/GFF3 file
+    feature_types:  list: feature types to keep (default genes, see DEFAULT_FEATURES), e.g. ['transcript']
+    biotypes:       list: only keep features with one of these biotypes (e.g. ['protein_coding']), None keeps all
+    file_format:    str: gtf or gff3, by default this comes from the file extension
+    chunk_rows:     int: number of lines read at once
+
+    Returns
+    -------
+    DataFrame with chromosome_name, start_position, end_position, strand (1 or -1), ensembl_gene_id,
+    external_gene_name (the gene id if there is no name), gene_biotype and feature. Transcript features also have
+    ensembl_transcript_id, external_transcript_name and transcript_biotype. Rows are in file order.
+    """
+    file_format = file_format or get_format(filename)
+    feature_types = feature_types or DEFAULT_FEATURES[file_format]
+    keys = get_attribute_keys(file_format, all(f in GENE_FEATURES for f in feature_types))
+    chunks = []
+    # Comment lines are skipped by their prefix rather than with comment='#', which would also cut attribute values
+    # with a # in them (e.g. URLs). Readers are only context managers from pandas 1.2 (Python 3.7), so close it
+    reader = pd.read_csv(filename, sep='\t', header=None, names=GFF_COLUMNS, dtype=str, chunksize=chunk_rows,
+                         quoting=csv.QUOTE_NONE, skiprows=count_header_lines(filename))
+    try:
+        for chunk in reader:
+            # GFF3 directives (e.g. ### or ##sequence-region) can also be between the features
+            chunk = chunk[chunk['feature'].isin(feature_types) & ~chunk['seqname'].str.startswith('#', na=False)]
+            if len(chunk) == 0:
+                continue
+            parsed = parse_attributes(chunk['attributes'], file_format, keys)
+            if biotypes is not None:
+                biotype = parsed['transcript_biotype'] if 'transcript_biotype' in parsed else parsed['gene_biotype']
+                keep = biotype.isin(biotypes).values
+                chunk, parsed = chunk[keep], parsed[keep]
+            parsed.insert(0, 'chromosome_name', chunk['seqname'].values)
+            parsed.insert(1, 'start_position', chunk['start'].values.astype(np.int64))
+            parsed.insert(2, 'end_position', chunk['end'].values.astype(np.int64))
+            parsed.insert(3, 'strand', np.where(chunk['strand'].values == '-', -1, 1))
+            parsed['feature'] = chunk['feature'].values
+            chunks.append(parsed)
+    finally:
+        reader.close()
+    if not chunks:
+        return pd.DataFrame(columns=['chromosome_name', 'start_position', 'end_position', 'strand'] + list(keys) +
+                            ['feature'])
+    annot_df = pd.concat(chunks, ignore_index=True)
+    annot_df['external_gene_name'] = annot_df['external_gene_name'].fillna(annot_df['ensembl_gene_id'])
+    return annot_df
@@ -0,0 +1,318 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+"""
+Vectorised interval index used to assign many locations to gene windows in a single pass.
+
+Each gene is reduced to a window [lo, hi] such that a location overlaps the gene when
+loc_start <= hi and loc_end >= lo, which is exactly the test performed by in_promotor and overlaps_gene.
+"""
+
+import numpy as np
+
+# Positions are packed together with the chromosome code into one int64 key, this lets a single searchsorted
+# cover every chromosome at once.
+POS_OFFSET = 1 << 39
+CHR_SPAN = 1 << 40
+
+
+def pack_positions(chr_codes, positions) -> np.ndarray:
+    """
+    Packs chromosome codes and positions into sortable int64 keys.
+
+    Parameters
+    ----------
+    chr_codes:      np.array: integer chromosome codes (>= 0)
+    positions:      np.array: positions on the chromosome
+
+    Returns
+    -------
+    np.array of int64 keys
+    """
+    return np.asarray(chr_codes, dtype=np.int64) * CHR_SPAN + (np.asarray(positions, dtype=np.int64) + POS_OFFSET)
+
+
+def gene_windows(starts, ends, directions, overlap_method: str, buffer_before_tss: int, buffer_after_tss: int,
+                 buffer_gene_overlap: int):
+    """
+    Vectorised version of in_promotor and overlaps_gene. Note in_promotor does not flip the start and end of the
+    gene while overlaps_gene does (see get_start_end), we keep both of these behaviours.
+
+    Parameters
+    ----------
+    starts:                 np.array: gene starts
+    ends:                   np.array: gene ends
+    directions:             np.array: gene directions (> 0 is forward)
+    overlap_method:         str: in_promoter or overlaps
+    buffer_before_tss:      int: buffer upstream of the TSS
+    buffer_after_tss:       int: buffer after the gene end (overlaps only)
+    buffer_gene_overlap:    int: overlap with the gene body (in_promoter only)
+
+    Returns
+    -------
+    lo, hi: np.arrays with the window for each gene
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    forward = np.asarray(directions, dtype=np.float64) > 0
+    if overlap_method == 'in_promoter':
+        lo = np.where(forward, starts - buffer_before_tss, ends - buffer_gene_overlap)
+        hi = np.where(forward, starts + buffer_gene_overlap, ends + buffer_before_tss)
+    elif overlap_method == 'overlaps':
+        gene_starts, gene_ends = np.minimum(starts, ends), np.maximum(starts, ends)
+        lo = np.where(forward, gene_starts - buffer_before_tss, gene_starts - buffer_after_tss)
+        hi = np.where(forward, gene_ends + buffer_after_tss, gene_ends + buffer_before_tss)
+    else:
+        raise ValueError(f'Unsupported overlap method: {overlap_method}')
+    return lo, hi
+
+
+class IntervalIndex:
+
+    """
+    Sorted, per-chromosome view of a set of intervals that answers batches of overlap queries with searchsorted.
+
+    Intervals are bucketed by log2 of their length so that a few very long intervals (e.g. large genes in overlaps
+    mode) don't widen the candidate range for every other query.
+
+    Identical intervals (e.g. the promoter windows of transcripts sharing a TSS) are only stored once and matches
+    are expanded to every interval they stand for.
+    """
+
+    def __init__(self, chr_codes, lo, hi):
+        chr_codes = np.asarray(chr_codes, dtype=np.int64)
+        lo = np.asarray(lo, dtype=np.int64)
+        hi = np.asarray(hi, dtype=np.int64)
+        self.num_intervals = len(lo)
+        # members[member_offsets[u]: member_offsets[u + 1]] are the intervals identical to unique interval u
+        self.members, self.member_offsets = None, None
+        if len(lo) > 1:
+            order = np.lexsort((hi, lo, chr_codes))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = (chr_codes[order][1:] != chr_codes[order][:-1]) | (lo[order][1:] != lo[order][:-1]) | \
+                        (hi[order][1:] != hi[order][:-1])
+            if not first.all():
+                self.members = order
+                self.member_offsets = np.append(np.nonzero(first)[0], len(order))
+                chr_codes, lo, hi = chr_codes[order[first]], lo[order[first]], hi[order[first]]
+        lengths = np.maximum(hi - lo, 0)
+        buckets = np.zeros(len(lengths), dtype=np.int64)
+        non_zero = lengths > 0
+        buckets[non_zero] = np.floor(np.log2(lengths[non_zero])).astype(np.int64) + 1
+        # Intervals on unknown chromosomes (code < 0) can never be matched.
+        valid = chr_codes >= 0
+        self.buckets = []
+        for bucket in np.unique(buckets[valid]):
+            ids = np.nonzero((buckets == bucket) & valid)[0]
+            lo_keys = pack_positions(chr_codes[ids], lo[ids])
+            order = np.argsort(lo_keys, kind='stable')
+            ids, lo_keys = ids[order], lo_keys[order]
+            hi_keys = pack_positions(chr_codes[ids], hi[ids])
+            # Running max of the ends, lets us find the first interval that could still reach a query start.
+            self.buckets.append((ids, lo_keys, hi_keys, np.maximum.accumulate(hi_keys)))
+
+    @property
+    def nbytes(self) -> int:
+        """ Bytes held by the index arrays. """
+        members = [a for a in (self.members, self.member_offsets) if a is not None]
+        return sum(a.nbytes for bucket in self.buckets for a in bucket) + sum(a.nbytes for a in members)
+
+    def query(self, chr_codes, starts, ends, stats=None):
+        """
+        Finds every interval that overlaps each query, i.e. start <= interval hi and end >= interval lo.
+
+        Parameters
+        ----------
+        chr_codes:      np.array: integer chromosome codes of the queries (-1 for unknown)
+        starts:         np.array: query starts
+        ends:           np.array: query ends
+        stats:          Stats: optional, the queries searched, the candidate intervals compared and the most
+                        candidates for one query are counted (see query_sorted and stats.py)
+
+        Returns
+        -------
+        query_idx, interval_idx: np.arrays of matching pairs sorted by query then interval
+        """
+        chr_codes = np.asarray(chr_codes, dtype=np.int64)
+        query_lo = pack_positions(chr_codes, starts)
+        query_hi = pack_positions(chr_codes, ends)
+        # searchsorted is several times faster on sorted queries (it narrows the search from the last result and
+        # stays in cache), so sort once here and map the query indexes back at the end. Sorting on the end as well
+        # puts identical queries next to each other.
+        query_order = None
+        if len(query_lo) > 1 and not is_sorted_pairs(query_lo, query_hi):
+            query_order = np.argsort(query_lo)
+            if not is_sorted_pairs(query_lo[query_order], query_hi[query_order]):
+                # Only needed when queries with the same start have ends out of order
+                query_order = np.lexsort((query_hi, query_lo))
+            chr_codes, query_lo, query_hi = chr_codes[query_order], query_lo[query_order], query_hi[query_order]
+        # Identical queries (common in merged peak sets) are only searched for once and the matches fanned back out
+        first = np.ones(len(query_lo), dtype=bool)
+        first[1:] = (query_lo[1:] != query_lo[:-1]) | (query_hi[1:] != query_hi[:-1])
+        if first.all():
+            query_idx, interval_idx = self.query_sorted(chr_codes, query_lo, query_hi, stats)
+        else:
+            unique_idx, interval_idx = self.query_sorted(chr_codes[first], query_lo[first], query_hi[first], stats)
+            query_idx, interval_idx = fan_out(np.cumsum(first) - 1, unique_idx, interval_idx)
+        if query_order is not None:
+            query_idx = query_order[query_idx]
+        if self.members is not None:
+            query_idx, interval_idx = self.expand_members(query_idx, interval_idx)
+        # Pairs are unique so a single int64 key sorts them by query then interval (much faster than lexsort)
+        order = np.argsort(query_idx * max(self.num_intervals, 1) + interval_idx)
+        return query_idx[order], interval_idx[order]
+
+    def expand_members(self, query_idx, unique_idx):
+        """ Replaces each match to a unique interval with a match to every interval identical to it. """
+        counts = self.member_offsets[unique_idx + 1] - self.member_offsets[unique_idx]
+        total = int(counts.sum())
+        positions = np.arange(total) + np.repeat(self.member_offsets[unique_idx] - (np.cumsum(counts) - counts),
+                                                 counts)
+        return np.repeat(query_idx, counts), self.members[positions]
+
+    def query_sorted(self, chr_codes, query_lo, query_hi, stats=None):
+        """
+        query on packed (see pack_positions) and sorted queries, pairs are not sorted. If stats is passed the queries
+        searched (index_queries), the candidates compared (candidate_genes_tested) and the most candidates for one
+        query (max_candidates_per_location) are counted.
+        """
+        valid = chr_codes >= 0
+        query_idxs, interval_idxs = [], []
+        candidates = np.zeros(len(query_lo), dtype=np.int64) if stats is not None and stats.enabled else None
+        if candidates is not None:
+            stats.add('index_queries', int(valid.sum()))
+        for ids, lo_keys, hi_keys, max_hi_keys in self.buckets:
+            right = np.searchsorted(lo_keys, query_hi, side='right')
+            left = np.searchsorted(max_hi_keys, query_lo, side='left')
+            counts = np.where(valid, np.maximum(right - left, 0), 0)
+            total = int(counts.sum())
+            if candidates is not None:
+                stats.add('candidate_genes_tested', total)
+                candidates += counts
+            if total == 0:
+                continue
+            query_idx = np.repeat(np.arange(len(counts)), counts)
+            # Position of each candidate in the bucket: left[q] + offset within that query's candidate range.
+            positions = np.arange(total) + np.repeat(left - (np.cumsum(counts) - counts), counts)
+            keep = hi_keys[positions] >= query_lo[query_idx]
+            query_idxs.append(query_idx[keep])
+            interval_idxs.append(ids[positions[keep]])
+        if candidates is not None:
+            stats.set_max('max_candidates_per_location', int(candidates.max(initial=0)))
+        if not query_idxs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(query_idxs), np.concatenate(interval_idxs)
+
+
+def is_sorted_pairs(first, second) -> bool:
+    """ True if (first, second) pairs are in ascending order. """
+    if np.any(first[1:] < first[:-1]):
+        return False
+    ties = first[1:] == first[:-1]
+    return not np.any(ties & (second[1:] < second[:-1]))
+
+
+def fan_out(inverse, unique_idx, interval_idx):
+    """
+    Copies the matches of unique queries to every query they stand for.
+
+    Parameters
+    ----------
+    inverse:        np.array: for each query, the index of its unique query
+    unique_idx:     np.array: unique query index of each match
+    interval_idx:   np.array: interval index of each match
+
+    Returns
+    -------
+    query_idx, interval_idx: np.arrays of matching pairs for the queries
+    """
+    unique_counts = np.bincount(unique_idx, minlength=int(inverse[-1]) + 1)
+    # Group the matches by unique query so each one's matches are a contiguous range
+    order = np.argsort(unique_idx, kind='stable')
+    interval_idx = interval_idx[order]
+    unique_offsets = np.cumsum(unique_counts) - unique_counts
+    counts = unique_counts[inverse]
+    total = int(counts.sum())
+    query_idx = np.repeat(np.arange(len(inverse)), counts)
+    positions = np.arange(total) + np.repeat(unique_offsets[inverse] - (np.cumsum(counts) - counts), counts)
+    return query_idx, interval_idx[positions]
+
+
+def parse_strands(strands) -> np.ndarray:
+    """
+    Strand of each location as 1.0 (+) or -1.0 (-), anything else (e.g. . or missing) is unstranded (NaN).
+
+    Parameters
+    ----------
+    strands:    np.array: strands as +/- or numbers (> 0 is +, < 0 is -)
+
+    Returns
+    -------
+    np.array of float64
+    """
+    strands = np.asarray(strands)
+    if strands.dtype.kind in 'OUS':
+        try:
+            strands = strands.astype(np.float64)
+        except (TypeError, ValueError):
+            as_str = strands.astype(str)
+            strands = np.select([as_str == '+', as_str == '-'], [1.0, -1.0], np.nan)
+    strands = np.sign(strands.astype(np.float64))
+    strands[strands == 0] = np.nan
+    return strands
+
+
+class StrandedIndex:
+
+    """
+    Separate interval indexes for the + and - strand intervals. A stranded query is only compared with intervals on
+    its own strand, unstranded queries (NaN) are compared with both.
+    """
+
+    def __init__(self, chr_codes, lo, hi, directions):
+        chr_codes = np.asarray(chr_codes, dtype=np.int64)
+        lo = np.asarray(lo, dtype=np.int64)
+        hi = np.asarray(hi, dtype=np.int64)
+        forward = np.asarray(directions, dtype=np.float64) > 0
+        self.num_intervals = len(lo)
+        self.strands = []
+        for strand, on_strand in [(1.0, forward), (-1.0, ~forward)]:
+            ids = np.nonzero(on_strand)[0]
+            self.strands.append((strand, ids, IntervalIndex(chr_codes[ids], lo[ids], hi[ids])))
+
+    @property
+    def nbytes(self) -> int:
+        """ Bytes held by the index of each strand. """
+        return sum(ids.nbytes + index.nbytes for _, ids, index in self.strands)
+
+    def query(self, chr_codes, starts, ends, strands, stats=None):
+        """
+        Same as IntervalIndex.query, strands are 1.0, -1.0 or NaN for unstranded queries (see parse_strands).
+        """
+        chr_codes = np.asarray(chr_codes, dtype=np.int64)
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        strands = np.asarray(strands, dtype=np.float64)
+        unstranded = np.isnan(strands)
+        query_idxs, interval_idxs = [], []
+        for strand, ids, index in self.strands:
+            queries = np.nonzero((strands == strand) | unstranded)[0]
+            query_idx, interval_idx = index.query(chr_codes[queries], starts[queries], ends[queries], stats)
+            query_idxs.append(queries[query_idx])
+            interval_idxs.append(ids[interval_idx])
+        query_idx, interval_idx = np.concatenate(query_idxs), np.concatenate(interval_idxs)
+        order = np.argsort(query_idx * max(self.num_intervals, 1) + interval_idx)
+        return query_idx[order], interval_idx[order]
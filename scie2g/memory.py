@@ -0,0 +1,158 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+"""
+Helpers for running within a memory budget: parsing sizes such as 8G, choosing chunk sizes from the budget and
+spilling (location, gene) index pairs to typed temporary files.
+"""
+
+import os
+import re
+import sys
+import tempfile
+import weakref
+import numpy as np
+
+UNITS = {'': 1, 'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+# Pairs are stored as two int64 values
+PAIR_DTYPE = np.dtype([('loc_idx', np.int64), ('gene_idx', np.int64)])
+# Never use chunks smaller than this, however small the budget
+MIN_CHUNK_ROWS = 1000
+
+
+def parse_memory(memory) -> int:
+    """
+    Converts a memory size to bytes.
+
+    Parameters
+    ----------
+    memory:     int or str: bytes, or a string with a unit e.g. 512M, 8G, 8GB (None means no limit)
+
+    Returns
+    -------
+    int: number of bytes (None if memory was None)
+    """
+    if memory is None or isinstance(memory, (int, np.integer)):
+        return memory
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([BKMGT]?)B?\s*', str(memory).upper())
+    if match is None:
+        raise ValueError(f'Could not parse the memory size: {memory}, expected a number with an optional unit '
+                         f'e.g. 512M or 8G')
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+def get_chunk_rows(max_memory: int, bytes_per_row: float, copies=4) -> int:
+    """
+    Number of rows per chunk so that a chunk fits in the memory budget. Pandas makes copies of each chunk as it is
+    processed, so the budget is divided by the number of copies we expect to be alive at once.
+    """
+    return max(MIN_CHUNK_ROWS, int(max_memory // (max(bytes_per_row, 1) * copies)))
+
+
+def get_nbytes(obj) -> int:
+    """
+    Approximate bytes held by a DataFrame, array, index or (nested) list/dict of these. Python objects held in
+    object arrays and lists are counted with sys.getsizeof, objects shared between containers are counted each time.
+    """
+    if obj is None:
+        return 0
+    if hasattr(obj, 'memory_usage'):  # DataFrame or Series
+        return int(np.sum(obj.memory_usage(deep=True)))
+    if isinstance(obj, np.ndarray):
+        if obj.dtype == object:
+            return obj.nbytes + sum(sys.getsizeof(v) for v in obj.ravel())
+        return obj.nbytes
+    if hasattr(obj, 'nbytes'):  # interval indexes
+        return int(obj.nbytes)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(get_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(get_nbytes(v) for v in obj)
+    return sys.getsizeof(obj)
+
+
+class PairSpill:
+
+    """
+    Buffers (location index, gene index) pairs and writes them to typed .npy files once the buffer is full.
+    Pairs must be added in location order, the files are then read back (also in location order) to make the
+    outputs. Files are removed when this object is deleted.
+    """
+
+    def __init__(self, max_pairs: int, tmp_dir=None):
+        self.max_pairs, self.tmp_dir = max(max_pairs, 1), tmp_dir
+        self.buffer, self.buffer_size = [], 0
+        self.files, self.num_pairs = [], 0
+        self.cur_file, self.cur_pairs, self.cur_pos = -1, np.zeros(0, dtype=PAIR_DTYPE), 0
+        weakref.finalize(self, PairSpill._remove, self.files)
+
+    def add(self, loc_idx: np.ndarray, gene_idx: np.ndarray) -> None:
+        pairs = np.empty(len(loc_idx), dtype=PAIR_DTYPE)
+        pairs['loc_idx'], pairs['gene_idx'] = loc_idx, gene_idx
+        self.buffer.append(pairs)
+        self.buffer_size += len(pairs)
+        self.num_pairs += len(pairs)
+        if self.buffer_size >= self.max_pairs:
+            self.flush()
+
+    def flush(self) -> None:
+        """ Writes any buffered pairs to a new spill file. """
+        if self.buffer_size == 0:
+            return
+        fd, path = tempfile.mkstemp(prefix='scie2g_pairs_', suffix='.npy', dir=self.tmp_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.concatenate(self.buffer))
+        self.files.append(path)
+        self.buffer, self.buffer_size = [], 0
+
+    def rewind(self) -> None:
+        """ Start reading from the first pair again. """
+        self.flush()
+        self.cur_file, self.cur_pairs, self.cur_pos = -1, np.zeros(0, dtype=PAIR_DTYPE), 0
+
+    def take_before(self, loc_limit: int) -> np.ndarray:
+        """
+        Reads the next pairs (in the order they were added) up to the first pair with a location index >= loc_limit.
+        Only one spill file is loaded at a time.
+        """
+        taken = []
+        while True:
+            if self.cur_pos >= len(self.cur_pairs):
+                if self.cur_file + 1 >= len(self.files):
+                    break
+                self.cur_file += 1
+                self.cur_pairs, self.cur_pos = np.load(self.files[self.cur_file]), 0
+                continue
+            end = self.cur_pos + int(np.searchsorted(self.cur_pairs['loc_idx'][self.cur_pos:], loc_limit))
+            taken.append(self.cur_pairs[self.cur_pos:end])
+            self.cur_pos = end
+            if end < len(self.cur_pairs):
+                break
+        return np.concatenate(taken) if taken else np.zeros(0, dtype=PAIR_DTYPE)
+
+    def cleanup(self) -> None:
+        PairSpill._remove(self.files)
+
+    @staticmethod
+    def _remove(files: list) -> None:
+        for path in files:
+            if os.path.exists(path):
+                os.remove(path)
+        files.clear()
+
+    def __len__(self):
+        return self.num_pairs
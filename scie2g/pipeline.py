@@ -0,0 +1,136 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+"""
+Threaded pipeline stages for streaming runs: chunks are read ahead in one thread and outputs are written in another,
+so reading, computing and writing overlap. Stages are connected by bounded queues, a stage that gets ahead waits for
+the next one (the number of chunks held in memory stays fixed).
+"""
+
+import queue
+import threading
+
+# Chunks held in each queue between two stages
+PIPELINE_DEPTH = 2
+_DONE = object()
+
+
+def prefetch(iterable, depth=PIPELINE_DEPTH):
+    """
+    Iterates over iterable in a background thread, keeping up to depth items ready. Errors raised while reading are
+    raised again where the item would have been returned. With depth 0 the items are read in this thread.
+
+    Parameters
+    ----------
+    iterable:   items to read ahead (e.g. chunks from pd.read_csv)
+    depth:      int: maximum number of items read but not yet used
+
+    Returns
+    -------
+    generator over the items of iterable, in order
+    """
+    if depth < 1:
+        yield from iterable
+        return
+    items, stop = queue.Queue(maxsize=depth), threading.Event()
+
+    def read():
+        try:
+            for item in iterable:
+                if not _put(items, (item, None), stop):
+                    return
+            _put(items, (_DONE, None), stop)
+        except BaseException as e:
+            _put(items, (_DONE, e), stop)
+
+    reader = threading.Thread(target=read, name='scie2g-reader', daemon=True)
+    reader.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        # Stop the reader if we are closed early
+        stop.set()
+        reader.join()
+
+
+def _put(items: queue.Queue, item, stop: threading.Event) -> bool:
+    """ Puts item on the queue, waiting for space unless the consumer has stopped. """
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+class BackgroundWriter:
+
+    """
+    Calls write on each item put in a background thread, in order. Used as a context manager, leaving it waits for
+    every item to be written and raises any error from the writer. put raises straight away if the writer has failed.
+    With depth 0 items are written in the calling thread.
+    """
+
+    def __init__(self, write, depth=PIPELINE_DEPTH):
+        self.write, self.depth = write, depth
+        self.items, self.error, self.thread = queue.Queue(maxsize=max(depth, 1)), None, None
+
+    def __enter__(self):
+        if self.depth > 0:
+            self.thread = threading.Thread(target=self._run, name='scie2g-writer', daemon=True)
+            self.thread.start()
+        return self
+
+    def put(self, item) -> None:
+        if self.thread is None:
+            self.write(item)
+            return
+        while self.error is None:
+            try:
+                self.items.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise self.error
+
+    def _run(self):
+        while True:
+            item = self.items.get()
+            if item is _DONE:
+                return
+            if self.error is not None:
+                continue  # Drain the queue so put doesn't wait
+            try:
+                self.write(item)
+            except BaseException as e:
+                self.error = e
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.thread is not None:
+            self.items.put(_DONE)
+            self.thread.join()
+            self.thread = None
+        if self.error is not None and exc_type is None:
+            raise self.error
+        return False
@@ -0,0 +1,71 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+"""
+Brute force reference for the gene assignment. Every location is tested against every gene on its chromosome with
+the per pair checks (in_promotor / overlaps_gene, see Epi2Gene.overlaps), O(locations x genes), so this is only
+for validating the fast engines on small inputs (see tests/test_fuzz.py).
+"""
+
+import copy
+from typing import Tuple
+import numpy as np
+
+from scie2g.base import SWEEP_PARAMS, Epi2Gene
+
+
+def reference_pairs(e2g: Epi2Gene, loc_chrs, loc_starts, loc_ends, loc_strands=None,
+                    setting=None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (location, gene) pairs found by testing every location against every gene, using the annotation and overlap
+    settings of e2g (or those in setting). If e2g is direction_aware, stranded locations only keep genes on their own
+    strand and unstranded ones (NaN) keep genes on either strand.
+
+    Parameters
+    ----------
+    e2g:            Epi2Gene: object with the annotation set
+    loc_chrs:       np.array: chromosome of each location (any naming convention)
+    loc_starts:     np.array: start of each location
+    loc_ends:       np.array: end of each location
+    loc_strands:    np.array: strand of each location (1.0, -1.0 or NaN, see parse_strands)
+    setting:        dict: overlap settings to use instead of the ones on e2g (keys in SWEEP_PARAMS)
+
+    Returns
+    -------
+    loc_idx, gene_idx: np.arrays sorted by location then gene
+    """
+    if setting:
+        e2g = copy.copy(e2g)
+        for p in SWEEP_PARAMS:
+            if p in setting:
+                setattr(e2g, p, setting[p])
+    loc_codes = e2g.get_chr_codes(loc_chrs)
+    loc_strands = np.full(len(loc_codes), np.nan) if loc_strands is None else np.asarray(loc_strands, np.float64)
+    _, gene_starts, gene_ends, gene_directions = e2g.get_gene_arrays()
+    pairs = []
+    for i, loc_code in enumerate(loc_codes):
+        for g in range(len(gene_starts)):
+            if e2g.gene_chr_codes[g] != loc_code:
+                continue
+            if e2g.direction_aware and not np.isnan(loc_strands[i]) and \
+                    loc_strands[i] != (1.0 if gene_directions[g] > 0 else -1.0):
+                continue
+            if e2g.overlaps(int(gene_starts[g]), int(gene_ends[g]), gene_directions[g], int(loc_starts[i]),
+                            int(loc_ends[i])):
+                pairs.append((i, g))
+    pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
@@ -0,0 +1,340 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+"""
+Long running annotation server: annotations are loaded and indexed once, then batches of regions are assigned to genes
+over localhost HTTP or a Unix socket. Requests and responses are JSON, or Arrow IPC streams if pyarrow is installed.
+
+POST /query     {"annotation": "hg38", "chr": [...], "start": [...], "end": [...], "strand": [...], "columns": [...],
+                 "settings": {"overlap_method": ..., "buffer_before_tss": ...}}
+                returns {"annotation": ..., "offsets": [...], "gene_idx": [...], <column>: [...]} where the genes of
+                region i are gene_idx[offsets[i]: offsets[i + 1]] (strand is only used if direction_aware is set,
+                settings are optional and override the server's overlap settings).
+                Arrow requests (Content-Type: application/vnd.apache.arrow.stream) have chr, start, end (and strand)
+                columns and get back one row per region/gene pair with region_idx, gene_idx and the gene columns
+                (X-Annotation, X-Columns and X-Settings headers replace the JSON keys).
+GET /annotations    the loaded annotations and their settings.
+GET /health         "ok"
+
+Annotation files are checked for changes (at most every reload_interval seconds) and reloaded in the background of a
+request, the previous annotation keeps answering queries until the new one is ready.
+"""
+
+import argparse
+import io
+import json
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import numpy as np
+
+from sciutil import SciUtil
+
+from scie2g import Epi2GeneException
+from scie2g.annotator import Annotator
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+try:
+    from http.server import ThreadingHTTPServer
+except ImportError:
+    # Python 3.6 (ThreadingHTTPServer was added in 3.7)
+    class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+ARROW_TYPE = 'application/vnd.apache.arrow.stream'
+JSON_TYPE = 'application/json'
+# Python and JSON type of each key of a JSON query
+QUERY_TYPES = {'chr': (list, 'array'), 'start': (list, 'array'), 'end': (list, 'array'), 'strand': (list, 'array'),
+               'columns': (list, 'array'), 'settings': (dict, 'object'), 'annotation': (str, 'string')}
+# Keys that can be null to get the default, columns has to be left out (null is not a list of columns)
+NULLABLE_KEYS = ['strand', 'settings', 'annotation']
+
+
+class Annotation:
+
+    """
+    An annotation loaded from a file. Only the cache of gene indexes changes after loading (a reload makes a new
+    Annotation) so instances can be shared between request threads.
+    """
+
+    def __init__(self, name: str, filename: str, settings: dict):
+        self.name, self.filename, self.settings = name, filename, settings
+        self.mtime = os.path.getmtime(filename)
+        # Read only annotation and indexes shared by the request threads
+        self.annotator = Annotator.from_file(filename, **settings)
+        self.loaded = time.time()
+
+    def query(self, chrs, starts, ends, strands=None, setting=None):
+        """ Genes for each region as CSR arrays, see Epi2Gene.query. """
+        return self.annotator.query(chrs, starts, ends, strands, setting)
+
+    def gene_values(self, column: str, gene_idx: np.ndarray) -> list:
+        if column not in self.annotator.gene_annot_df.columns:
+            raise Epi2GeneException(f'Column not in the annotation {self.name}: {column}')
+        return self.annotator.gene_values(column, gene_idx).tolist()
+
+    def describe(self) -> dict:
+        return {'name': self.name, 'filename': self.filename, 'num_genes': self.annotator.num_genes,
+                'columns': list(self.annotator.gene_annot_df.columns), 'mtime': self.mtime, 'loaded': self.loaded,
+                'memory_bytes': self.annotator.memory_usage()['total'], **self.settings}
+
+
+class AnnotationStore:
+
+    """
+    The annotations served, by name. Reloads an annotation when its file changes.
+    """
+
+    def __init__(self, annotation_files: dict, settings: dict, reload_interval=1.0, sciutil=None):
+        self.u = SciUtil() if sciutil is None else sciutil
+        self.annotation_files, self.settings, self.reload_interval = annotation_files, settings, reload_interval
+        self.annotations = {name: Annotation(name, f, settings) for name, f in annotation_files.items()}
+        self.last_checked = {name: time.time() for name in annotation_files}
+        self.reloading, self.lock = set(), threading.Lock()
+
+    def get(self, name=None) -> Annotation:
+        """ The annotation with this name (can be None if only one annotation is served). """
+        if name is None:
+            if len(self.annotations) != 1:
+                raise Epi2GeneException(f'Please choose an annotation: {list(self.annotations.keys())}')
+            name = next(iter(self.annotations))
+        annotation = self.annotations.get(name)
+        if annotation is None:
+            raise Epi2GeneException(f'Unknown annotation: {name}, choose from {list(self.annotations.keys())}')
+        self.check_reload(name)
+        return annotation
+
+    def check_reload(self, name: str) -> None:
+        """ Starts reloading an annotation in another thread if its file has changed. """
+        now = time.time()
+        with self.lock:
+            if now - self.last_checked[name] < self.reload_interval or name in self.reloading:
+                return
+            self.last_checked[name] = now
+            try:
+                changed = os.path.getmtime(self.annotation_files[name]) != self.annotations[name].mtime
+            except OSError:
+                # Mid-write or removed, keep serving what we have
+                return
+            if not changed:
+                return
+            self.reloading.add(name)
+        threading.Thread(target=self.reload, args=(name, ), daemon=True).start()
+
+    def reload(self, name: str) -> None:
+        try:
+            annotation = Annotation(name, self.annotation_files[name], self.settings)
+            self.annotations[name] = annotation
+            self.u.dp(['Reloaded annotation: ', name, self.annotation_files[name]])
+        except Exception as e:
+            self.u.warn_p(['Could not reload annotation (still serving the previous version): ', name, str(e)])
+        finally:
+            with self.lock:
+                self.reloading.discard(name)
+
+
+def query_json(store: AnnotationStore, request: dict) -> dict:
+    """ Handles a JSON query, see the module docstring for the format. """
+    if not isinstance(request, dict):
+        raise Epi2GeneException('Query must be a JSON object')
+    for key in ['chr', 'start', 'end']:
+        if key not in request:
+            raise Epi2GeneException(f'Query is missing: {key}')
+    for key, (value_type, json_type) in QUERY_TYPES.items():
+        if key not in request or (request[key] is None and key in NULLABLE_KEYS):
+            continue
+        if not isinstance(request[key], value_type):
+            raise Epi2GeneException(f'Query {key} must be a JSON {json_type}')
+    if not all(isinstance(column, str) for column in request.get('columns', [])):
+        raise Epi2GeneException('Query columns must be an array of strings')
+    if not len(request['chr']) == len(request['start']) == len(request['end']):
+        raise Epi2GeneException('chr, start and end must have the same length')
+    annotation = store.get(request.get('annotation'))
+    offsets, gene_idx = annotation.query(request['chr'], request['start'], request['end'], request.get('strand'),
+                                         request.get('settings'))
+    response = {'annotation': annotation.name, 'offsets': offsets.tolist(), 'gene_idx': gene_idx.tolist()}
+    for column in request.get('columns', [annotation.annotator.name_column]):
+        response[column] = annotation.gene_values(column, gene_idx)
+    return response
+
+
+def query_arrow(store: AnnotationStore, body: bytes, annotation_name=None, columns=None, setting=None) -> bytes:
+    """ Handles an Arrow query, returns an Arrow IPC stream with one row per region/gene pair. """
+    table = pa.ipc.open_stream(body).read_all()
+    for key in ['chr', 'start', 'end']:
+        if key not in table.column_names:
+            raise Epi2GeneException(f'Query is missing: {key}')
+    strands = table.column('strand').to_numpy() if 'strand' in table.column_names else None
+    annotation = store.get(annotation_name)
+    offsets, gene_idx = annotation.query(table.column('chr').to_numpy(zero_copy_only=False),
+                                         table.column('start').to_numpy(), table.column('end').to_numpy(), strands,
+                                         setting)
+    result = {'region_idx': np.repeat(np.arange(len(offsets) - 1), np.diff(offsets)), 'gene_idx': gene_idx}
+    for column in columns or [annotation.annotator.name_column]:
+        result[column] = annotation.gene_values(column, gene_idx)
+    sink = io.BytesIO()
+    result_table = pa.table(result)
+    with pa.ipc.new_stream(sink, result_table.schema) as writer:
+        writer.write_table(result_table)
+    return sink.getvalue()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send(200, b'ok', 'text/plain')
+        elif self.path == '/annotations':
+            self.send_json(200, [a.describe() for a in self.server.store.annotations.values()])
+        else:
+            self.send_json(404, {'error': f'Unknown path: {self.path}'})
+
+    def do_POST(self):
+        if self.path.split('?')[0] != '/query':
+            self.send_json(404, {'error': f'Unknown path: {self.path}'})
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        content_type = self.headers.get('Content-Type', JSON_TYPE).split(';')[0].strip()
+        try:
+            if content_type == ARROW_TYPE:
+                if pa is None:
+                    self.send_json(415, {'error': 'Arrow payloads need pyarrow installed on the server'})
+                    return
+                columns, setting = self.headers.get('X-Columns'), self.headers.get('X-Settings')
+                self.send(200, query_arrow(self.server.store, body, self.headers.get('X-Annotation'),
+                                           columns.split(',') if columns else None,
+                                           json.loads(setting) if setting else None), ARROW_TYPE)
+            else:
+                self.send_json(200, query_json(self.server.store, json.loads(body)))
+        except (Epi2GeneException, ValueError, KeyError, TypeError, AttributeError) as e:
+            # Anything wrong with the payload that got past the checks is still the client's error
+            self.send_json(400, {'error': str(e)})
+
+    def send_json(self, status: int, value) -> None:
+        self.send(status, json.dumps(value).encode(), JSON_TYPE)
+
+    def send(self, status: int, body: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class HTTPAnnotationServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, store: AnnotationStore, host='127.0.0.1', port=8765, verbose=False):
+        self.store, self.verbose = store, verbose
+        super().__init__((host, port), RequestHandler)
+
+
+class UnixAnnotationServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, store: AnnotationStore, socket_path: str, verbose=False):
+        self.store, self.verbose = store, verbose
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, RequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def parse_annotations(annotations: list) -> dict:
+    """ Annotations given as name=path or path (the name is then the file name without the extension). """
+    annotation_files = {}
+    for a in annotations:
+        name, path = a.split('=', 1) if '=' in a else (os.path.splitext(os.path.basename(a))[0], a)
+        annotation_files[name] = path
+    return annotation_files
+
+
+def gen_parser():
+    parser = argparse.ArgumentParser(description='scie2g serve: assign regions to genes over HTTP or a Unix socket')
+    parser.add_argument('--a', type=str, action='append', required=True,
+                        help='Annotation file, as name=path or path, can be given more than once.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host for HTTP (default localhost only)')
+    parser.add_argument('--port', type=int, default=8765, help='Port for HTTP')
+    parser.add_argument('--socket', type=str, default=None, help='Serve on this Unix socket instead of HTTP')
+    parser.add_argument('--upflank', type=int, default=2500, help='Maximum distance upstream from TSS')
+    parser.add_argument('--downflank', type=int, default=500, help='Maximum distance downstream from gene end')
+    parser.add_argument('--overlap', type=int, default=500, help='Overlap with gene body')
+    parser.add_argument('--m', type=str, default='in_promoter', help='Overlap method (overlaps or in_promoter)')
+    parser.add_argument('--strand', action='store_true', help='Direction aware: only match genes on the same strand '
+                                                              'as the region (queries then need a strand).')
+    parser.add_argument('--gchr', type=int, default=2, help='Position in annotation file that your chr annotation is.')
+    parser.add_argument('--gstart', type=int, default=3, help='Position in annotation file that your start is.')
+    parser.add_argument('--gend', type=int, default=4, help='Position in annotation file that your end is.')
+    parser.add_argument('--gdir', type=int, default=5, help='Position in annotation file that your gene direction is.')
+    parser.add_argument('--gname', type=int, default=0, help='Position in annotation file that gene name is.')
+    parser.add_argument('--reload', type=float, default=1.0, help='Seconds between checks for annotation changes.')
+    parser.add_argument('--verbose', action='store_true', help='Log every request.')
+    return parser
+
+
+def get_settings(args) -> dict:
+    return {'overlap_method': args.m, 'buffer_before_tss': args.upflank, 'buffer_after_tss': args.downflank,
+            'buffer_gene_overlap': args.overlap, 'direction_aware': args.strand, 'gene_chr': args.gchr,
+            'gene_start': args.gstart, 'gene_end': args.gend, 'gene_direction': args.gdir, 'gene_name': args.gname}
+
+
+def make_server(args):
+    store = AnnotationStore(parse_annotations(args.a), get_settings(args), args.reload)
+    if args.socket:
+        return UnixAnnotationServer(store, args.socket, args.verbose)
+    return HTTPAnnotationServer(store, args.host, args.port, args.verbose)
+
+
+def main(args=None):
+    args = gen_parser().parse_args(args)
+    u = SciUtil()
+    for path in parse_annotations(args.a).values():
+        if not os.path.isfile(path):
+            u.err_p([f'The annotation file could not be located, file passed: {path}'])
+            return 1
+    server = make_server(args)
+    u.dp(['Serving annotations: ', ', '.join(server.store.annotations.keys()), '\nOn: ',
+          args.socket if args.socket else f'http://{args.host}:{server.server_address[1]}'])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
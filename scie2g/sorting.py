@@ -0,0 +1,138 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+"""
+Checks and sorts location files so that they are in the canonical chromosome order (the same order as the annotation,
+see chromosomes.py). Files that don't fit in the memory budget are sorted with an external merge sort (sorted chunks
+are spilled to disk and then merged).
+"""
+
+import csv
+import heapq
+import os
+import tempfile
+import numpy as np
+
+from scie2g.chromosomes import CHROMOSOMES
+
+
+def is_sorted(chr_codes, starts) -> bool:
+    """ Single vectorised pass to check that locations are sorted on chromosome code then start. """
+    if len(starts) < 2:
+        return True
+    chr_diff = np.diff(np.asarray(chr_codes))
+    start_diff = np.diff(np.asarray(starts, dtype=np.int64))
+    return bool(np.all((chr_diff > 0) | ((chr_diff == 0) & (start_diff >= 0))))
+
+
+def get_sort_order(chr_codes, starts) -> np.ndarray:
+    """ Stable order that sorts the locations on chromosome code then start. """
+    return np.lexsort((np.asarray(starts, dtype=np.int64), np.asarray(chr_codes)))
+
+
+class LineKey:
+
+    """
+    Sort key for a single line of a delimited file, i.e. (chromosome code, start).
+    """
+
+    def __init__(self, chr_idx: int, start_idx: int, chromosomes=None, sep='\t'):
+        self.chr_idx, self.start_idx, self.sep = chr_idx, start_idx, sep
+        self.chromosomes = chromosomes or CHROMOSOMES
+
+    def split(self, line: str) -> list:
+        if self.sep == '\t':
+            return line.split(self.sep)
+        # Use the csv reader so quoted values with the separator in them don't shift the columns
+        return next(csv.reader([line], delimiter=self.sep))
+
+    def __call__(self, line: str):
+        values = self.split(line)
+        return self.chromosomes.code(values[self.chr_idx].strip()), int(values[self.start_idx])
+
+
+def sort_file(filename: str, output_filename: str, chr_idx: int, start_idx: int, sep='\t', header=False,
+              max_memory=512 * 1024 * 1024, tmp_dir=None, chromosomes=None) -> int:
+    """
+    Sorts a delimited file on chromosome (canonical order) and start. If the file is larger than max_memory it is
+    sorted in chunks that are spilled to temporary files and then merged.
+
+    Parameters
+    ----------
+    filename:           str: file to sort
+    output_filename:    str: where to save the sorted file
+    chr_idx:            int: index of the chromosome column
+    start_idx:          int: index of the start column
+    sep:                str: separator
+    header:             Bool: whether the first line is a header (kept as the first line)
+    max_memory:         int: memory budget (bytes) for the lines held in memory at once
+    tmp_dir:            str: directory for the spill files (default system temp dir)
+    chromosomes:        ChromosomeIndex: chromosome codes to use (default the shared CHROMOSOMES)
+
+    Returns
+    -------
+    int: the number of spill files used (0 if the file was sorted in memory)
+    """
+    key = LineKey(chr_idx, start_idx, chromosomes, sep)
+    # Python strings take about twice the space of the raw line so we budget for that.
+    chunk_bytes = max(max_memory // 2, 1)
+    spill_files = []
+    header_line = None
+    with open(filename, 'r') as f:
+        if header:
+            header_line = f.readline()
+        lines, num_bytes = [], 0
+        for line in f:
+            if not line.strip():
+                continue
+            if not line.endswith('\n'):
+                line += '\n'
+            lines.append(line)
+            num_bytes += len(line)
+            if num_bytes >= chunk_bytes:
+                spill_files.append(_spill_chunk(lines, key, tmp_dir))
+                lines, num_bytes = [], 0
+        if spill_files and lines:
+            spill_files.append(_spill_chunk(lines, key, tmp_dir))
+            lines = []
+    try:
+        with open(output_filename, 'w') as out:
+            if header_line is not None:
+                out.write(header_line)
+            if not spill_files:
+                lines.sort(key=key)
+                out.writelines(lines)
+            else:
+                spill_handles = [open(s, 'r') for s in spill_files]
+                try:
+                    out.writelines(heapq.merge(*spill_handles, key=key))
+                finally:
+                    for handle in spill_handles:
+                        handle.close()
+    finally:
+        for spill_file in spill_files:
+            os.remove(spill_file)
+    return len(spill_files)
+
+
+def _spill_chunk(lines: list, key: LineKey, tmp_dir=None) -> str:
+    """ Sorts a chunk of lines and writes it to a temporary file, returns the path. """
+    lines.sort(key=key)
+    fd, path = tempfile.mkstemp(prefix='scie2g_sort_', suffix='.tmp', dir=tmp_dir)
+    with os.fdopen(fd, 'w') as f:
+        f.writelines(lines)
+    return path
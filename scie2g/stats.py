@@ -0,0 +1,141 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+"""
+Low overhead instrumentation: stage timers and counters for a run.
+
+Stats are disabled by default, in which case timed methods call straight through and counting is a single boolean
+check. Candidate genes are counted by the index queries themselves (see IntervalIndex.query_sorted), the run's Stats
+is passed to each query so runs never share or patch each other's counters.
+"""
+
+import functools
+import json
+import time
+from collections import defaultdict
+
+
+class Timer:
+    """ Context manager adding the time spent in a block to a stage. """
+
+    def __init__(self, stats, stage: str):
+        self.stats, self.stage, self.start = stats, stage, 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.stage_seconds[self.stage] += time.perf_counter() - self.start
+        self.stats.stage_calls[self.stage] += 1
+        return False
+
+
+class NullTimer:
+    """ Timer used when stats are disabled, does nothing. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Stats:
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stage_seconds, self.stage_calls = defaultdict(float), defaultdict(int)
+        self.counters, self.maxima = defaultdict(int), defaultdict(int)
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        """ Clears all timers and counters (keeps enabled as is). """
+        self.stage_seconds.clear()
+        self.stage_calls.clear()
+        self.counters.clear()
+        self.maxima.clear()
+
+    def timer(self, stage: str):
+        """ Context manager timing a stage, stages are cumulative if they are timed more than once. """
+        return Timer(self, stage) if self.enabled else NULL_TIMER
+
+    def add(self, counter: str, n=1):
+        if self.enabled:
+            self.counters[counter] += n
+
+    def set_max(self, counter: str, value: int):
+        if self.enabled and value > self.maxima[counter]:
+            self.maxima[counter] = value
+
+    def to_dict(self) -> dict:
+        """
+        Report of the stages and counters.
+
+        Returns
+        -------
+        dict: stages (seconds and calls for each stage), counters and maxima
+        """
+        return {'stages': {s: {'seconds': self.stage_seconds[s], 'calls': self.stage_calls[s]}
+                           for s in self.stage_seconds},
+                'counters': dict(self.counters),
+                'maxima': dict(self.maxima)}
+
+    def save(self, filename: str, info=None) -> None:
+        """
+        Save the report as JSON.
+
+        Parameters
+        ----------
+        filename:       str: JSON file to write
+        info:           dict: any other information about the run to include (e.g. the input file)
+
+        Returns
+        -------
+        None
+        """
+        report = {'info': info if info else {}}
+        report.update(self.to_dict())
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    def __repr__(self):
+        lines = [f'{s}: {self.stage_seconds[s]:.3f}s ({self.stage_calls[s]} calls)' for s in self.stage_seconds]
+        lines += [f'{c}: {v}' for c, v in self.counters.items()]
+        lines += [f'{c}: {v}' for c, v in self.maxima.items()]
+        return '\n'.join(lines)
+
+
+def timed(stage: str):
+    """ Decorator timing an Epi2Gene method as a stage of self.stats. """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not self.stats.enabled:
+                return func(self, *args, **kwargs)
+            with Timer(self.stats, stage):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -46,6 +46,7 @@ setup(name='scie2g',
           ]
       },
       install_requires=['pandas', 'numpy', 'scibiomart', 'sciutil>=1.0.3', 'tqdm', 'igv-jupyter'],
+      extras_require={'arrow': ['pyarrow']},
       python_requires='>=3.6',
       data_files=[("", ["LICENSE"])]
       )
\ No newline at end of file
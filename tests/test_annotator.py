@@ -0,0 +1,124 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+from scie2g import Csv, Epi2Gene, Epi2GeneException
+from scie2g.annotator import Annotator
+
+
+class TestClass(unittest.TestCase):
+
+    @classmethod
+    def setup_class(self):
+        local = True
+        # Create a base object since it will be the same for all the tests
+        THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+        self.data_dir = os.path.join(THIS_DIR, 'data/')
+        if local:
+            self.tmp_dir = os.path.join(THIS_DIR, 'data/tmp/')
+            if os.path.exists(self.tmp_dir):
+                shutil.rmtree(self.tmp_dir)
+            os.mkdir(self.tmp_dir)
+        else:
+            self.tmp_dir = tempfile.mkdtemp(prefix='scie2g_tmp_')
+        # Setup the default data for each of the tests
+        self.methyl_overlaps = os.path.join(self.data_dir, 'test_methyl_overlaps.csv')
+        self.hg38_annot = os.path.join(self.data_dir, 'hsapiens_gene_ensembl-GRCh38.p13.csv')
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestAnnotator(TestClass):
+
+    def test_annotator(self):
+        self.setup_class()
+        e2g = Epi2Gene(overlap_method='overlaps')
+        e2g.set_annotation_from_file(self.hg38_annot)
+        annotator = Annotator(e2g)
+        loc_df = pd.read_csv(self.methyl_overlaps)
+        loc_df['chr'] = 'chr' + loc_df['chr'].astype(str)
+        for setting in [None, {'overlap_method': 'in_promoter'}, {'buffer_before_tss': 0, 'buffer_after_tss': 0}]:
+            offsets, gene_idx = annotator.query(loc_df['chr'], loc_df['start'], loc_df['end'], setting=setting)
+            expected_offsets, expected_gene_idx = e2g.query(loc_df['chr'], loc_df['start'], loc_df['end'],
+                                                            setting=setting)
+            assert list(offsets) == list(expected_offsets) and list(gene_idx) == list(expected_gene_idx)
+
+        # Same output as a Csv run (csv ends are inclusive)
+        csv = Csv(self.methyl_overlaps, 'chr', 'start', 'end', 'meth.diff', ['genes'], overlap_method='overlaps')
+        csv.set_annotation_from_file(self.hg38_annot)
+        expected = csv.assign_locations_to_genes_grid([{}])
+        run = annotator.run(loc_df.assign(end=loc_df['end'] + 1))
+        run_df = run.get_loc_df()
+        assert len(run) == len(run_df) == len(expected) > 0
+        assert list(run_df['gene_idx']) == list(expected['gene_idx'])
+        assert list(run_df['external_gene_name']) == list(expected['external_gene_name'])
+        gene_to_locations = run.get_gene_to_locations()
+        assert sum(len(locs) for locs in gene_to_locations.values()) == len(run)
+        assert all(g in run.get_location_to_genes()[loc] for g, locs in gene_to_locations.items() for loc in locs)
+        # Every location is kept (in location order) if keep_unassigned
+        all_df = run.get_loc_df(keep_unassigned=True)
+        unassigned = sorted(set(range(len(loc_df))) - set(run.loc_idx))
+        assert len(unassigned) > 0
+        assert len(all_df) == len(run_df) + len(unassigned)
+        assert all_df['gene_idx'].isna().sum() == len(unassigned)
+        assert list(all_df['Unnamed: 0']) == sorted(all_df['Unnamed: 0'])
+
+        # Changing the Epi2Gene object (or its annotation) afterwards doesn't change the annotator
+        offsets, gene_idx = annotator.query(loc_df['chr'], loc_df['start'], loc_df['end'])
+        e2g.buffer_before_tss = 0
+        e2g.set_annotation_from_file(self.hg38_annot)
+        e2g.gene_annot_df = e2g.gene_annot_df.head(1)
+        offsets_after, gene_idx_after = annotator.query(loc_df['chr'], loc_df['start'], loc_df['end'])
+        assert list(offsets_after) == list(offsets) and list(gene_idx_after) == list(gene_idx)
+        assert not annotator.gene_starts.flags.writeable
+
+        with self.assertRaises(Epi2GeneException):
+            annotator.query(['chr1'], [0], [1], setting={'nearby': 10})
+        with self.assertRaises(Epi2GeneException):
+            Annotator(Epi2Gene())
+
+    def test_concurrent_runs(self):
+        self.setup_class()
+        annotator = Annotator.from_file(self.hg38_annot, overlap_method='overlaps', direction_aware=True)
+        loc_df = pd.read_csv(self.methyl_overlaps)
+        rng = np.random.default_rng(0)
+        # Many inputs (different locations, strands and settings) annotated at once against the same annotator
+        inputs = []
+        for i in range(40):
+            sample = loc_df.sample(frac=0.8, random_state=i)
+            sample['strand'] = rng.choice(['+', '-', '.'], len(sample))
+            inputs.append((sample, {'buffer_before_tss': int(rng.integers(0, 5000))}))
+
+        def annotate(args):
+            sample, setting = args
+            return annotator.run(sample, strand_col='strand', setting=setting).get_loc_df()
+        expected = [annotate(args) for args in inputs]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(annotate, inputs))
+        for result, expected_df in zip(results, expected):
+            assert result.equals(expected_df)
+        assert sum(len(r) for r in results) > 0
@@ -16,6 +16,8 @@
 ###############################################################################
 
 import os
+from collections import defaultdict
+import numpy as np
 import pandas as pd
 import pytest
 import os
@@ -64,6 +66,37 @@ class TestEpi2Gene(TestClass):
         l2g.set_annotation_from_bed_file('data/GCF_000001635.27_GRCm39.bed')
 
 
+    def test_bed_files_annot(self):
+        self.setup_class()
+        beds = [[['chr2', 100, 200, 'a', 5, '+'], ['chr1', 500, 600, 'b', 1, '-'], ['chr1', 150, 300, 'c', 2, '+']],
+                [['chr1', 100, 200, 'd', 3, '+'], ['chr1', 300, 310, 'e', 4, '+'], ['chr10', 50, 60, 'f', 1, '+'],
+                 ['chr10', 100, 120, 'i', 2, '+']],
+                [['chr1', 550, 700, 'g', 9, '-'], ['chr2', 200, 250, 'h', 1, '+']]]
+        bed_files = []
+        for i, rows in enumerate(beds):
+            bed_files.append(os.path.join(self.tmp_dir, f'annot_{i}.bed'))
+            pd.DataFrame(rows).to_csv(bed_files[-1], sep='\t', header=False, index=False)
+        for threads in [1, 3]:
+            l2g = Epi2Gene('', [])
+            l2g.set_annotation_from_bed_files(bed_files, threads=threads)
+            # Sorted in the canonical chromosome order then TSS (the end for reverse strand genes)
+            assert list(l2g.gene_annot_df['name']) == ['d', 'c', 'e', 'b', 'g', 'a', 'h', 'f', 'i']
+            assert list(l2g.gene_annot_df['direction']) == [1, 1, 1, -1, -1, 1, 1, 1, 1]
+            assert l2g.num_genes == 9
+        # Merge overlapping and book-ended intervals on the same chromosome and strand
+        merged_file = os.path.join(self.tmp_dir, 'merged.bed')
+        l2g = Epi2Gene('', [])
+        l2g.set_annotation_from_bed_files(bed_files, merge=True, save_file=True, output_filename=merged_file)
+        merged = l2g.gene_annot_df[['chr', 'start_position', 'end_position', 'name', 'score', 'direction']]
+        assert merged.values.tolist() == [['chr1', 100, 310, 'd,c,e', 4, 1], ['chr1', 500, 700, 'b,g', 9, -1],
+                                          ['chr2', 100, 250, 'a,h', 5, 1], ['chr10', 50, 60, 'f', 1, 1],
+                                          ['chr10', 100, 120, 'i', 2, 1]]
+        saved = pd.read_csv(merged_file, sep='\t', header=None)
+        assert list(saved[5]) == ['+', '-', '+', '+', '+']
+        # Intervals within merge_distance are merged too
+        l2g.set_annotation_from_bed_files(bed_files, merge=True, merge_distance=40)
+        assert list(l2g.gene_annot_df['name']) == ['d,c,e', 'b,g', 'a,h', 'f,i']
+
     def test_generate_gene_info(self):
         self.setup_class()
         l2g = Epi2Gene('', [])
@@ -186,26 +219,57 @@ class TestEpi2Gene(TestClass):
         was_in = l2g.overlaps(20, 40, -1, 0, 1)
         assert not was_in
 
-    def test_assign_loc_value(self):
-        l2g = Epi2Gene('', [])
-        l2g.cur_loc_idx, l2g.cur_chr, l2g.cur_loc_start, l2g.cur_loc_end, l2g.cur_gene_idx = 1, 2, 3, 4, 5
-        l2g.location_to_gene_dict = {1: []}
-        l2g.gene_to_location_dict = {5: []}
-        l2g.assign_loc_value()
-        assert l2g.gene_to_location_dict[5][0] == 1
-        assert l2g.location_to_gene_dict[1][0] == 5
-
-    def test_update_loc_value(self):
+    def test_query(self):
+        l2g = Epi2Gene()
+        with self.assertRaises(Epi2GeneException):
+            l2g.query(['1'], [1], [2])
+        l2g.set_annotation_from_file(self.hg38_annot)
+        # Brute force every chr7 gene with the scalar test for some random regions on chr7
+        chr7 = np.nonzero(l2g.gene_chr_codes == l2g.chromosomes.code('7'))[0]
+        rng = np.random.default_rng(1)
+        starts = rng.integers(26000000, 28000000, 200)
+        ends = starts + rng.integers(1, 50000, 200)
+        for method in ['in_promoter', 'overlaps']:
+            l2g.overlap_method = method
+            offsets, gene_idx = l2g.query(['chr7'] * len(starts), starts, ends)
+            assert len(offsets) == len(starts) + 1
+            assert offsets[-1] == len(gene_idx)
+            for i in range(len(starts)):
+                expected = [g for g in chr7 if l2g.overlaps(l2g.get_gene_start(g), l2g.get_gene_end(g),
+                                                            l2g.get_gene_direction(g), starts[i], ends[i])]
+                assert list(gene_idx[offsets[i]: offsets[i + 1]]) == expected
+        # Chromosome naming conventions, unknown chromosomes and empty batches
+        l2g.overlap_method = 'overlaps'
+        offsets, gene_idx = l2g.query(['7', 'chr7', 'NC_000007.14', 'chrNotReal'], [27082673] * 4, [27109403] * 4)
+        num_genes = offsets[1]
+        assert num_genes > 0
+        assert list(np.diff(offsets)) == [num_genes, num_genes, num_genes, 0]
+        assert list(gene_idx[:num_genes]) == list(gene_idx[num_genes: 2 * num_genes])
+        offsets, gene_idx = l2g.query([], [], [])
+        assert list(offsets) == [0] and len(gene_idx) == 0
+        # Settings can be passed per query without changing the object
+        wide = l2g.query(['7'], [27082673], [27109403], setting={'buffer_before_tss': 100000})
+        assert len(wide[1]) > num_genes
+        assert l2g.buffer_before_tss == 2500
+        assert len(l2g.gene_indexes) == 3
+        # Direction aware only keeps genes on the same strand
+        l2g.direction_aware = True
+        offsets, gene_idx = l2g.query(['7', '7'], [27082673] * 2, [27109403] * 2, strands=['+', '-'])
+        directions = l2g.gene_annot_values[gene_idx, l2g.gene_direction]
+        assert all(directions[offsets[0]: offsets[1]] == 1)
+        assert all(directions[offsets[1]: offsets[2]] == -1)
+        assert offsets[2] == num_genes
+
+    def test_set_assignment_pairs(self):
         l2g = Epi2Gene('', [])
-        l2g.cur_loc_idx, l2g.cur_chr, l2g.cur_loc_start, l2g.cur_loc_end, l2g.cur_gene_idx = 1, 2, 3, 4, 5
-        args = {'A': 'he', 'B': 'she'}
-        l2g.rows_with_genes = []
-        l2g.location_to_gene_dict = {1: []}
-        l2g.gene_to_location_dict = {5: []}
-        l2g.update_loc_value(args)
-        assert l2g.rows_with_genes[0] == [1, 2, 3, 4, 5, 'he', 'she']
-        assert l2g.gene_to_location_dict[5][0] == 1
-        assert l2g.location_to_gene_dict[1][0] == 5
+        l2g.header, l2g.hdr_gene_idx = ['idx', 'gene_idx', 'A'], 1
+        l2g.location_to_gene_dict, l2g.gene_to_location_dict = defaultdict(list), defaultdict(list)
+        loc_df = pd.DataFrame({'idx': [0, 1, 2], 'gene_idx': -1, 'A': ['he', 'she', 'they']})
+        l2g.set_assignment_pairs(np.array([1, 1, 2]), np.array([5, 6, 5]), loc_df)
+        assert l2g.rows_with_genes == [[1, 5, 'she'], [1, 6, 'she'], [2, 5, 'they']]
+        assert l2g.location_to_gene_dict == {1: [5, 6], 2: [5]}
+        assert l2g.gene_to_location_dict == {5: [1, 2], 6: [1]}
+        assert [a.tolist() for a in l2g.get_assignment_pairs()] == [[1, 1, 2], [5, 6, 5]]
 
     def test_check_chr(self):
         l2g = Epi2Gene('', [])
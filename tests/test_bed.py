@@ -18,6 +18,7 @@
 import os
 import shutil
 import tempfile
+import numpy as np
 import pandas as pd
 import unittest
 
@@ -77,6 +78,18 @@ class TestBed(TestClass):
         assert len(found_genes) == len(genes)
         assert len(annotated_genes) > len(genes)
 
+    def test_nested_genes(self):
+        self.setup_class()
+        # Genes nested in the body of a longer gene are assigned too (Gm7417 sits inside Alkal1), the gene by gene
+        # walk used before the interval index missed these and found 49 pairs
+        bed = Bed(self.h3k27me3, overlap_method='overlaps', header_extra='3')
+        bed.set_annotation_from_file(self.mm10_annot)
+        bed.assign_locations_to_genes()
+        loc_df = bed.assign_gene_info_to_loc_df(bed.get_columns_in_gene_info())
+        assert len(loc_df) == 53
+        for peak_idx in [23, 24]:
+            assert {'Alkal1', 'Gm7417'} <= set(loc_df[loc_df['peak_idx'] == peak_idx]['external_gene_name'])
+
     def test_bed_annot(self):
         self.setup_class()
         """ Tests the generic function of the bed data """
@@ -133,6 +146,185 @@ class TestBed(TestClass):
         assert len(found_genes) == len(genes)
         assert len(annotated_genes) > len(genes)
 
+    def test_grid_matches_single_run(self):
+        self.setup_class()
+        # Each setting of a grid gives the same output as a single run with that setting
+        settings = [{'overlap_method': 'in_promoter', 'buffer_before_tss': 20000},
+                    {'overlap_method': 'overlaps', 'buffer_gene_overlap': 5000},
+                    {'overlap_method': 'in_promoter', 'buffer_before_tss': 100, 'buffer_after_tss': 0},
+                    {'overlap_method': 'overlaps', 'buffer_gene_overlap': 0}]
+        grid = Bed(self.h3k27me3, overlap_method='overlaps', header_extra='3')
+        grid.set_annotation_from_file(self.mm10_annot)
+        results = grid.assign_locations_to_genes_grid(settings, long_format=False)
+        for setting_id, setting in enumerate(settings):
+            bed = Bed(self.h3k27me3, header_extra='3', **setting)
+            bed.set_annotation_from_file(self.mm10_annot)
+            bed.assign_locations_to_genes()
+            expected = bed.assign_gene_info_to_loc_df(bed.get_columns_in_gene_info())
+            assert len(expected) > 0
+            assert results[setting_id].equals(expected)
+
+    def test_locations_for_genes(self):
+        self.setup_class()
+        bed = Bed(self.h3k27me3, overlap_method='overlaps', header_extra='3')
+        bed.set_annotation_from_file(self.mm10_annot)
+        settings = [{}, {'overlap_method': 'in_promoter'}, {'buffer_before_tss': 20000, 'buffer_after_tss': 5000}]
+        results = bed.assign_locations_to_genes_grid(settings, long_format=False)
+        for setting_id, setting in enumerate(settings):
+            expected = results[setting_id]
+            genes = list(expected['external_gene_name'].unique()[::2])
+            found = bed.locations_for_genes(genes, setting)
+            expected = expected[expected['external_gene_name'].isin(genes)].reset_index(drop=True)
+            assert len(found) > 0
+            assert found.equals(expected)
+        # The input is only read for the first call, and the object's own settings weren't changed
+        location_index = bed.location_index
+        found = bed.locations_for_genes(genes, {'overlap_method': 'in_promoter'})
+        assert bed.location_index is location_index
+        assert bed.overlap_method == 'overlaps'
+        # Other id columns, and genes that don't have any locations
+        ensembl_ids = bed.gene_annot_df['ensembl_gene_id'].values[found['gene_idx'].values]
+        assert found.equals(bed.locations_for_genes(list(ensembl_ids), {'overlap_method': 'in_promoter'},
+                                                    id_column='ensembl_gene_id'))
+        assert len(bed.locations_for_genes(['NotAGene'])) == 0
+
+    def test_transcript_rollup(self):
+        self.setup_class()
+        # A transcript table: every gene has its own TSS, a copy sharing it and an alternative TSS 3kb downstream
+        annot_df = pd.read_csv(self.mm10_annot)
+        shifted = annot_df.copy()
+        shift = np.where(shifted['strand'] > 0, 3000, -3000)
+        shifted['start_position'] += shift
+        shifted['end_position'] += shift
+        transcripts = pd.concat([annot_df, annot_df, shifted], ignore_index=True)
+        transcripts['ensembl_transcript_id'] = [f'T{i}' for i in range(len(transcripts))]
+        transcripts.to_csv(f'{self.tmp_dir}transcripts.csv', index=False)
+        bed = Bed(self.h3k27me3, overlap_method='in_promoter', header_extra='3')
+        bed.set_annotation_from_file(f'{self.tmp_dir}transcripts.csv')
+        settings = [{}, {'buffer_before_tss': 10000}]
+        all_pairs = bed.assign_locations_to_genes_grid(settings, long_format=False)
+        rolled_up = bed.assign_locations_to_genes_grid(settings, long_format=False, rollup_column='ensembl_gene_id')
+        gene_ids = bed.gene_annot_df['ensembl_gene_id'].values
+        tss = np.where(bed.gene_annot_df['strand'] > 0, bed.gene_annot_df['start_position'],
+                       bed.gene_annot_df['end_position'])
+        for setting_id in range(len(settings)):
+            # Closest TSS of each gene (first transcript on ties) from every matching transcript
+            expected = all_pairs[setting_id].copy()
+            expected['gene_id'] = gene_ids[expected['gene_idx'].values]
+            loc_tss = tss[expected['gene_idx'].values]
+            expected['tss_distance'] = np.maximum(np.maximum(expected['start'].astype(int) - loc_tss,
+                                                             loc_tss - expected['end'].astype(int)), 0)
+            expected['num_transcripts'] = expected.groupby(['peak_idx', 'gene_id'])['gene_idx'].transform('size')
+            expected = expected.sort_values(['peak_idx', 'gene_id', 'tss_distance', 'gene_idx'])
+            expected = expected.drop_duplicates(['peak_idx', 'gene_id']).sort_values(['peak_idx', 'gene_idx'])
+            found = rolled_up[setting_id]
+            assert len(found) > 0
+            assert len(found) < len(all_pairs[setting_id])
+            assert found.equals(expected.drop(columns='gene_id').reset_index(drop=True))
+            assert not found.duplicated(['peak_idx', 'external_gene_name']).any()
+            assert found['num_transcripts'].max() >= 2
+
+    def test_reannotate(self):
+        self.setup_class()
+        gene_columns = {'gene_chr': 2, 'gene_start': 3, 'gene_end': 4, 'gene_direction': 5, 'gene_name': 1}
+        bed = Bed(self.h3k27me3, overlap_method='overlaps', header_extra='3', **gene_columns)
+        bed.set_annotation_from_file(self.mm10_annot)
+        bed.assign_locations_to_genes_grid([{}]).drop(columns='setting_id').to_csv(f'{self.tmp_dir}previous.csv',
+                                                                                  index=False)
+        previous_df = pd.read_csv(f'{self.tmp_dir}previous.csv')
+        # Remove, move, rename and add a gene that had locations
+        old_annot_df = pd.read_csv(self.mm10_annot)
+        genes = previous_df['ensembl_gene_id'].unique()
+        annot_df = old_annot_df[old_annot_df['ensembl_gene_id'] != genes[0]].copy()
+        moved = annot_df['ensembl_gene_id'] == genes[1]
+        annot_df.loc[moved, 'start_position'] += 100000
+        annot_df.loc[moved, 'end_position'] += 100000
+        annot_df.loc[annot_df['ensembl_gene_id'] == genes[2], 'external_gene_name'] = 'Renamed'
+        added = annot_df[annot_df['ensembl_gene_id'] == genes[3]].copy()
+        added['ensembl_gene_id'], added['external_gene_name'] = 'ENSMUSG_NEW', 'New'
+        pd.concat([annot_df, added]).to_csv(f'{self.tmp_dir}new_annot.csv', index=False)
+
+        bed = Bed(self.h3k27me3, overlap_method='overlaps', header_extra='3', **gene_columns)
+        bed.set_annotation_from_file(f'{self.tmp_dir}new_annot.csv')
+        diff = bed.diff_annotation(old_annot_df).set_index('ensembl_gene_id')['status']
+        assert diff[genes[0]] == 'removed'
+        assert diff[genes[1]] == 'moved'
+        assert diff[genes[2]] == 'unchanged'
+        assert diff['ENSMUSG_NEW'] == 'added'
+        assert (diff == 'unchanged').sum() == len(old_annot_df) - 2
+
+        bed.reannotate(previous_df, old_annot_df).to_csv(f'{self.tmp_dir}updated.csv', index=False)
+        # Same as running it all again with the new annotation
+        expected = Bed(self.h3k27me3, overlap_method='overlaps', header_extra='3', **gene_columns)
+        expected.set_annotation_from_file(f'{self.tmp_dir}new_annot.csv')
+        expected.assign_locations_to_genes_grid([{}]).drop(columns='setting_id').to_csv(f'{self.tmp_dir}expected.csv',
+                                                                                       index=False)
+        updated_df = pd.read_csv(f'{self.tmp_dir}updated.csv')
+        assert updated_df.equals(pd.read_csv(f'{self.tmp_dir}expected.csv'))
+        assert 'Renamed' in updated_df['external_gene_name'].values
+        assert 'New' in updated_df['external_gene_name'].values
+        assert genes[0] not in updated_df['ensembl_gene_id'].values
+
+    def test_duplicate_locations(self):
+        self.setup_class()
+        # Every peak twice, the copies are assigned the genes of the first without searching again
+        duplicated = f'{self.tmp_dir}duplicated.bed'
+        with open(self.h3k27me3) as f, open(duplicated, 'w') as out:
+            for line in f:
+                out.write(line + line)
+        outputs = []
+        for filename in [self.h3k27me3, duplicated]:
+            bed = Bed(filename, overlap_method='overlaps', header_extra='3')
+            bed.set_annotation_from_file(self.mm10_annot)
+            bed.stats.enable()
+            bed.assign_locations_to_genes()
+            outputs.append(bed.assign_gene_info_to_loc_df(bed.get_columns_in_gene_info()))
+        assert bed.stats.counters['duplicate_locations'] == len(pd.read_csv(self.h3k27me3, sep='\t', header=None))
+        expected, got = outputs
+        assert len(got) == 2 * len(expected) > 0
+        for copy in range(2):
+            copy_df = got[got['peak_idx'] % 2 == copy].reset_index(drop=True)
+            copy_df['peak_idx'] //= 2
+            assert copy_df.equals(expected)
+        # The index engine gives every copy the same genes too
+        grid_df = bed.assign_locations_to_genes_grid([{}])
+        assert len(grid_df) == 2 * len(grid_df.drop_duplicates(['chr', 'start', 'end', 'gene_idx'])) > 0
+
+    def test_filtered_bed(self):
+        self.setup_class()
+        # Each assigned peak is written once (even if it is assigned to several genes), in the order of the (sorted)
+        # input
+        outputs = []
+        for filename in [f'{self.tmp_dir}filtered.bed', f'{self.tmp_dir}filtered.bed.gz']:
+            bed = Bed(self.h3k27me3, overlap_method='overlaps', header_extra='3', output_bed_file=filename)
+            bed.set_annotation_from_file(self.mm10_annot)
+            bed.assign_locations_to_genes()
+            outputs.append(pd.read_csv(filename, sep='\t', header=None))
+        loc_df = bed.assign_gene_info_to_loc_df(bed.get_columns_in_gene_info())
+        peaks_df = pd.read_csv(self.h3k27me3, sep='\t', header=None)
+        expected = peaks_df.iloc[loc_df['peak_idx'].unique()].reset_index(drop=True)
+        assert 0 < len(expected) < len(loc_df)
+        for filtered_df in outputs:
+            assert filtered_df.equals(expected)
+
+    def test_filtered_bed_unsorted(self):
+        self.setup_class()
+        # An unsorted input is written in its own (input) order, the same lines as for the sorted input
+        unsorted = f'{self.tmp_dir}h3k27me3_unsorted.bed'
+        with open(self.h3k27me3) as f:
+            lines = f.readlines()
+        with open(unsorted, 'w') as f:
+            f.writelines(lines[::-1])
+        outputs = []
+        for i, filename in enumerate([self.h3k27me3, unsorted]):
+            output_file = f'{self.tmp_dir}filtered_{i}.bed'
+            bed = Bed(filename, overlap_method='overlaps', header_extra='3', output_bed_file=output_file)
+            bed.set_annotation_from_file(self.mm10_annot)
+            bed.assign_locations_to_genes()
+            outputs.append(pd.read_csv(output_file, sep='\t', header=None))
+        assert len(outputs[0]) > 0
+        assert outputs[0].iloc[::-1].reset_index(drop=True).equals(outputs[1])
+
     def test_bed_arg_parse_err(self):
         self.setup_class()
         # Test raises an exception when we pass a value that isn't within the range
@@ -0,0 +1,154 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+from scie2g import Bed, Csv
+from scie2g.cache import ResultCache, hash_df, hash_file
+from scie2g.chromosomes import ChromosomeIndex
+
+
+class TestClass(unittest.TestCase):
+
+    @classmethod
+    def setup_class(self):
+        local = True
+        # Create a base object since it will be the same for all the tests
+        THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+        self.data_dir = os.path.join(THIS_DIR, 'data/')
+        if local:
+            self.tmp_dir = os.path.join(THIS_DIR, 'data/tmp/')
+            if os.path.exists(self.tmp_dir):
+                shutil.rmtree(self.tmp_dir)
+            os.mkdir(self.tmp_dir)
+        else:
+            self.tmp_dir = tempfile.mkdtemp(prefix='scie2g_tmp_')
+        # Setup the default data for each of the tests
+        self.h3k27me3 = os.path.join(self.data_dir, 'test_H3K27me3.bed')
+        self.methyl_overlaps = os.path.join(self.data_dir, 'test_methyl_overlaps.csv')
+
+        self.mm10_annot = os.path.join(self.data_dir, 'mmusculus_gene_ensembl-GRCm38.p6.csv')
+        self.hg38_annot = os.path.join(self.data_dir, 'hsapiens_gene_ensembl-GRCh38.p13.csv')
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestCache(TestClass):
+
+    def test_lru(self):
+        cache = ResultCache(os.path.join(self.tmp_dir, 'lru'), max_size=10000)
+        pairs = np.arange(300)
+        keys = [cache.key('input', 'annot', {'overlap_method': m}) for m in ['a', 'b', 'c']]
+        assert len(set(keys)) == 3
+        assert cache.get(keys[0]) is None
+        cache.put(keys[0], pairs, pairs + 1)
+        cache.put(keys[1], pairs, pairs + 2)
+        assert len(cache) == 2
+        # Use the first so the second is the least recently used
+        assert list(cache.get(keys[0])['gene_idx']) == list(pairs + 1)
+        cache.put(keys[2], pairs, pairs + 3)
+        assert cache.size() <= 10000
+        assert cache.get(keys[1]) is None
+        assert cache.get(keys[0]) is not None and cache.get(keys[2]) is not None
+        cache.clear()
+        assert len(cache) == 0
+
+    def check_cached(self, make_e2g, annotation):
+        """ A second run loads the pairs from the cache, the outputs must match the first run. """
+        outputs = []
+        for run in range(2):
+            e2g = make_e2g()
+            e2g.set_annotation_from_file(annotation)
+            e2g.stats.enable()
+            e2g.assign_locations_to_genes()
+            assert e2g.stats.counters['cache_hits' if run else 'cache_misses'] == 1
+            loc_file, gene_file = os.path.join(self.tmp_dir, f'loc_{run}.csv'), \
+                os.path.join(self.tmp_dir, f'gene_{run}.csv')
+            e2g.save_loc_to_csv(loc_file)
+            e2g.get_gene_info_as_df()
+            e2g.save_gene_info_to_csv(gene_file)
+            outputs.append((pd.read_csv(loc_file), pd.read_csv(gene_file)))
+        assert len(outputs[0][0]) > 0
+        assert outputs[0][0].equals(outputs[1][0])
+        assert outputs[0][1].equals(outputs[1][1])
+
+    def test_bed_cache(self):
+        cache_dir = os.path.join(self.tmp_dir, 'bed_cache')
+        self.check_cached(lambda: Bed(self.h3k27me3, overlap_method='overlaps', header_extra='3',
+                                      cache_dir=cache_dir), self.mm10_annot)
+        # A different setting is a different result
+        bed = Bed(self.h3k27me3, overlap_method='in_promoter', header_extra='3', cache_dir=cache_dir)
+        bed.set_annotation_from_file(self.mm10_annot)
+        bed.stats.enable()
+        bed.assign_locations_to_genes()
+        assert bed.stats.counters['cache_misses'] == 1
+        assert len(os.listdir(cache_dir)) == 2
+
+    def test_csv_cache(self):
+        cache_dir = os.path.join(self.tmp_dir, 'csv_cache')
+        self.check_cached(lambda: Csv(self.methyl_overlaps, 'chr', 'start', 'end', 'meth.diff', ['pvalue', 'qvalue'],
+                                      overlap_method='overlaps', cache_dir=cache_dir), self.hg38_annot)
+
+    def test_contig_order(self):
+        # Contigs that aren't numbered or named (scaffolds, chrUn_*) are coded in the order a process first sees
+        # them, the cached location indexes are in that order so another order must not reuse them
+        annotation = os.path.join(self.tmp_dir, 'contig_annotation.csv')
+        # Only one contig has genes so the annotation (and its hash) is the same in either order
+        pd.DataFrame({'chromosome_name': ['scaffold_b'], 'external_gene_name': ['geneB'], 'start_position': [10000],
+                      'end_position': [12000], 'strand': [1]}).to_csv(annotation, index=False)
+        locations = os.path.join(self.tmp_dir, 'contig_locations.csv')
+        pd.DataFrame({'chr': ['scaffold_a', 'scaffold_b', 'scaffold_b'], 'start': [9000, 9000, 50000],
+                      'end': [9100, 9100, 50100], 'value': [1, 2, 3]}).to_csv(locations, index=False)
+        cache_dir = os.path.join(self.tmp_dir, 'contig_cache')
+
+        def run(contig_order, cache=True):
+            csv = Csv(locations, 'chr', 'start', 'end', 'value', [], overlap_method='in_promoter',
+                      cache_dir=cache_dir if cache else None)
+            csv.chromosomes = ChromosomeIndex()
+            csv.chromosomes.codes(contig_order)
+            csv.set_annotation_from_file(annotation)
+            csv.stats.enable()
+            csv.assign_locations_to_genes()
+            loc_df = csv.assign_gene_info_to_loc_df(csv.get_columns_in_gene_info())
+            return csv.stats.counters, loc_df[['chr', 'start', 'value', 'external_gene_name']]
+
+        counters, first = run(['scaffold_a', 'scaffold_b'])
+        assert counters['cache_misses'] == 1 and len(first) == 1
+        counters, reordered = run(['scaffold_b', 'scaffold_a'])
+        assert counters['cache_misses'] == 1
+        assert reordered.equals(run(['scaffold_b', 'scaffold_a'], cache=False)[1])
+        assert set(map(tuple, reordered.values)) == set(map(tuple, first.values))
+        counters, again = run(['scaffold_a', 'scaffold_b'])
+        assert counters['cache_hits'] == 1
+        assert again.equals(first)
+
+    def test_hashes(self):
+        assert hash_file(self.h3k27me3) == hash_file(self.h3k27me3)
+        assert hash_file(self.h3k27me3) != hash_file(self.methyl_overlaps)
+        df = pd.read_csv(self.methyl_overlaps)
+        assert hash_df(df) == hash_df(df.copy())
+        changed = df.copy()
+        changed.loc[0, 'start'] += 1
+        assert hash_df(df) != hash_df(changed)
@@ -0,0 +1,50 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import unittest
+
+from scie2g.chromosomes import ChromosomeIndex, canonical_chr_name
+
+
+class TestChromosomes(unittest.TestCase):
+
+    def test_canonical_chr_name(self):
+        assert canonical_chr_name('chr1') == '1'
+        assert canonical_chr_name('1') == '1'
+        assert canonical_chr_name(1) == '1'
+        assert canonical_chr_name('"chr10"') == '10'
+        assert canonical_chr_name('chrX') == 'X'
+        assert canonical_chr_name('chrM') == 'MT'
+        assert canonical_chr_name('MT') == 'MT'
+        assert canonical_chr_name('NC_000001.11') == '1'
+        assert canonical_chr_name('NC_000023.11') == 'X'
+        assert canonical_chr_name('NC_012920.1') == 'MT'
+        assert canonical_chr_name('NC_000067.7') == '1'  # Mouse chr1
+        assert canonical_chr_name('NC_000086.8') == 'X'  # Mouse chrX
+        assert canonical_chr_name('chrUn_KI270302v1') == 'KI270302.1'
+        assert canonical_chr_name('chr1_KI270706v1_random') == 'KI270706.1'
+        assert canonical_chr_name('KI270706.1') == 'KI270706.1'
+
+    def test_codes(self):
+        chromosomes = ChromosomeIndex()
+        assert chromosomes.code('chr1') == chromosomes.code('1') == chromosomes.code('NC_000001.11')
+        assert chromosomes.code('chrM') == chromosomes.code('MT')
+        # Canonical order: numbered, then named then anything else in the order first seen
+        codes = chromosomes.codes(['chr2', 'GL000194.1', 'chr10', 'chrY', 'chrX', 'chrM', 'KI270706.1', 'chr1'])
+        assert list(codes.argsort()) == [7, 0, 2, 4, 3, 5, 1, 6]
+        assert chromosomes.name(chromosomes.code('chrUn_KI270706v1')) == 'KI270706.1'
+        assert list(chromosomes.codes(['chr1', None])) == [1, -1]
@@ -0,0 +1,180 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+from scie2g import Coverage, Epi2GeneException
+from scie2g.coverage import CoverageTrack, build_max_table, iter_chromosomes, query_max_table
+from scie2g.index import gene_windows
+
+
+def per_base_signal(starts, ends, values, length):
+    """ Signal at every base (0 if not covered) and whether it is covered, to check the window sums against. """
+    signal, covered = np.zeros(length), np.zeros(length, dtype=bool)
+    for start, end, value in zip(starts, ends, values):
+        signal[start: end], covered[start: end] = value, True
+    return signal, covered
+
+
+class TestClass(unittest.TestCase):
+
+    @classmethod
+    def setup_class(self):
+        local = True
+        # Create a base object since it will be the same for all the tests
+        THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+        self.data_dir = os.path.join(THIS_DIR, 'data/')
+        if local:
+            self.tmp_dir = os.path.join(THIS_DIR, 'data/tmp/')
+            if os.path.exists(self.tmp_dir):
+                shutil.rmtree(self.tmp_dir)
+            os.mkdir(self.tmp_dir)
+        else:
+            self.tmp_dir = tempfile.mkdtemp(prefix='scie2g_tmp_')
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestCoverage(TestClass):
+
+    def test_max_table(self):
+        rng = np.random.default_rng(0)
+        values = rng.normal(size=50)
+        table = build_max_table(values)
+        first = rng.integers(0, 50, size=200)
+        last = first + rng.integers(0, 10, size=200)
+        last = np.minimum(last, 50)
+        maxes = query_max_table(table, first, last)
+        for f, l, m in zip(first, last, maxes):
+            assert m == (values[f: l].max() if l > f else -np.inf)
+
+    def test_window_signal(self):
+        rng = np.random.default_rng(1)
+        # Non overlapping intervals with gaps, given out of order
+        bounds = np.sort(rng.choice(np.arange(1, 1000), size=60, replace=False))
+        starts, ends = bounds[0::2], bounds[1::2]
+        values = rng.normal(size=len(starts))
+        order = rng.permutation(len(starts))
+        track = CoverageTrack(starts[order], ends[order], values[order])
+        signal, covered = per_base_signal(starts, ends, values, 1200)
+        lo = rng.integers(0, 1000, size=100)
+        hi = lo + rng.integers(1, 200, size=100)
+        total, covered_bases, maxes = track.window_signal(lo, hi)
+        for i in range(len(lo)):
+            assert np.isclose(total[i], signal[lo[i]: hi[i]].sum())
+            assert covered_bases[i] == covered[lo[i]: hi[i]].sum()
+            assert maxes[i] == signal[lo[i]: hi[i]].max()
+        with self.assertRaises(Epi2GeneException):
+            CoverageTrack(np.array([0, 5]), np.array([10, 15]), np.array([1.0, 2.0]))
+
+    def test_iter_chromosomes(self):
+        self.setup_class()
+        bedgraph = os.path.join(self.tmp_dir, 'chunks.bedGraph.gz')
+        with gzip.open(bedgraph, 'wt') as f:
+            f.write('track type=bedGraph\n')
+            for chrom, n in [('chr1', 5), ('chr2', 1), ('chr3', 4)]:
+                for i in range(n):
+                    f.write(f'{chrom}\t{i * 10}\t{i * 10 + 5}\t{i}\n')
+        # Chromosomes are split across chunks
+        chromosomes = list(iter_chromosomes(bedgraph, chunk_rows=3))
+        assert [c[0] for c in chromosomes] == ['chr1', 'chr2', 'chr3']
+        assert [len(c[1]) for c in chromosomes] == [5, 1, 4]
+        assert list(chromosomes[2][3]) == [0.0, 1.0, 2.0, 3.0]
+        unsorted = os.path.join(self.tmp_dir, 'unsorted.bedGraph')
+        with open(unsorted, 'w') as f:
+            f.write('chr1\t0\t5\t1\nchr2\t0\t5\t1\nchr1\t10\t15\t1\n')
+        with self.assertRaises(Epi2GeneException):
+            list(iter_chromosomes(unsorted))
+
+    def test_coverage(self):
+        self.setup_class()
+        rng = np.random.default_rng(2)
+        # Genes on three chromosomes, only the first two have coverage (the track has the chr prefix)
+        starts = rng.integers(0, 50000, size=300)
+        annot_df = pd.DataFrame({'chromosome_name': rng.choice(['1', '2', '3'], size=300),
+                                 'external_gene_name': [f'gene{i}' for i in range(300)], 'start_position': starts,
+                                 'end_position': starts + rng.integers(100, 5000, size=300),
+                                 'strand': rng.choice([-1, 1], size=300)})
+        annotation = os.path.join(self.tmp_dir, 'coverage_annotation.csv')
+        annot_df.to_csv(annotation, index=False)
+        bedgraph = os.path.join(self.tmp_dir, 'coverage.bedGraph')
+        tracks = {}
+        with open(bedgraph, 'w') as f:
+            f.write('track type=bedGraph name=test\n')
+            for chrom in ['1', '2']:
+                bounds = np.unique(rng.integers(0, 60000, size=400))
+                starts, ends = bounds[0:-1:2], bounds[1::2]
+                values = np.round(rng.uniform(0, 10, size=len(starts)), 3)
+                tracks[chrom] = per_base_signal(starts, ends, values, 60000)
+                for start, end, value in zip(starts, ends, values):
+                    f.write(f'chr{chrom}\t{start}\t{end}\t{value}\n')
+        for method in ['in_promoter', 'overlaps']:
+            cov = Coverage(bedgraph, overlap_method=method, chunk_rows=50)
+            cov.set_annotation_from_file(annotation)
+            signal_df = cov.assign_signal_to_genes()
+            assert len(signal_df) == cov.num_genes
+            _, starts, ends, directions = cov.get_gene_arrays()
+            lo, hi = gene_windows(starts, ends, directions, method, 2500, 500, 500)
+            gene_chrs = cov.gene_annot_df['chromosome_name'].astype(str).values
+            for i in range(cov.num_genes):
+                row = signal_df.iloc[i]
+                if gene_chrs[i] not in tracks:
+                    assert row['covered_bases'] == 0 and row['max_signal'] == 0
+                    continue
+                signal, covered = tracks[gene_chrs[i]]
+                # Bases lo - 1 to hi overlap the window (see get_gene_window_bases)
+                window = slice(max(lo[i] - 1, 0), hi[i] + 1)
+                assert row['window_start'] == max(lo[i] - 1, 0) and row['window_end'] == hi[i] + 1
+                assert np.isclose(row['total_signal'], signal[window].sum())
+                assert np.isclose(row['mean_signal'], signal[window].mean())
+                assert row['max_signal'] == signal[window].max()
+                assert row['covered_bases'] == covered[window].sum()
+            output_file = os.path.join(self.tmp_dir, f'coverage_{method}.csv')
+            cov.save_loc_to_csv(output_file)
+            saved = pd.read_csv(output_file)
+            assert 0 < len(saved) == (signal_df['covered_bases'] > 0).sum()
+
+    def test_window_edges(self):
+        self.setup_class()
+        # One base intervals on each edge of a window count only if a one base location there would be assigned
+        annotation = os.path.join(self.tmp_dir, 'edge_annotation.csv')
+        pd.DataFrame({'chromosome_name': ['1'], 'external_gene_name': ['gene0'], 'start_position': [10000],
+                      'end_position': [12000], 'strand': [1]}).to_csv(annotation, index=False)
+        lo, hi = gene_windows(np.array([10000]), np.array([12000]), np.array([1]), 'overlaps', 2500, 500, 500)
+        lo, hi = int(lo[0]), int(hi[0])
+        for base, value in zip([lo - 2, lo - 1, hi, hi + 1], [1, 10, 100, 1000]):
+            bedgraph = os.path.join(self.tmp_dir, f'edge_{base}.bedGraph')
+            with open(bedgraph, 'w') as f:
+                f.write(f'chr1\t{base}\t{base + 1}\t{value}\n')
+            cov = Coverage(bedgraph, overlap_method='overlaps')
+            cov.set_annotation_from_file(annotation)
+            # The same base as a location
+            offsets, _ = cov.query(['1'], [base], [base + 1])
+            assigned = offsets[1] == 1
+            assert assigned == (lo - 1 <= base <= hi)
+            signal_df = cov.assign_signal_to_genes()
+            assert signal_df['covered_bases'].values[0] == int(assigned)
+            assert signal_df['total_signal'].values[0] == (value if assigned else 0)
@@ -19,6 +19,7 @@ import os
 import shutil
 import tempfile
 import unittest
+import numpy as np
 import pandas as pd
 
 from scie2g.csv import Csv, Epi2GeneException
@@ -155,3 +156,174 @@ class TestCsv(TestClass):
             f = Csv(self.methyl_overlaps, 'chr', 'start', 'genes', 'meth.diff',
                     ['pvalue', 'qvalue', 'description', 'genes'], sep='\t')
             print(context)
+
+    def test_csv_grid(self):
+        self.setup_class()
+        """ Each setting in a grid should match running the overlap test with those parameters """
+        f = Csv(self.methyl_overlaps,  'chr', 'start', 'end', 'meth.diff', ['pvalue', 'qvalue', 'description', 'genes'])
+        f.set_annotation_from_file(self.hg38_annot)
+        param_sets = [{'buffer_before_tss': 100}, {'overlap_method': 'overlaps'},
+                      {'buffer_before_tss': 5000, 'buffer_gene_overlap': 1000}]
+        grid_df = f.assign_locations_to_genes_grid(param_sets)
+        assert sorted(set(grid_df['setting_id'].values)) == [0, 1, 2]
+        # Check we can also get one DataFrame per setting
+        results = f.assign_locations_to_genes_grid(param_sets, long_format=False)
+        assert len(results) == 3
+        assert len(results[1]) == len(grid_df[grid_df['setting_id'] == 1])
+
+        loc_df = f.read_locations()
+        for setting_id, setting in enumerate(f.get_sweep_settings(param_sets)):
+            for p in setting:
+                setattr(f, p, setting[p])
+            expected = set()
+            for loc_idx, (start, end) in enumerate(zip(loc_df['start'].values, loc_df['end'].values)):
+                for gene_idx in range(f.num_genes):
+                    gene = f.gene_annot_values[gene_idx]
+                    if gene[0] == loc_df['chr'].values[loc_idx] and f.overlaps(gene[2], gene[3], gene[4], start, end):
+                        expected.add((loc_idx, gene_idx))
+            setting_df = grid_df[grid_df['setting_id'] == setting_id]
+            assert set(zip(setting_df['idx'].values, setting_df['gene_idx'].values)) == expected
+
+        # Check an unknown parameter raises an error
+        with self.assertRaises(Epi2GeneException) as context:
+            f.assign_locations_to_genes_grid([{'upflank': 10}])
+
+    def test_csv_direction_aware(self):
+        self.setup_class()
+        # Every region on the + strand, the - strand and unstranded
+        stranded = os.path.join(self.tmp_dir, 'stranded.csv')
+        df = pd.read_csv(self.methyl_overlaps)
+        df = pd.concat([df.assign(direction=d) for d in ['+', '-', '.']], ignore_index=True)
+        df.sort_values(['chr', 'start'], kind='stable').to_csv(stranded, index=False)
+        f = Csv(stranded, 'chr', 'start', 'end', 'meth.diff', ['direction'], overlap_method='overlaps',
+                direction_aware=True)
+        f.set_annotation_from_file(self.hg38_annot)
+        f.assign_locations_to_genes()
+        loc_df = f.assign_gene_info_to_loc_df(f.get_columns_in_gene_info())
+        # Same strand genes only, unstranded regions get genes on both strands
+        unstranded = Csv(stranded, 'chr', 'start', 'end', 'meth.diff', ['direction'], overlap_method='overlaps')
+        unstranded.set_annotation_from_file(self.hg38_annot)
+        all_df = unstranded.assign_locations_to_genes_grid([{}]).drop(columns='setting_id')
+        strands = np.where(all_df['strand'] > 0, '+', '-')
+        expected = all_df[(all_df['direction'] == '.') | (all_df['direction'] == strands)]
+        assert len(expected) > 0
+        assert set(expected['direction']) == {'+', '-', '.'}
+        assert list(zip(loc_df['idx'], loc_df['gene_idx'])) == list(zip(expected['idx'], expected['gene_idx']))
+        grid_df = f.assign_locations_to_genes_grid([{}]).drop(columns='setting_id')
+        assert grid_df.equals(expected.reset_index(drop=True))
+        # Each setting of a stranded grid gives the same output as a stranded single run with that setting
+        settings = [{'overlap_method': 'in_promoter', 'buffer_before_tss': 5000}, {'buffer_gene_overlap': 1000}]
+        results = f.assign_locations_to_genes_grid(settings, long_format=False)
+        for setting_id, setting in enumerate(settings):
+            single = Csv(stranded, 'chr', 'start', 'end', 'meth.diff', ['direction'], direction_aware=True,
+                         **{'overlap_method': 'overlaps', **setting})
+            single.set_annotation_from_file(self.hg38_annot)
+            single.assign_locations_to_genes()
+            assert results[setting_id].equals(single.assign_gene_info_to_loc_df(single.get_columns_in_gene_info()))
+        # Same for the memory budgeted run and batch queries
+        f_chunked = Csv(stranded, 'chr', 'start', 'end', 'meth.diff', ['direction'], overlap_method='overlaps',
+                        direction_aware=True, max_memory='1M')
+        f_chunked.set_annotation_from_file(self.hg38_annot)
+        f_chunked.assign_locations_to_genes()
+        f_chunked.save_loc_to_csv(os.path.join(self.tmp_dir, 'stranded_chunked.csv'))
+        chunked_df = pd.read_csv(os.path.join(self.tmp_dir, 'stranded_chunked.csv'))
+        assert list(chunked_df['gene_idx']) == list(expected['gene_idx'])
+        offsets, gene_idx = f.query(df['chr'], df['start'], df['end'] + 1, df['direction'])
+        assert len(gene_idx) == len(expected)
+
+    def test_csv_stranded_subset(self):
+        self.setup_class()
+        # A stranded run uses the same engine as an unstranded one, so it only ever drops pairs
+        stranded = os.path.join(self.tmp_dir, 'stranded_subset.csv')
+        df = pd.read_csv(self.methyl_overlaps)
+        df.assign(direction=np.where(np.arange(len(df)) % 3 == 0, '+', np.where(np.arange(len(df)) % 3 == 1, '-', '.')))\
+            .to_csv(stranded, index=False)
+        for method in ['in_promoter', 'overlaps']:
+            pairs = []
+            for direction_aware in [False, True]:
+                f = Csv(stranded, 'chr', 'start', 'end', 'meth.diff', ['direction'], overlap_method=method,
+                        direction_aware=direction_aware)
+                f.set_annotation_from_file(self.hg38_annot)
+                f.assign_locations_to_genes()
+                pairs.append(set(zip(*f.get_assignment_pairs())))
+            assert len(pairs[1]) > 0
+            assert pairs[1] <= pairs[0]
+
+    def test_convert_to_bed(self):
+        self.setup_class()
+        f = Csv(self.methyl_overlaps, 'chr', 'start', 'end', 'meth.diff', ['pvalue', 'genes'], overlap_method='overlaps')
+        f.set_annotation_from_file(self.hg38_annot)
+        f.assign_locations_to_genes()
+        loc_df = f.assign_gene_info_to_loc_df(f.get_columns_in_gene_info())
+        # Tab separated, one line per location after the track line, the same written in chunks and gzipped
+        beds = []
+        for filename, chunk_rows in [('methyl.bed', 500000), ('methyl_chunked.bed.gz', 1)]:
+            f.convert_to_bed(loc_df, os.path.join(self.tmp_dir, filename), 'Methyl', 'pvalue', 'genes',
+                             chunk_rows=chunk_rows)
+            beds.append(pd.read_csv(os.path.join(self.tmp_dir, filename), sep='\t', header=None, skiprows=1,
+                                    keep_default_na=False))
+        bed_df, chunked_df = beds
+        assert bed_df.equals(chunked_df)
+        assert bed_df.shape == (len(loc_df), 9)
+        assert list(bed_df[0].astype(str)) == list(loc_df['chr'].astype(str))
+        assert list(bed_df[3]) == list(loc_df['genes'].astype(str))
+        assert np.allclose(bed_df[4], -np.log10(loc_df['pvalue']))
+        # BED9: the strand is column 6, then thickStart, thickEnd and itemRgb
+        assert set(bed_df[5]) == {'.'}
+        assert list(bed_df[6]) == list(loc_df['start']) and list(bed_df[7]) == list(loc_df['end'])
+        assert set(bed_df[8]) == {'0,0,255'}
+        # Locations with a direction column get their strand
+        stranded_df = loc_df.assign(direction=np.where(np.arange(len(loc_df)) % 2 == 0, '+', '-'))
+        f.convert_to_bed(stranded_df, os.path.join(self.tmp_dir, 'stranded.bed'), 'Methyl', 'pvalue', 'genes')
+        stranded_bed = pd.read_csv(os.path.join(self.tmp_dir, 'stranded.bed'), sep='\t', header=None, skiprows=1)
+        assert list(stranded_bed[5]) == list(stranded_df['direction'])
+        # Missing p values don't shift the other scores and are written as ., only p values of 0 do
+        for pvalues, expected in [([np.nan, 0.1, 0.01], ['.', '1.0', '2.0']),
+                                  ([0, 0.1, 0.01], [str(-np.log10(0.01)), str(-np.log10(0.11)), str(-np.log10(0.02))])]:
+            scored_df = loc_df.iloc[:3].assign(pvalue=pvalues)
+            f.convert_to_bed(scored_df, os.path.join(self.tmp_dir, 'scored.bed'), 'Methyl', 'pvalue', 'genes')
+            scored_bed = pd.read_csv(os.path.join(self.tmp_dir, 'scored.bed'), sep='\t', header=None, skiprows=1,
+                                     dtype=str)
+            assert list(scored_bed[4]) == expected
+
+    def test_rerun(self):
+        self.setup_class()
+        # The same object can be run again (e.g. with other settings), nothing is kept from the previous run
+        f = Csv(self.methyl_overlaps, 'chr', 'start', 'end', 'meth.diff', ['genes'], overlap_method='overlaps')
+        f.set_annotation_from_file(self.hg38_annot)
+        f.assign_locations_to_genes()
+        overlaps_df = f.assign_gene_info_to_loc_df(f.get_columns_in_gene_info())
+        f.overlap_method = 'in_promoter'
+        f.assign_locations_to_genes()
+        promoter_df = f.assign_gene_info_to_loc_df(f.get_columns_in_gene_info())
+        expected = Csv(self.methyl_overlaps, 'chr', 'start', 'end', 'meth.diff', ['genes'], overlap_method='in_promoter')
+        expected.set_annotation_from_file(self.hg38_annot)
+        expected.assign_locations_to_genes()
+        assert promoter_df.equals(expected.assign_gene_info_to_loc_df(expected.get_columns_in_gene_info()))
+        assert len(promoter_df) < len(overlaps_df)
+        assert sum(len(genes) for genes in f.location_to_gene_dict.values()) == len(promoter_df)
+
+    def test_read_columns(self):
+        self.setup_class()
+        # Only the columns used are read, an unsorted file with unused columns gives the same output
+        unsorted = os.path.join(self.tmp_dir, 'methyl_unused_columns.csv')
+        df = pd.read_csv(self.methyl_overlaps)
+        df['notes'] = 'unused'
+        df.iloc[::-1].to_csv(unsorted, index=False)
+        f = Csv(unsorted, 'chr', 'start', 'end', 'meth.diff', ['pvalue'], overlap_method='overlaps')
+        assert list(f.read_csv().columns) == [c for c in df.columns if c in ['chr', 'start', 'end', 'meth.diff',
+                                                                            'pvalue']]
+        columns = f.format_df(f.read_csv())
+        assert columns['start'].dtype == np.int64
+        assert list(columns['start']) == sorted(df['start'].values)
+        f.set_annotation_from_file(self.hg38_annot)
+        f.assign_locations_to_genes()
+        expected = Csv(self.methyl_overlaps, 'chr', 'start', 'end', 'meth.diff', ['pvalue'], overlap_method='overlaps')
+        expected.set_annotation_from_file(self.hg38_annot)
+        expected.assign_locations_to_genes()
+        got = f.assign_gene_info_to_loc_df(f.get_columns_in_gene_info()).drop(columns='idx')
+        expected = expected.assign_gene_info_to_loc_df(expected.get_columns_in_gene_info()).drop(columns='idx')
+        assert len(got) > 0
+        # Rows starting at the same position can be in either order
+        assert got.sort_values(list(got.columns)).reset_index(drop=True).equals(
+            expected.sort_values(list(expected.columns)).reset_index(drop=True))
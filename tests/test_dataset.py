@@ -0,0 +1,109 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+
+from scie2g import Bed, Epi2Gene, Epi2GeneException
+from scie2g.dataset import PartitionedDataset, find_partitions, get_partition_chr
+
+
+class TestClass(unittest.TestCase):
+
+    @classmethod
+    def setup_class(self):
+        local = True
+        # Create a base object since it will be the same for all the tests
+        THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+        self.data_dir = os.path.join(THIS_DIR, 'data/')
+        if local:
+            self.tmp_dir = os.path.join(THIS_DIR, 'data/tmp/')
+            if os.path.exists(self.tmp_dir):
+                shutil.rmtree(self.tmp_dir)
+            os.mkdir(self.tmp_dir)
+        else:
+            self.tmp_dir = tempfile.mkdtemp(prefix='scie2g_tmp_')
+        # Setup the default data for each of the tests
+        self.h3k27me3 = os.path.join(self.data_dir, 'test_H3K27me3.bed')
+        self.mm10_annot = os.path.join(self.data_dir, 'mmusculus_gene_ensembl-GRCm38.p6.csv')
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestDataset(TestClass):
+
+    def test_partition_chr(self):
+        assert get_partition_chr('chr1.bed') == '1'
+        assert get_partition_chr('sample1_chrX.bed.gz') == 'X'
+        assert get_partition_chr('sample1/chrM.csv') == 'MT'
+        assert get_partition_chr('chrom=chr7/part-0.parquet') == '7'
+        assert get_partition_chr('chrom=12/sample=a/part-0.parquet') == '12'
+        assert get_partition_chr('sample1/peaks.bed') is None
+
+    def test_partitioned_dataset(self):
+        self.setup_class()
+        # Peaks split per sample and chromosome, plus a chromosome without any genes
+        dataset_dir = os.path.join(self.tmp_dir, 'dataset')
+        peaks_df = pd.read_csv(self.h3k27me3, sep='\t', header=None)
+        for sample, ext in [('sample1', '.bed'), ('sample2', '.bed.gz')]:
+            os.makedirs(os.path.join(dataset_dir, sample))
+            for chr_name, chr_df in peaks_df.groupby(0):
+                chr_df.to_csv(os.path.join(dataset_dir, sample, f'{sample}_{chr_name}{ext}'), sep='\t', header=False,
+                              index=False)
+        no_genes_df = peaks_df.copy()
+        no_genes_df[0] = 'chrZZ'
+        no_genes_df.to_csv(os.path.join(dataset_dir, 'sample1', 'chrZZ.bed'), sep='\t', header=False, index=False)
+        # Not a partition
+        open(os.path.join(dataset_dir, 'sample1', 'README.md'), 'w').close()
+
+        dataset = PartitionedDataset(dataset_dir, chunk_rows=7)
+        assert len(dataset.partitions) == 7
+        assert [p.chromosome for p in dataset.partitions if p.relpath.startswith('sample2')] == ['1', '6', 'X']
+
+        e2g = Epi2Gene(overlap_method='overlaps')
+        e2g.set_annotation_from_file(self.mm10_annot)
+        output_dir = os.path.join(self.tmp_dir, 'output')
+        outputs = dataset.annotate(e2g, output_dir, workers=3)
+        assert outputs == [os.path.join(output_dir, p.relpath.replace('.bed.gz', '.csv').replace('.bed', '.csv'))
+                           for p in dataset.partitions]
+
+        # Same genes as annotating the whole file
+        bed = Bed(self.h3k27me3, overlap_method='overlaps', header_extra='3')
+        bed.set_annotation_from_file(self.mm10_annot)
+        expected = bed.assign_locations_to_genes_grid([{}])
+        expected = sorted(zip(expected['chr'], expected['start'].astype(int), expected['end'].astype(int),
+                              expected['gene_idx']))
+        assert len(expected) > 0
+        for sample in ['sample1', 'sample2']:
+            sample_df = pd.concat([pd.read_csv(o) for o in outputs if f'{sample}_chr' in o])
+            assert sorted(zip(sample_df['0'], sample_df['1'], sample_df['2'], sample_df['gene_idx'])) == expected
+            assert list(sample_df.columns[-5:]) == e2g.get_columns_in_gene_info()
+        assert len(pd.read_csv(os.path.join(output_dir, 'sample1', 'chrZZ.csv'))) == 0
+
+    def test_dataset_errors(self):
+        self.setup_class()
+        with self.assertRaises(Epi2GeneException):
+            PartitionedDataset(self.h3k27me3)
+        # No annotation yet
+        with self.assertRaises(Epi2GeneException):
+            PartitionedDataset(self.tmp_dir).annotate(Epi2Gene(), self.tmp_dir)
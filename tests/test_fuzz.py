@@ -0,0 +1,248 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+from scie2g import Csv, Epi2Gene
+from scie2g.index import gene_windows, parse_strands
+from scie2g.reference import reference_pairs
+
+# Random cases per overlap method, each engine is compared with the brute force reference on every case
+NUM_CASES = 25
+ANNOT_COLUMNS = ['ensembl_gene_id', 'external_gene_name', 'chromosome_name', 'start_position', 'end_position',
+                 'strand']
+
+
+def random_case(rng: np.random.Generator, overlap_method: str) -> dict:
+    """
+    An adversarial annotation and set of locations: reverse strand, nested and duplicated genes, genes with the start
+    after the end, broad domains and point locations, locations exactly on (and one off) the edges of the gene
+    windows, duplicated locations and chromosomes with no genes. Buffers are random and often asymmetric or 0.
+    """
+    setting = {'overlap_method': overlap_method, 'buffer_before_tss': int(rng.choice([0, 1, 50, 2500])),
+               'buffer_after_tss': int(rng.choice([0, 1, 30, 500])),
+               'buffer_gene_overlap': int(rng.choice([0, 1, 20, 500]))}
+    num_genes = int(rng.integers(1, 25))
+    chrs = rng.choice(['1', '2', 'X'], num_genes)
+    starts = rng.integers(0, 20000, num_genes)
+    ends = starts + np.where(rng.random(num_genes) < 0.2, rng.integers(5000, 15000, num_genes),
+                             rng.integers(0, 800, num_genes))
+    strands = rng.choice([1, -1], num_genes)
+    genes = pd.DataFrame({'chromosome_name': chrs, 'start_position': starts, 'end_position': ends, 'strand': strands})
+    # Nested genes (inside another gene, on either strand) and exact duplicates
+    parents = genes.sample(n=min(3, num_genes), random_state=int(rng.integers(1 << 30)))
+    nested = parents.assign(start_position=parents['start_position'] + 10,
+                            end_position=np.maximum(parents['end_position'] - 10, parents['start_position'] + 10),
+                            strand=-parents['strand'])
+    genes = pd.concat([genes, nested, genes.head(2)], ignore_index=True)
+    # A few genes with the start after the end
+    flipped = rng.random(len(genes)) < 0.1
+    genes.loc[flipped, ['start_position', 'end_position']] = genes.loc[flipped, ['end_position',
+                                                                                 'start_position']].values
+    genes['ensembl_gene_id'] = [f'G{i}' for i in range(len(genes))]
+    genes['external_gene_name'] = genes['ensembl_gene_id']
+
+    # Locations on the edges of the gene windows, random ones (including broad domains) and points
+    lo, hi = gene_windows(genes['start_position'], genes['end_position'], genes['strand'], overlap_method,
+                          setting['buffer_before_tss'], setting['buffer_after_tss'], setting['buffer_gene_overlap'])
+    edges = rng.choice(np.concatenate([lo - 1, lo, hi, hi + 1]), int(rng.integers(1, 20)))
+    edge_chrs = rng.choice(genes['chromosome_name'].values, len(edges))
+    edge_starts = np.where(rng.random(len(edges)) < 0.5, edges, edges - rng.integers(0, 100, len(edges)))
+    edge_ends = np.where(edge_starts == edges, edges + rng.integers(0, 100, len(edges)), edges)
+    num_random = int(rng.integers(1, 20))
+    random_starts = rng.integers(-3000, 25000, num_random)
+    random_ends = random_starts + np.where(rng.random(num_random) < 0.2, rng.integers(0, 20000, num_random),
+                                           rng.integers(0, 300, num_random))
+    locs = pd.DataFrame({'chr': np.concatenate([edge_chrs, rng.choice(['1', '2', 'X', '3'], num_random)]),
+                         'start': np.concatenate([edge_starts, random_starts]),
+                         'end': np.concatenate([edge_ends, random_ends])})
+    locs = pd.concat([locs, locs.sample(n=min(3, len(locs)), random_state=int(rng.integers(1 << 30)))],
+                     ignore_index=True)
+    # UCSC names for the locations, Ensembl names in the annotation
+    locs['chr'] = 'chr' + locs['chr']
+    locs['value'] = rng.random(len(locs))
+    locs['direction'] = rng.choice(['+', '-', '.'], len(locs))
+    locs['loc_id'] = np.arange(len(locs))
+    return {'genes': genes[ANNOT_COLUMNS], 'locs': locs, 'setting': setting}
+
+
+def to_pairs(loc_ids, gene_ids) -> set:
+    return set(zip(np.asarray(loc_ids).tolist(), np.asarray(gene_ids).tolist()))
+
+
+def run_engines(case: dict, tmp_dir: str, direction_aware=False) -> dict:
+    """
+    (location id, gene id) pairs found by every engine, and by the reference. Csv inputs have inclusive ends (one is
+    added to each end when they are read) so the engines reading the file are compared with reference_csv.
+    """
+    annot_file, locs_file = os.path.join(tmp_dir, 'fuzz_annot.csv'), os.path.join(tmp_dir, 'fuzz_locs.csv')
+    case['genes'].to_csv(annot_file, index=False)
+    case['locs'].to_csv(locs_file, index=False)
+    locs, setting = case['locs'], case['setting']
+
+    def make_csv(**kwargs):
+        e2g = Csv(locs_file, 'chr', 'start', 'end', 'value', ['loc_id', 'direction'], direction_aware=direction_aware,
+                  **setting, **kwargs)
+        e2g.set_annotation_from_file(annot_file)
+        return e2g
+
+    pairs = {}
+    e2g = Epi2Gene(direction_aware=direction_aware, **setting)
+    e2g.set_annotation_from_file(annot_file)
+    gene_ids = e2g.gene_annot_df['external_gene_name'].values
+    strands = parse_strands(locs['direction'].values)
+    loc_idx, gene_idx = reference_pairs(e2g, locs['chr'].values, locs['start'].values, locs['end'].values, strands)
+    pairs['reference'] = to_pairs(locs['loc_id'].values[loc_idx], gene_ids[gene_idx])
+    loc_idx, gene_idx = reference_pairs(e2g, locs['chr'].values, locs['start'].values, locs['end'].values + 1, strands)
+    pairs['reference_csv'] = to_pairs(locs['loc_id'].values[loc_idx], gene_ids[gene_idx])
+
+    offsets, gene_idx = e2g.query(locs['chr'].values, locs['start'].values, locs['end'].values, locs['direction'].values)
+    pairs['query'] = to_pairs(np.repeat(locs['loc_id'].values, np.diff(offsets)), gene_ids[gene_idx])
+
+    grid_df = make_csv().assign_locations_to_genes_grid([{}])
+    pairs['grid'] = to_pairs(grid_df['loc_id'], grid_df['external_gene_name'])
+
+    chunked = make_csv(max_memory='1M')
+    chunked.assign_locations_to_genes()
+    chunked.save_loc_to_csv(os.path.join(tmp_dir, 'fuzz_chunked.csv'))
+    chunked_df = pd.read_csv(os.path.join(tmp_dir, 'fuzz_chunked.csv'))
+    pairs['chunked'] = to_pairs(chunked_df['loc_id'], chunked_df['external_gene_name'])
+
+    # The assignment itself
+    assigned = make_csv()
+    assigned.assign_locations_to_genes()
+    assigned_df = assigned.assign_gene_info_to_loc_df(assigned.get_columns_in_gene_info())
+    pairs['assign'] = to_pairs(assigned_df['loc_id'], assigned_df['external_gene_name'])
+    return pairs
+
+
+def get_failures(case: dict, tmp_dir: str, direction_aware=False) -> dict:
+    """
+    Engines that don't find the same pairs as the reference: {engine: (missing pairs, extra pairs)}.
+    """
+    pairs = run_engines(case, tmp_dir, direction_aware)
+    expected, expected_csv = pairs.pop('reference'), pairs.pop('reference_csv')
+    failures = {}
+    for engine, found in pairs.items():
+        engine_expected = expected if engine == 'query' else expected_csv
+        missing, extra = sorted(engine_expected - found), sorted(found - engine_expected)
+        if missing or extra:
+            failures[engine] = (missing, extra)
+    return failures
+
+
+def shrink_case(case: dict, fails) -> dict:
+    """
+    Smallest case (fewest genes and locations) that still fails, found by removing chunks of rows (halves, then
+    quarters, down to single rows) for as long as fails(case) stays True.
+    """
+    for table in ['genes', 'locs', 'genes']:
+        chunk = max(len(case[table]) // 2, 1)
+        while chunk >= 1:
+            start = 0
+            while start < len(case[table]) and len(case[table]) > 1:
+                smaller = dict(case)
+                smaller[table] = case[table].drop(case[table].index[start: start + chunk])
+                if len(smaller[table]) > 0 and fails(smaller):
+                    case = smaller
+                else:
+                    start += chunk
+            chunk //= 2
+    return case
+
+
+def format_case(case: dict, failures: dict) -> str:
+    """ Readable failing case: the settings, the annotation, the locations and what each engine got wrong. """
+    lines = [f'setting: {case["setting"]}', 'annotation:', case['genes'].to_string(index=False), 'locations:',
+             case['locs'].to_string(index=False)]
+    for engine, (missing, extra) in failures.items():
+        lines.append(f'{engine}: missing (loc_id, gene) pairs {missing}, extra pairs {extra}')
+    return '\n'.join(lines)
+
+
+class TestClass(unittest.TestCase):
+
+    @classmethod
+    def setup_class(self):
+        local = True
+        # Create a base object since it will be the same for all the tests
+        THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+        self.data_dir = os.path.join(THIS_DIR, 'data/')
+        if local:
+            self.tmp_dir = os.path.join(THIS_DIR, 'data/tmp/')
+            if os.path.exists(self.tmp_dir):
+                shutil.rmtree(self.tmp_dir)
+            os.mkdir(self.tmp_dir)
+        else:
+            self.tmp_dir = tempfile.mkdtemp(prefix='scie2g_tmp_')
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestFuzz(TestClass):
+
+    def check_engines(self, overlap_method: str, direction_aware=False, seed=0):
+        self.setup_class()
+        rng = np.random.default_rng(seed)
+        for _ in range(NUM_CASES):
+            case = random_case(rng, overlap_method)
+            failures = get_failures(case, self.tmp_dir, direction_aware)
+            if failures:
+                engines = set(failures)
+                case = shrink_case(case, lambda c: bool(engines & set(get_failures(c, self.tmp_dir,
+                                                                                   direction_aware))))
+                self.fail('Engines differ from the reference, minimal case:\n' +
+                          format_case(case, get_failures(case, self.tmp_dir, direction_aware)))
+
+    def test_reference(self):
+        self.setup_class()
+        # Promoter windows: [0, 15] for the forward gene, [35, 50] for the reverse one
+        genes = pd.DataFrame([['G0', 'G0', '1', 10, 40, 1], ['G1', 'G1', '1', 10, 40, -1]], columns=ANNOT_COLUMNS)
+        genes.to_csv(os.path.join(self.tmp_dir, 'annot.csv'), index=False)
+        e2g = Epi2Gene(overlap_method='in_promoter', buffer_before_tss=10, buffer_gene_overlap=5)
+        e2g.set_annotation_from_file(os.path.join(self.tmp_dir, 'annot.csv'))
+        loc_idx, gene_idx = reference_pairs(e2g, ['chr1', 'chr1', 'chr1', 'chr2'], [0, 16, 45, 0], [1, 20, 50, 100])
+        assert list(zip(loc_idx, gene_idx)) == [(0, 0), (2, 1)]
+        # Settings override those on the object, the object isn't changed
+        loc_idx, gene_idx = reference_pairs(e2g, ['chr1'], [0], [1], setting={'buffer_before_tss': 0})
+        assert len(loc_idx) == 0 and e2g.buffer_before_tss == 10
+        loc_idx, gene_idx = reference_pairs(e2g, ['chr1'], [0], [1], setting={'overlap_method': 'overlaps'})
+        assert list(gene_idx) == [0, 1]
+
+    def test_shrink_case(self):
+        # Shrinks to the one gene and location that make the case fail
+        case = {'genes': pd.DataFrame({'g': range(10)}), 'locs': pd.DataFrame({'l': range(10)}), 'setting': {}}
+        minimal = shrink_case(case, lambda c: 7 in c['genes']['g'].values and 3 in c['locs']['l'].values)
+        assert list(minimal['genes']['g']) == [7] and list(minimal['locs']['l']) == [3]
+
+    def test_fuzz_in_promoter(self):
+        self.check_engines('in_promoter', seed=1)
+
+    def test_fuzz_overlaps(self):
+        self.check_engines('overlaps', seed=2)
+
+    def test_fuzz_direction_aware(self):
+        self.check_engines('overlaps', direction_aware=True, seed=3)
+        self.check_engines('in_promoter', direction_aware=True, seed=4)
@@ -0,0 +1,132 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+
+from scie2g import Epi2Gene
+from scie2g.gtf import get_format, is_gtf, read_gtf
+
+GTF = """#!genome-build GRCh38.p13
+chr2\tHAVANA\tgene\t5000\t9000\t.\t-\t.\tgene_id "ENSG3"; gene_version "1"; gene_type "lncRNA"; gene_name "LNC1";
+chr2\tHAVANA\ttranscript\t5000\t9000\t.\t-\t.\tgene_id "ENSG3"; transcript_id "ENST3"; gene_type "lncRNA"; gene_name "LNC1"; transcript_type "lncRNA"; transcript_name "LNC1-201";
+chr1\tHAVANA\tgene\t11869\t14409\t.\t+\t.\tgene_id "ENSG1"; gene_type "protein_coding"; gene_name "DDX11L1";
+chr1\tHAVANA\ttranscript\t11869\t14409\t.\t+\t.\tgene_id "ENSG1"; transcript_id "ENST1"; gene_type "protein_coding"; gene_name "DDX11L1"; transcript_type "protein_coding"; transcript_name "DDX11L1-201";
+chr1\tHAVANA\texon\t11869\t12227\t.\t+\t.\tgene_id "ENSG1"; transcript_id "ENST1"; exon_number 1;
+chr1\tHAVANA\tgene\t3000\t4000\t.\t-\t.\tgene_id "ENSG2"; gene_type "protein_coding";
+"""
+
+GFF3 = """##gff-version 3
+1\tensembl\tgene\t11869\t14409\t.\t+\t.\tID=gene:ENSG1;Name=DDX11L1;biotype=protein_coding
+1\tensembl\tmRNA\t11869\t14409\t.\t+\t.\tID=transcript:ENST1;Parent=gene:ENSG1;Name=DDX11L1-201;biotype=protein_coding
+1\tensembl\texon\t11869\t12227\t.\t+\t.\tParent=transcript:ENST1
+1\tensembl\tncRNA_gene\t3000\t4000\t.\t-\t.\tID=gene:ENSG2;Name=MIR%3B1;biotype=miRNA
+"""
+
+
+class TestClass(unittest.TestCase):
+
+    @classmethod
+    def setup_class(self):
+        local = True
+        # Create a base object since it will be the same for all the tests
+        THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+        self.data_dir = os.path.join(THIS_DIR, 'data/')
+        if local:
+            self.tmp_dir = os.path.join(THIS_DIR, 'data/tmp/')
+            if os.path.exists(self.tmp_dir):
+                shutil.rmtree(self.tmp_dir)
+            os.mkdir(self.tmp_dir)
+        else:
+            self.tmp_dir = tempfile.mkdtemp(prefix='scie2g_tmp_')
+        # Setup the default data for each of the tests
+        self.gtf = os.path.join(self.tmp_dir, 'genes.gtf.gz')
+        with gzip.open(self.gtf, 'wt') as f:
+            f.write(GTF)
+        self.gff3 = os.path.join(self.tmp_dir, 'genes.gff3')
+        with open(self.gff3, 'w') as f:
+            f.write(GFF3)
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestGtf(TestClass):
+
+    def test_format(self):
+        assert is_gtf('genes.gtf.gz') and is_gtf('genes.GFF3') and is_gtf('genes.gff')
+        assert not is_gtf('genes.csv') and not is_gtf('gtf')
+        assert get_format('genes.gff3.gz') == 'gff3'
+        assert get_format('genes.gtf') == 'gtf'
+
+    def test_read_gtf(self):
+        # Small chunks so features are filtered across several chunks
+        annot_df = read_gtf(self.gtf, chunk_rows=2)
+        assert list(annot_df['ensembl_gene_id']) == ['ENSG3', 'ENSG1', 'ENSG2']
+        # The gene id is used when there is no name
+        assert list(annot_df['external_gene_name']) == ['LNC1', 'DDX11L1', 'ENSG2']
+        assert list(annot_df['strand']) == [-1, 1, -1]
+        assert list(annot_df['start_position']) == [5000, 11869, 3000]
+        assert list(annot_df['gene_biotype']) == ['lncRNA', 'protein_coding', 'protein_coding']
+        coding = read_gtf(self.gtf, biotypes=['protein_coding'])
+        assert list(coding['ensembl_gene_id']) == ['ENSG1', 'ENSG2']
+        transcripts = read_gtf(self.gtf, feature_types=['transcript'], biotypes=['protein_coding'])
+        assert list(transcripts['ensembl_transcript_id']) == ['ENST1']
+        assert list(transcripts['external_transcript_name']) == ['DDX11L1-201']
+        assert len(read_gtf(self.gtf, feature_types=['CDS'])) == 0
+
+    def test_read_gff3(self):
+        annot_df = read_gtf(self.gff3)
+        assert list(annot_df['ensembl_gene_id']) == ['ENSG1', 'ENSG2']
+        assert list(annot_df['external_gene_name']) == ['DDX11L1', 'MIR;1']
+        assert list(annot_df['gene_biotype']) == ['protein_coding', 'miRNA']
+        transcripts = read_gtf(self.gff3, feature_types=['mRNA'])
+        assert list(transcripts['ensembl_gene_id']) == ['ENSG1']
+        assert list(transcripts['ensembl_transcript_id']) == ['ENST1']
+        assert list(transcripts['external_transcript_name']) == ['DDX11L1-201']
+
+    def test_hash_in_attributes(self):
+        # Only lines starting with # are comments, a # inside an attribute value is kept
+        gff3 = os.path.join(self.tmp_dir, 'hash.gff3.gz')
+        with gzip.open(gff3, 'wt') as f:
+            f.write('##gff-version 3\n##sequence-region 1 1 20000\n'
+                    '1\tensembl\tgene\t11869\t14409\t.\t+\t.\tID=gene:ENSG1;Name=LINC#1;Dbxref=http://x.org/g#1\n'
+                    '###\n'
+                    '1\tensembl\tgene\t15000\t16000\t.\t-\t.\tID=gene:ENSG2;Name=DDX11L1\n')
+        annot_df = read_gtf(gff3, chunk_rows=2)
+        assert list(annot_df['ensembl_gene_id']) == ['ENSG1', 'ENSG2']
+        assert list(annot_df['external_gene_name']) == ['LINC#1', 'DDX11L1']
+        gtf = os.path.join(self.tmp_dir, 'hash.gtf')
+        with open(gtf, 'w') as f:
+            f.write('#!genome-build GRCh38.p13\n'
+                    'chr1\tHAVANA\tgene\t11869\t14409\t.\t+\t.\tgene_id "ENSG1"; gene_name "LINC#1";\n')
+        assert list(read_gtf(gtf)['external_gene_name']) == ['LINC#1']
+
+    def test_set_annotation_from_gtf(self):
+        l2g = Epi2Gene('', [])
+        l2g.set_annotation_from_gtf(self.gtf)
+        # Sorted on chromosome then TSS (the end for reverse strand genes)
+        assert list(l2g.gene_annot_df['ensembl_gene_id']) == ['ENSG2', 'ENSG1', 'ENSG3']
+        assert l2g.gene_annot_values[0].tolist() == ['chr1', 'ENSG2', 3000, 4000, -1]
+        assert l2g.gene_annot_df['start_position'].dtype == 'int64'
+        assert l2g.num_genes == 3
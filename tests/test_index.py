@@ -0,0 +1,111 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import numpy as np
+import unittest
+
+from scie2g.index import IntervalIndex, StrandedIndex, gene_windows, parse_strands
+
+
+class TestIndex(unittest.TestCase):
+
+    def test_gene_windows(self):
+        # Same values as in test_base: test_in_gene_promoter & test_overlaps_gene
+        lo, hi = gene_windows([0, 10, 10], [40, 40, 40], [1, 1, -1], 'in_promoter', 5, 10, 10)
+        assert list(lo) == [-5, 5, 30]
+        assert list(hi) == [10, 20, 45]
+        lo, hi = gene_windows([10, 40, 10], [40, 10, 40], [1, 1, -1], 'overlaps', 5, 10, 10)
+        assert list(lo) == [5, 5, 0]
+        assert list(hi) == [50, 50, 45]
+        with self.assertRaises(ValueError):
+            gene_windows([0], [1], [1], 'nearby', 5, 10, 10)
+
+    def test_query(self):
+        rng = np.random.default_rng(0)
+        num_intervals, num_queries = 500, 300
+        chrs = rng.integers(0, 3, num_intervals)
+        lo = rng.integers(0, 100000, num_intervals)
+        # Mix of short and very long intervals
+        hi = lo + np.where(rng.random(num_intervals) < 0.1, rng.integers(0, 50000, num_intervals),
+                           rng.integers(0, 500, num_intervals))
+        q_chrs = rng.integers(-1, 3, num_queries)
+        q_starts = rng.integers(0, 100000, num_queries)
+        q_ends = q_starts + rng.integers(0, 1000, num_queries)
+        query_idx, interval_idx = IntervalIndex(chrs, lo, hi).query(q_chrs, q_starts, q_ends)
+        expected = [(q, i) for q in range(num_queries) for i in range(num_intervals)
+                    if q_chrs[q] == chrs[i] and q_starts[q] <= hi[i] and q_ends[q] >= lo[i]]
+        assert list(zip(query_idx, interval_idx)) == expected
+
+    def test_empty_query(self):
+        query_idx, interval_idx = IntervalIndex([0], [10], [20]).query([1], [10], [20])
+        assert len(query_idx) == 0
+        assert len(interval_idx) == 0
+
+    def test_duplicate_query(self):
+        rng = np.random.default_rng(1)
+        num_intervals = 200
+        chrs = rng.integers(0, 2, num_intervals)
+        lo = rng.integers(0, 10000, num_intervals)
+        hi = lo + rng.integers(0, 2000, num_intervals)
+        # Few distinct queries repeated many times, some with the same start but a different end
+        q_chrs = rng.integers(0, 2, 20)
+        q_starts = np.repeat(rng.integers(0, 10000, 10), 2)
+        q_ends = q_starts + rng.integers(0, 500, 20)
+        picks = rng.integers(0, 20, 400)
+        q_chrs, q_starts, q_ends = q_chrs[picks], q_starts[picks], q_ends[picks]
+        query_idx, interval_idx = IntervalIndex(chrs, lo, hi).query(q_chrs, q_starts, q_ends)
+        expected = [(q, i) for q in range(len(picks)) for i in range(num_intervals)
+                    if q_chrs[q] == chrs[i] and q_starts[q] <= hi[i] and q_ends[q] >= lo[i]]
+        assert len(expected) > 0
+        assert list(zip(query_idx, interval_idx)) == expected
+
+    def test_duplicate_intervals(self):
+        # Many identical windows e.g. promoters of transcripts that share a TSS
+        rng = np.random.default_rng(2)
+        picks = rng.integers(0, 30, 300)
+        chrs = rng.integers(0, 2, 30)[picks]
+        lo = rng.integers(0, 10000, 30)[picks]
+        hi = lo + 3000
+        index = IntervalIndex(chrs, lo, hi)
+        assert index.member_offsets is not None and len(index.member_offsets) <= 31
+        q_chrs = rng.integers(0, 2, 100)
+        q_starts = rng.integers(0, 13000, 100)
+        q_ends = q_starts + rng.integers(0, 200, 100)
+        query_idx, interval_idx = index.query(q_chrs, q_starts, q_ends)
+        expected = [(q, i) for q in range(100) for i in range(len(picks))
+                    if q_chrs[q] == chrs[i] and q_starts[q] <= hi[i] and q_ends[q] >= lo[i]]
+        assert len(expected) > 0
+        assert list(zip(query_idx, interval_idx)) == expected
+
+    def test_stranded_query(self):
+        rng = np.random.default_rng(3)
+        chrs = rng.integers(0, 2, 200)
+        lo = rng.integers(0, 10000, 200)
+        hi = lo + rng.integers(0, 1000, 200)
+        directions = rng.choice([1, -1], 200)
+        q_chrs = rng.integers(0, 2, 150)
+        q_starts = rng.integers(0, 10000, 150)
+        q_ends = q_starts + rng.integers(0, 300, 150)
+        q_strands = parse_strands(rng.choice(['+', '-', '.'], 150))
+        query_idx, interval_idx = StrandedIndex(chrs, lo, hi, directions).query(q_chrs, q_starts, q_ends, q_strands)
+        expected = [(q, i) for q in range(150) for i in range(200)
+                    if q_chrs[q] == chrs[i] and q_starts[q] <= hi[i] and q_ends[q] >= lo[i] and
+                    (np.isnan(q_strands[q]) or q_strands[q] == directions[i])]
+        assert len(expected) > 0
+        assert list(zip(query_idx, interval_idx)) == expected
+        assert list(parse_strands(['+', '-', '.', None])[:2]) == [1, -1]
+        assert np.isnan(parse_strands(np.array([0, 1]))[0])
@@ -0,0 +1,218 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+from scie2g import Bed, Csv, Epi2GeneException
+from scie2g.memory import PairSpill, get_chunk_rows, get_nbytes, parse_memory, MIN_CHUNK_ROWS
+
+
+class TestClass(unittest.TestCase):
+
+    @classmethod
+    def setup_class(self):
+        local = True
+        # Create a base object since it will be the same for all the tests
+        THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+        self.data_dir = os.path.join(THIS_DIR, 'data/')
+        if local:
+            self.tmp_dir = os.path.join(THIS_DIR, 'data/tmp/')
+            if os.path.exists(self.tmp_dir):
+                shutil.rmtree(self.tmp_dir)
+            os.mkdir(self.tmp_dir)
+        else:
+            self.tmp_dir = tempfile.mkdtemp(prefix='scie2g_tmp_')
+        # Setup the default data for each of the tests
+        self.h3k27me3 = os.path.join(self.data_dir, 'test_H3K27me3.bed')
+        self.methyl_overlaps = os.path.join(self.data_dir, 'test_methyl_overlaps.csv')
+
+        self.mm10_annot = os.path.join(self.data_dir, 'mmusculus_gene_ensembl-GRCm38.p6.csv')
+        self.hg38_annot = os.path.join(self.data_dir, 'hsapiens_gene_ensembl-GRCh38.p13.csv')
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestMemory(TestClass):
+
+    def test_parse_memory(self):
+        assert parse_memory(None) is None
+        assert parse_memory(100) == 100
+        assert parse_memory('100') == 100
+        assert parse_memory('512M') == 512 * 1024 ** 2
+        assert parse_memory('8G') == 8 * 1024 ** 3
+        assert parse_memory('8gb') == 8 * 1024 ** 3
+        assert parse_memory('1.5K') == 1536
+        with self.assertRaises(ValueError):
+            parse_memory('lots')
+        assert get_chunk_rows(1, 100) == MIN_CHUNK_ROWS
+        assert get_chunk_rows(400 * 1000 * 1000, 100) == 1000 * 1000
+
+    def test_pair_spill(self):
+        spill = PairSpill(max_pairs=4)
+        loc_idx = np.array([0, 0, 1, 3, 3, 3, 4, 7, 8])
+        gene_idx = np.arange(len(loc_idx))
+        for i in range(0, len(loc_idx), 2):
+            spill.add(loc_idx[i: i + 2], gene_idx[i: i + 2])
+        spill.flush()
+        assert len(spill) == len(loc_idx)
+        assert len(spill.files) == 3
+        files = list(spill.files)
+        # Read back in location ranges, crossing the spill files
+        spill.rewind()
+        taken = [spill.take_before(limit) for limit in [1, 3, 5, 8, 10]]
+        assert [list(t['loc_idx']) for t in taken] == [[0, 0], [1], [3, 3, 3, 4], [7], [8]]
+        assert list(np.concatenate(taken)['gene_idx']) == list(gene_idx)
+        # Again from the start
+        spill.rewind()
+        assert len(spill.take_before(100)) == len(loc_idx)
+        spill.cleanup()
+        assert not any(os.path.exists(f) for f in files)
+
+    def check_chunked(self, e2g, expected_e2g, annotation, output_file, chunk_sizes=(7, 5)):
+        """ Runs with tiny chunks so that there are many chunks and spill files, compares to the in memory run. """
+        e2g.set_annotation_from_file(annotation)
+        e2g.get_chunk_sizes = lambda: chunk_sizes
+        e2g.assign_locations_to_genes()
+        assert len(e2g.pair_spill.files) > 1
+        e2g.save_loc_to_csv(output_file)
+        expected_e2g.set_annotation_from_file(annotation)
+        expected = expected_e2g.assign_locations_to_genes_grid([{}]).drop(columns='setting_id')
+        expected.to_csv(output_file + '.expected.csv', index=False)
+        got = pd.read_csv(output_file)
+        assert len(got) > 0
+        assert got.equals(pd.read_csv(output_file + '.expected.csv'))
+
+    def test_bed_max_memory(self):
+        for method in ['in_promoter', 'overlaps']:
+            bed = Bed(self.h3k27me3, overlap_method=method, header_extra='3', max_memory='1M')
+            assert bed.max_memory == 1024 * 1024
+            assert bed.sort_memory == 512 * 1024
+            self.check_chunked(bed, Bed(self.h3k27me3, overlap_method=method, header_extra='3'), self.mm10_annot,
+                               os.path.join(self.tmp_dir, f'bed_chunked_{method}.csv'))
+            with self.assertRaises(Epi2GeneException):
+                bed.get_gene_info_as_df()
+
+    def test_max_memory_same_output(self):
+        # A memory budget never changes the output of assign_locations_to_genes
+        for method in ['in_promoter', 'overlaps']:
+            runs = [(Bed(self.h3k27me3, overlap_method=method, header_extra='3', max_memory=max_memory),
+                     self.mm10_annot) for max_memory in [None, '1M']] + \
+                   [(Csv(self.methyl_overlaps, 'chr', 'start', 'end', 'meth.diff', ['pvalue'], overlap_method=method,
+                         max_memory=max_memory), self.hg38_annot) for max_memory in [None, '1M']]
+            outputs = []
+            for i, (e2g, annotation) in enumerate(runs):
+                e2g.set_annotation_from_file(annotation)
+                if e2g.max_memory is not None:
+                    e2g.get_chunk_sizes = lambda: (3, 2)
+                e2g.assign_locations_to_genes()
+                output_file = os.path.join(self.tmp_dir, f'budget_{method}_{i}.csv')
+                e2g.save_loc_to_csv(output_file)
+                outputs.append(pd.read_csv(output_file))
+            for default_df, budget_df in [outputs[:2], outputs[2:]]:
+                assert len(default_df) > 0
+                assert default_df.equals(budget_df)
+
+    def test_filtered_bed_max_memory(self):
+        # The spilled pairs are read back one chunk of peaks at a time, the filtered bed is the same as without a budget
+        # (an unsorted input is written in input order either way)
+        unsorted = os.path.join(self.tmp_dir, 'h3k27me3_unsorted.bed')
+        with open(self.h3k27me3) as f:
+            lines = f.readlines()
+        with open(unsorted, 'w') as f:
+            f.writelines(lines[::-1])
+        outputs = []
+        for bed_file in [self.h3k27me3, unsorted]:
+            for max_memory in [None, '1M']:
+                filename = os.path.join(self.tmp_dir, f'filtered_{len(outputs)}.bed')
+                bed = Bed(bed_file, overlap_method='overlaps', header_extra='3', max_memory=max_memory,
+                          output_bed_file=filename)
+                bed.set_annotation_from_file(self.mm10_annot)
+                if max_memory is not None:
+                    bed.get_chunk_sizes = lambda: (3, 2)
+                bed.assign_locations_to_genes()
+                with open(filename) as f:
+                    outputs.append(f.readlines())
+        assert len(outputs[0]) > 0
+        assert outputs[0] == outputs[1]
+        assert outputs[2] == outputs[3] == outputs[0][::-1]
+
+    def test_unsorted_csv_max_memory(self):
+        # Reverse the rows so the csv needs to be sorted before it can be read in chunks
+        unsorted = os.path.join(self.tmp_dir, 'methyl_unsorted.csv')
+        df = pd.read_csv(self.methyl_overlaps)
+        df.iloc[::-1].to_csv(unsorted, index=False)
+        for method in ['in_promoter', 'overlaps']:
+            csv = Csv(unsorted, 'chr', 'start', 'end', 'meth.diff', ['pvalue', 'qvalue'], overlap_method=method,
+                      max_memory='1M')
+            expected = Csv(unsorted, 'chr', 'start', 'end', 'meth.diff', ['pvalue', 'qvalue'], overlap_method=method)
+            self.check_chunked(csv, expected, self.hg38_annot, os.path.join(self.tmp_dir, f'csv_chunked_{method}.csv'),
+                               chunk_sizes=(2, 1))
+            assert csv.get_sorted_filename() != unsorted
+
+    def test_get_nbytes(self):
+        values = np.arange(10, dtype=np.int64)
+        assert get_nbytes(None) == 0
+        assert get_nbytes(values) == 80
+        assert get_nbytes(pd.DataFrame({'a': values})) >= 80
+        assert get_nbytes(np.array(['chr1', 'chr2'], dtype=object)) > 16
+        assert get_nbytes({'a': values, 'b': [values]}) > 160
+
+    def test_compact_annotation(self):
+        # Compact annotations give the same outputs with a smaller footprint
+        for direction_aware in [False, True]:
+            outputs, usages, getters = [], [], []
+            for compact in [False, True]:
+                csv = Csv(self.methyl_overlaps, 'chr', 'start', 'end', 'meth.diff', ['pvalue', 'qvalue'],
+                          overlap_method='overlaps', direction_aware=direction_aware, compact_annotation=compact)
+                csv.set_annotation_from_file(self.hg38_annot)
+                csv.assign_locations_to_genes()
+                output_file = os.path.join(self.tmp_dir, f'compact_{compact}_{direction_aware}.csv')
+                csv.save_loc_to_csv(output_file)
+                outputs.append(pd.read_csv(output_file))
+                usages.append(csv.memory_usage())
+                getters.append([(csv.get_gene_chr(g), csv.get_gene_name(g), csv.get_gene_start(g),
+                                 csv.get_gene_end(g), csv.get_gene_direction(g)) for g in range(0, csv.num_genes, 97)])
+            assert len(outputs[0]) > 0
+            assert outputs[0].equals(outputs[1])
+            # The getters read the compact annotation directly
+            assert getters[0] == getters[1]
+            assert usages[1]['gene_annot_values'] == 0
+            assert usages[1]['gene_annot_df'] < usages[0]['gene_annot_df']
+            assert usages[1]['total'] < usages[0]['total']
+            assert usages[0]['total'] == sum(v for k, v in usages[0].items() if k != 'total')
+
+    def test_compact_annotation_columns(self):
+        bed = Bed(self.h3k27me3, header_extra='3', compact_annotation=['ensembl_gene_id'])
+        bed.set_annotation_from_file(self.mm10_annot)
+        assert list(bed.gene_annot_df.columns) == bed.column_order[:5] + ['ensembl_gene_id']
+        assert bed.gene_annot_df['chromosome_name'].dtype == 'category'
+        assert bed.gene_annot_df['strand'].dtype == np.int8
+        bed.assign_locations_to_genes()
+        expected = Bed(self.h3k27me3, header_extra='3')
+        expected.set_annotation_from_file(self.mm10_annot)
+        expected.assign_locations_to_genes()
+        assert bed.rows_with_genes == expected.rows_with_genes
+        with self.assertRaises(Epi2GeneException):
+            Bed(self.h3k27me3, compact_annotation=['missing']).set_annotation_from_file(self.mm10_annot)
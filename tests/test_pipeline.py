@@ -0,0 +1,70 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import threading
+import time
+import unittest
+
+from scie2g.pipeline import BackgroundWriter, prefetch
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_prefetch(self):
+        assert list(prefetch(range(100))) == list(range(100))
+        assert list(prefetch(range(100), depth=0)) == list(range(100))
+        assert list(prefetch([])) == []
+
+        # The reader never gets more than depth items ahead
+        read = []
+
+        def items():
+            for i in range(20):
+                read.append(i)
+                yield i
+        for i in prefetch(items(), depth=2):
+            time.sleep(0.01)
+            assert len(read) <= i + 4  # depth queued, one waiting to be queued and the one returned
+
+        # Errors while reading are raised in the consumer
+        def failing():
+            yield 1
+            raise ValueError('bad chunk')
+        with self.assertRaises(ValueError):
+            list(prefetch(failing()))
+
+        # Closing early stops the reader thread
+        chunks = prefetch(iter(range(1000)), depth=1)
+        assert next(chunks) == 0
+        chunks.close()
+        assert not [t for t in threading.enumerate() if t.name == 'scie2g-reader']
+
+    def test_background_writer(self):
+        for depth in [0, 1, 2]:
+            written = []
+            with BackgroundWriter(written.append, depth=depth) as writer:
+                for i in range(50):
+                    writer.put(i)
+            assert written == list(range(50))
+
+        # Errors while writing are raised by put or when leaving the writer
+        def failing(item):
+            raise IOError('disk full')
+        with self.assertRaises(IOError):
+            with BackgroundWriter(failing) as writer:
+                for i in range(50):
+                    writer.put(i)
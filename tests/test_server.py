@@ -0,0 +1,237 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import http.client
+import http.server
+import importlib
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import pandas as pd
+
+from scie2g import Csv
+from scie2g import server
+from scie2g.server import AnnotationStore, HTTPAnnotationServer, UnixAnnotationServer, ARROW_TYPE
+
+
+class TestClass(unittest.TestCase):
+
+    @classmethod
+    def setup_class(self):
+        local = True
+        # Create a base object since it will be the same for all the tests
+        THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+        self.data_dir = os.path.join(THIS_DIR, 'data/')
+        if local:
+            self.tmp_dir = os.path.join(THIS_DIR, 'data/tmp/')
+            if os.path.exists(self.tmp_dir):
+                shutil.rmtree(self.tmp_dir)
+            os.mkdir(self.tmp_dir)
+        else:
+            self.tmp_dir = tempfile.mkdtemp(prefix='scie2g_tmp_')
+        # Setup the default data for each of the tests
+        self.methyl_overlaps = os.path.join(self.data_dir, 'test_methyl_overlaps.csv')
+
+        self.hg38_annot = os.path.join(self.data_dir, 'hsapiens_gene_ensembl-GRCh38.p13.csv')
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class UnixConnection(http.client.HTTPConnection):
+
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def request(connection, method, path, body=None, headers=None):
+    connection.request(method, path, body=body, headers=headers or {})
+    response = connection.getresponse()
+    return response.status, response.read()
+
+
+class TestServer(TestClass):
+
+    settings = {'overlap_method': 'overlaps', 'buffer_before_tss': 2500, 'buffer_after_tss': 500,
+                'buffer_gene_overlap': 500, 'gene_chr': 2, 'gene_start': 3, 'gene_end': 4, 'gene_direction': 5,
+                'gene_name': 1}
+
+    def start(self, srv):
+        thread = threading.Thread(target=srv.serve_forever, daemon=True)
+        thread.start()
+        return srv
+
+    def expected_pairs(self):
+        """ Location/gene pairs from a normal run, to compare with the server. """
+        f = Csv(self.methyl_overlaps, 'chr', 'start', 'end', 'meth.diff', ['pvalue', 'qvalue'],
+                overlap_method='overlaps')
+        f.set_annotation_from_file(self.hg38_annot)
+        df = f.assign_locations_to_genes_grid([{}])
+        locs = f.read_locations()
+        return locs, df
+
+    def test_http_query(self):
+        store = AnnotationStore({'hg38': self.hg38_annot}, self.settings)
+        srv = self.start(HTTPAnnotationServer(store, port=0))
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', srv.server_address[1])
+            assert request(connection, 'GET', '/health') == (200, b'ok')
+            status, body = request(connection, 'GET', '/annotations')
+            assert status == 200
+            assert json.loads(body)[0]['num_genes'] == store.get('hg38').annotator.num_genes
+
+            locs, expected = self.expected_pairs()
+            query = {'chr': locs['chr'].tolist(), 'start': locs['start'].tolist(), 'end': locs['end'].tolist()}
+            status, body = request(connection, 'POST', '/query', json.dumps(query))
+            assert status == 200
+            result = json.loads(body)
+            assert result['annotation'] == 'hg38'
+            assert len(result['offsets']) == len(locs) + 1
+            assert result['gene_idx'] == expected['gene_idx'].tolist()
+            assert result['external_gene_name'] == expected['external_gene_name'].tolist()
+            for i in range(len(locs)):
+                genes = result['gene_idx'][result['offsets'][i]: result['offsets'][i + 1]]
+                assert genes == expected[expected['idx'] == i]['gene_idx'].tolist()
+
+            # Other columns and bad requests
+            query['columns'] = ['ensembl_gene_id']
+            status, body = request(connection, 'POST', '/query', json.dumps(query))
+            ensembl_ids = store.get('hg38').annotator.gene_annot_df['ensembl_gene_id'].values
+            assert json.loads(body)['ensembl_gene_id'] == ensembl_ids[expected['gene_idx'].values].tolist()
+            status, body = request(connection, 'POST', '/query', json.dumps({'chr': ['1']}))
+            assert status == 400
+            status, body = request(connection, 'POST', '/query', json.dumps({'annotation': 'mm10', **query}))
+            assert status == 400
+            # Payloads of the wrong shape
+            for bad in [[1, 2], {**query, 'start': '100'}, {**query, 'settings': ['overlaps']},
+                        {**query, 'columns': 'external_gene_name'}, {**query, 'start': [None] * len(locs)},
+                        {**query, 'chr': None}]:
+                status, body = request(connection, 'POST', '/query', json.dumps(bad))
+                assert status == 400
+                assert 'error' in json.loads(body)
+            # Caught by the query checks, not by a failure further in
+            for columns in [None, [1], [['external_gene_name']]]:
+                status, body = request(connection, 'POST', '/query', json.dumps({**query, 'columns': columns}))
+                assert status == 400
+                assert 'columns' in json.loads(body)['error']
+            status, body = request(connection, 'GET', '/nothing')
+            assert status == 404
+
+            # Concurrent requests all get the same answer
+            answers = []
+
+            def run():
+                c = http.client.HTTPConnection('127.0.0.1', srv.server_address[1])
+                answers.append(json.loads(request(c, 'POST', '/query', json.dumps(query))[1]))
+            threads = [threading.Thread(target=run) for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert len(answers) == 8
+            assert all(a == answers[0] for a in answers)
+        finally:
+            srv.shutdown()
+            srv.server_close()
+
+    @unittest.skipIf(server.pa is None, 'pyarrow is not installed')
+    def test_arrow_query(self):
+        pa = server.pa
+        store = AnnotationStore({'hg38': self.hg38_annot}, self.settings)
+        srv = self.start(HTTPAnnotationServer(store, port=0))
+        try:
+            locs, expected = self.expected_pairs()
+            table = pa.table({'chr': locs['chr'].astype(str).tolist(), 'start': locs['start'].values,
+                              'end': locs['end'].values})
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            connection = http.client.HTTPConnection('127.0.0.1', srv.server_address[1])
+            status, body = request(connection, 'POST', '/query', sink.getvalue().to_pybytes(),
+                                   {'Content-Type': ARROW_TYPE, 'X-Columns': 'external_gene_name'})
+            assert status == 200
+            result = pa.ipc.open_stream(body).read_all().to_pandas()
+            assert result['region_idx'].tolist() == expected['idx'].tolist()
+            assert result['gene_idx'].tolist() == expected['gene_idx'].tolist()
+            assert result['external_gene_name'].tolist() == expected['external_gene_name'].tolist()
+        finally:
+            srv.shutdown()
+            srv.server_close()
+
+    def test_python36_http_server(self):
+        # ThreadingHTTPServer was added in Python 3.7, on 3.6 the server builds its own
+        threading_server = http.server.ThreadingHTTPServer
+        try:
+            del http.server.ThreadingHTTPServer
+            fallback = importlib.reload(server)
+            assert issubclass(fallback.HTTPAnnotationServer, server.socketserver.ThreadingMixIn)
+            store = AnnotationStore({'hg38': self.hg38_annot}, self.settings)
+            srv = self.start(fallback.HTTPAnnotationServer(store, port=0))
+            try:
+                connection = http.client.HTTPConnection('127.0.0.1', srv.server_address[1])
+                assert request(connection, 'GET', '/health') == (200, b'ok')
+            finally:
+                srv.shutdown()
+                srv.server_close()
+        finally:
+            http.server.ThreadingHTTPServer = threading_server
+            importlib.reload(server)
+
+    def test_unix_socket_and_reload(self):
+        # Small copy of the annotation that we can change
+        annotation = os.path.join(self.tmp_dir, 'annotation.csv')
+        annot_df = pd.read_csv(self.hg38_annot)
+        annot_df[annot_df['chromosome_name'] == '7'].to_csv(annotation, index=False)
+        store = AnnotationStore({'hg38': annotation}, self.settings, reload_interval=0)
+        socket_path = os.path.join(self.tmp_dir, 'scie2g.sock')
+        srv = self.start(UnixAnnotationServer(store, socket_path))
+        try:
+            query = json.dumps({'chr': ['chr7'], 'start': [27082673], 'end': [27109403]})
+            status, body = request(UnixConnection(socket_path), 'POST', '/query', query)
+            assert status == 200
+            first = json.loads(body)
+            assert len(first['gene_idx']) > 0
+
+            # Remove the genes we matched, the server picks up the change
+            genes = set(first['external_gene_name'])
+            annot_df = annot_df[(annot_df['chromosome_name'] == '7') & ~annot_df['external_gene_name'].isin(genes)]
+            annot_df.to_csv(annotation, index=False)
+            os.utime(annotation, (time.time() + 10, time.time() + 10))
+            result = first
+            for _ in range(100):
+                result = json.loads(request(UnixConnection(socket_path), 'POST', '/query', query)[1])
+                if not genes & set(result['external_gene_name']):
+                    break
+                time.sleep(0.1)
+            assert not genes & set(result['external_gene_name'])
+            assert store.get('hg38').annotator.num_genes == len(annot_df)
+        finally:
+            srv.shutdown()
+            srv.server_close()
+        assert not os.path.exists(socket_path)
@@ -0,0 +1,136 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+from scie2g import Bed, Csv
+from scie2g.chromosomes import CHROMOSOMES
+from scie2g.sorting import is_sorted, sort_file
+
+
+class TestClass(unittest.TestCase):
+
+    @classmethod
+    def setup_class(self):
+        local = True
+        # Create a base object since it will be the same for all the tests
+        THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+        self.data_dir = os.path.join(THIS_DIR, 'data/')
+        if local:
+            self.tmp_dir = os.path.join(THIS_DIR, 'data/tmp/')
+            if os.path.exists(self.tmp_dir):
+                shutil.rmtree(self.tmp_dir)
+            os.mkdir(self.tmp_dir)
+        else:
+            self.tmp_dir = tempfile.mkdtemp(prefix='scie2g_tmp_')
+        # Setup the default data for each of the tests
+        self.h3k27me3 = os.path.join(self.data_dir, 'test_H3K27me3.bed')
+        self.methyl_overlaps = os.path.join(self.data_dir, 'test_methyl_overlaps.csv')
+
+        self.mm10_annot = os.path.join(self.data_dir, 'mmusculus_gene_ensembl-GRCm38.p6.csv')
+        self.mm10_unsorted_annot = os.path.join(self.data_dir, 'mmusculus_gene_ensembl-GRCm38.p6_unsorted.csv')
+        self.hg38_annot = os.path.join(self.data_dir, 'hsapiens_gene_ensembl-GRCh38.p13.csv')
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestSorting(TestClass):
+
+    def test_is_sorted(self):
+        codes = CHROMOSOMES.codes(['1', 'chr1', '2', 'X', 'chrM'])
+        assert is_sorted(codes, [5, 10, 1, 1, 1])
+        assert not is_sorted(codes, [10, 5, 1, 1, 1])
+        assert not is_sorted(CHROMOSOMES.codes(['2', '1']), [1, 1])
+        # Canonical (not lexicographic) order
+        assert is_sorted(CHROMOSOMES.codes(['chr2', 'chr10']), [1, 1])
+        assert is_sorted([], [])
+
+    def test_sort_file(self):
+        self.setup_class()
+        # Shuffle the bed file then check the in memory and on disk sorts give the same (sorted) result
+        with open(self.h3k27me3) as f:
+            lines = f.readlines()
+        np.random.default_rng(0).shuffle(lines)
+        shuffled = os.path.join(self.tmp_dir, 'shuffled.bed')
+        with open(shuffled, 'w') as f:
+            f.writelines(lines)
+        in_memory, on_disk = os.path.join(self.tmp_dir, 'mem.bed'), os.path.join(self.tmp_dir, 'disk.bed')
+        assert sort_file(shuffled, in_memory, 0, 1) == 0
+        assert sort_file(shuffled, on_disk, 0, 1, max_memory=2000, tmp_dir=self.tmp_dir) > 1
+        with open(in_memory) as f:
+            in_memory_lines = f.readlines()
+        with open(on_disk) as f:
+            assert f.readlines() == in_memory_lines
+        assert len(in_memory_lines) == len(lines)
+        bed_df = pd.read_csv(in_memory, sep='\t', header=None)
+        assert is_sorted(CHROMOSOMES.codes(bed_df[0].values), bed_df[1].values)
+        # Only the spill files we made should be left in the tmp dir
+        assert sorted(os.listdir(self.tmp_dir)) == ['disk.bed', 'mem.bed', 'shuffled.bed']
+
+    def test_unsorted_annotation(self):
+        self.setup_class()
+        bed = Bed(self.h3k27me3)
+        bed.set_annotation_from_file(self.mm10_unsorted_annot)
+        assert bed.num_genes == len(pd.read_csv(self.mm10_unsorted_annot))
+        # Should now be sorted on chr and TSS
+        values = bed.gene_annot_values
+        tss = np.where(values[:, 4] < 0, values[:, 3], values[:, 2])
+        assert is_sorted(CHROMOSOMES.codes(values[:, 0]), tss)
+        assert list(pd.unique(values[:, 0]))[:3] == ['1', '2', '3']
+
+    def test_unsorted_bed(self):
+        self.setup_class()
+        annot_file = self.mm10_annot
+        with open(self.h3k27me3) as f:
+            lines = f.readlines()
+        np.random.default_rng(1).shuffle(lines)
+        shuffled = os.path.join(self.tmp_dir, 'shuffled.bed')
+        with open(shuffled, 'w') as f:
+            f.writelines(lines)
+        results = []
+        for filename, sort_memory in [(self.h3k27me3, 1024), (shuffled, 1024), (shuffled, 512 * 1024 * 1024)]:
+            bed = Bed(filename, sort_memory=sort_memory)
+            bed.set_annotation_from_file(annot_file)
+            bed.assign_locations_to_genes()
+            loc_df = bed.assign_gene_info_to_loc_df(bed.get_columns_in_gene_info())
+            results.append(sorted(zip(loc_df['chr'], loc_df['start'], loc_df['external_gene_name'])))
+        assert len(results[0]) > 0
+        assert results[0] == results[1]
+        assert results[0] == results[2]
+
+    def test_unsorted_csv(self):
+        self.setup_class()
+        csv_df = pd.read_csv(self.methyl_overlaps)
+        shuffled = os.path.join(self.tmp_dir, 'shuffled.csv')
+        csv_df.iloc[::-1].to_csv(shuffled, index=False)
+        results = []
+        for filename in [self.methyl_overlaps, shuffled]:
+            f = Csv(filename, 'chr', 'start', 'end', 'meth.diff', ['pvalue', 'qvalue', 'description', 'genes'])
+            f.set_annotation_from_file(self.hg38_annot)
+            f.assign_locations_to_genes()
+            loc_df = f.assign_gene_info_to_loc_df(f.get_columns_in_gene_info())
+            results.append(sorted(zip(loc_df['start'], loc_df['external_gene_name'])))
+        assert len(results[0]) > 0
+        assert results[0] == results[1]
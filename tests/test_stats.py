@@ -0,0 +1,109 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from scie2g import Csv
+from scie2g.__main__ import gen_parser, run
+from scie2g.stats import Stats, NULL_TIMER
+
+
+class TestClass(unittest.TestCase):
+
+    @classmethod
+    def setup_class(self):
+        local = True
+        # Create a base object since it will be the same for all the tests
+        THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+        self.data_dir = os.path.join(THIS_DIR, 'data/')
+        if local:
+            self.tmp_dir = os.path.join(THIS_DIR, 'data/tmp/')
+            if os.path.exists(self.tmp_dir):
+                shutil.rmtree(self.tmp_dir)
+            os.mkdir(self.tmp_dir)
+        else:
+            self.tmp_dir = tempfile.mkdtemp(prefix='scie2g_tmp_')
+        # Setup the default data for each of the tests
+        self.h3k27me3 = os.path.join(self.data_dir, 'test_H3K27me3.bed')
+        self.methyl_overlaps = os.path.join(self.data_dir, 'test_methyl_overlaps.csv')
+
+        self.mm10_annot = os.path.join(self.data_dir, 'mmusculus_gene_ensembl-GRCm38.p6.csv')
+        self.hg38_annot = os.path.join(self.data_dir, 'hsapiens_gene_ensembl-GRCh38.p13.csv')
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestStats(TestClass):
+
+    def test_disabled(self):
+        stats = Stats()
+        assert stats.timer('stage') is NULL_TIMER
+        stats.add('counter')
+        stats.set_max('maximum', 10)
+        assert stats.to_dict() == {'stages': {}, 'counters': {}, 'maxima': {}}
+
+        # Nothing is recorded on a default run
+        f = Csv(self.methyl_overlaps, 'chr', 'start', 'end', 'meth.diff', ['pvalue', 'qvalue'])
+        f.set_annotation_from_file(self.mm10_annot)
+        f.assign_locations_to_genes()
+        assert f.stats.to_dict() == {'stages': {}, 'counters': {}, 'maxima': {}}
+
+    def test_enabled(self):
+        f = Csv(self.methyl_overlaps, 'chr', 'start', 'end', 'meth.diff', ['pvalue', 'qvalue'])
+        f.stats.enable()
+        f.set_annotation_from_file(self.hg38_annot)
+        f.assign_locations_to_genes()
+        f.save_loc_to_csv(os.path.join(self.tmp_dir, 'stats_loc.csv'))
+        report = f.stats.to_dict()
+        for stage in ['annotation', 'sort_annotation', 'format_input', 'assign_locations_to_genes', 'save',
+                      'assign_gene_info_to_loc_df']:
+            assert report['stages'][stage]['calls'] == 1
+            assert report['stages'][stage]['seconds'] >= 0
+        counters = report['counters']
+        assert counters['locations_read'] == 5
+        assert counters['matches'] == len(f.rows_with_genes) > 0
+        assert counters['candidate_genes_tested'] >= counters['matches']
+        assert counters['locations_assigned'] <= counters['locations_read']
+        assert report['maxima']['max_genes_per_location'] >= 1
+        # Index counters (these replace the chromosome jumps of the gene by gene walk)
+        assert 0 < counters['index_queries'] <= counters['locations_read']
+        assert 1 <= report['maxima']['max_candidates_per_location'] <= counters['candidate_genes_tested']
+
+        f.stats.reset()
+        assert f.stats.to_dict() == {'stages': {}, 'counters': {}, 'maxima': {}}
+
+    def test_cli_profile(self):
+        profile = os.path.join(self.tmp_dir, 'profile.json')
+        args = gen_parser().parse_args(['--a', self.mm10_annot, '--l2g', self.h3k27me3, '--t', 'b', '--m', 'overlaps',
+                                        '--o', os.path.join(self.tmp_dir, 'profile_out.csv'), '--hdridx', '0,1,2,3',
+                                        '--profile', profile])
+        run(args)
+        with open(profile) as f:
+            report = json.load(f)
+        assert report['info']['input'] == self.h3k27me3
+        assert report['info']['overlap_method'] == 'overlaps'
+        assert 'sort_input' in report['stages']
+        assert 'assign_locations_to_genes' in report['stages']
+        assert report['counters']['locations_read'] > 0
+        assert report['counters']['matches'] > 0